@@ -0,0 +1,245 @@
+"""
+End-to-end benchmark of the proxy against a fake InfluxDB: throughput, latency percentiles & RSS per proxy mode
+
+Modes:
+- direct: clients query the fake InfluxDB directly, i.e. the cost of the backend alone
+- passthrough: through the proxy, w/o any rule nor RP, so that every query gets relayed as is
+- corrective: through the proxy, w/ rules, RP auto-selection & limitation of the nb of points per series
+
+Clients replay a mix of Grafana-like queries (and optionally writes) over keep-alive connections.
+Each mode runs in a process of its own, so that its RSS is not polluted by the other ones.
+RSS includes the fake InfluxDB, which is the same for all modes.
+
+Usage:
+    python benchmarks/bench_proxy.py [--modes direct,passthrough,corrective] [--clients 8] [--duration 10]
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from fake_influxdb import FakeInfluxDB
+from cleanflux.cleanflux_main import Cleanflux
+from cleanflux.proxy.server import ThreadingHTTPServer
+from cleanflux.proxy.request_handler import ProxyRequestHandler
+from cleanflux.proxy.connection_pool import ConnectionPool
+
+
+# ------------------------------------------------------------------------
+# GLOBALS
+
+modes = ('direct', 'passthrough', 'corrective')
+
+# Grafana time ranges, w/ the GROUP BY time() interval it picks for a ~1000 px wide panel
+time_ranges = [('1h', '5s'), ('6h', '20s'), ('24h', '1m'), ('7d', '10m'), ('30d', '1h')]
+
+# (weight, query template)
+query_mix = [
+    (4, 'SELECT mean("value") FROM "gauge_cpu" WHERE time >= now() - {range} GROUP BY time({interval}), "host" fill(null)'),
+    (3, 'SELECT sum("value") FROM "counter_requests" WHERE time >= now() - {range} GROUP BY time({interval}) fill(null)'),
+    (2, 'SELECT non_negative_derivative(max("value"), 1s) FROM "counter_requests" '
+        'WHERE time >= now() - {range} GROUP BY time({interval}), "host" fill(null)'),
+    (1, 'SELECT "value" FROM "gauge_mem" WHERE time >= now() - 15m'),
+    (1, 'SHOW TAG VALUES FROM "gauge_cpu" WITH KEY = "host"'),
+]
+
+aggregation_properties = {
+    'default': [
+        {'regexp': 'counter_.*', 'function': 'sum'},
+        {'regexp': 'gauge_.*', 'function': 'mean'},
+    ],
+}
+
+
+# ------------------------------------------------------------------------
+# SETUP
+
+def disable_statsd():
+    # NB: like the daemon does when no statsd server is configured, whatever the version of datadog
+    from datadog.dogstatsd import statsd
+
+    def custom_send_to_server(*args, **kwargs):
+        return
+    setattr(statsd, '_send_to_server', custom_send_to_server)
+    setattr(statsd, '_send', custom_send_to_server)
+
+
+def start_proxy(mode, backend_host, backend_port, max_nb_points_per_series):
+    if mode == 'corrective':
+        cleanflux = Cleanflux(backend_host, backend_port, None, None,
+                              ['remove_partial_intervals_case_sum_group_by_time'],
+                              True, {}, aggregation_properties, {},
+                              None, max_nb_points_per_series)
+        cleanflux.guard.enrich_rp_conf_from_db()
+    else:
+        cleanflux = Cleanflux(backend_host, backend_port, None, None, [],
+                              False, {}, {}, {}, None, None)
+
+    handler_class = type('BenchProxyRequestHandler', (ProxyRequestHandler,), {
+        'protocol_version': 'HTTP/1.1',
+        'cleanflux': cleanflux,
+        'backend_address': (backend_host, backend_port),
+        'write_connection_pool': ConnectionPool(backend_host, backend_port),
+        'log_message': lambda self, *args: None,
+    })
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+    thread = threading.Thread(target=httpd.serve_forever, name='proxy')
+    thread.daemon = True
+    thread.start()
+    return httpd.server_address[:2]
+
+
+# ------------------------------------------------------------------------
+# LOAD
+
+def build_requests(schema, nb_requests, write_ratio, write_batch_size, seed=42):
+    """
+    :return: list of (method, path, body)
+    """
+    rng = random.Random(seed)
+    templates = [template for weight, template in query_mix for _ in range(weight)]
+    requests = []
+    for i in range(nb_requests):
+        if rng.random() < write_ratio:
+            lines = ['gauge_cpu,host=host-{} value={:.3f} {}'.format(j % 10, rng.random() * 100, i * 10 ** 9 + j)
+                     for j in range(write_batch_size)]
+            requests.append(('POST', '/write?' + urllib.parse.urlencode({'db': schema}), '\n'.join(lines).encode()))
+            continue
+        time_range, interval = rng.choice(time_ranges)
+        query = rng.choice(templates).format(range=time_range, interval=interval)
+        params = {'db': schema, 'epoch': 'ms', 'q': query}
+        requests.append(('GET', '/query?' + urllib.parse.urlencode(params), None))
+    return requests
+
+
+def run_client(host, port, requests, deadline, latencies, errors):
+    conn = http.client.HTTPConnection(host, port, timeout=60)
+    i = 0
+    while time.monotonic() < deadline:
+        method, path, body = requests[i % len(requests)]
+        i += 1
+        start = time.monotonic()
+        try:
+            conn.request(method, path, body=body)
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 300:
+                errors.append(response.status)
+        except Exception as e:
+            errors.append(str(e))
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=60)
+            continue
+        latencies.append(time.monotonic() - start)
+    conn.close()
+
+
+def run_load(host, port, requests, nb_clients, duration):
+    latencies = []
+    errors = []
+    deadline = time.monotonic() + duration
+    threads = []
+    for i in range(nb_clients):
+        # NB: each client starts at another offset of the mix
+        offset = i * len(requests) // nb_clients
+        thread = threading.Thread(target=run_client, args=(host, port, requests[offset:] + requests[:offset],
+                                                           deadline, latencies, errors))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+
+def get_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    # NB: peak rather than current RSS, in KB on Linux but in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else max_rss / 1024.0
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def run_mode(args):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    disable_statsd()
+    fake = FakeInfluxDB(nb_series=args.series, nan_ratio=args.nan_ratio)
+    host, port = fake.start()
+    if args.mode != 'direct':
+        host, port = start_proxy(args.mode, host, port, args.max_points)
+
+    requests = build_requests(fake.schema, args.requests, args.write_ratio, args.write_batch_size)
+    run_load(host, port, requests, args.clients, args.warmup)
+    latencies, errors = run_load(host, port, requests, args.clients, args.duration)
+
+    latencies.sort()
+    return {
+        'mode': args.mode,
+        'nb_requests': len(latencies),
+        'nb_errors': len(errors),
+        'throughput': len(latencies) / args.duration,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'rss_mb': get_rss_mb(),
+    }
+
+
+# ------------------------------------------------------------------------
+# MAIN
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of the proxy against a fake InfluxDB')
+    parser.add_argument('--modes', default=','.join(modes), help='comma-separated list among: ' + ', '.join(modes))
+    parser.add_argument('--mode', help=argparse.SUPPRESS)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10, help='in seconds, per mode')
+    parser.add_argument('--warmup', type=float, default=2, help='in seconds, per mode')
+    parser.add_argument('--requests', type=int, default=500, help='nb of distinct requests in the mix')
+    parser.add_argument('--series', type=int, default=10, help='nb of series per measurement')
+    parser.add_argument('--nan-ratio', type=float, default=0.05)
+    parser.add_argument('--max-points', type=int, default=1000, help='max nb of points per series (corrective)')
+    parser.add_argument('--write-ratio', type=float, default=0.1)
+    parser.add_argument('--write-batch-size', type=int, default=100, help='nb of lines per write')
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        # NB: child process, running a single mode
+        print(json.dumps(run_mode(args)))
+        return
+
+    print('{} clients, {} series per measurement, {:.0%} writes, {}s per mode'.format(
+        args.clients, args.series, args.write_ratio, args.duration))
+    print('{:<14}{:>10}{:>10}{:>10}{:>10}{:>10}'.format('mode', 'req/s', 'p50 ms', 'p99 ms', 'errors', 'RSS MB'))
+    argv = []
+    for name, value in vars(args).items():
+        if name not in ('modes', 'mode'):
+            argv.extend(['--' + name.replace('_', '-'), str(value)])
+    for mode in args.modes.split(','):
+        output = subprocess.check_output([sys.executable, __file__, '--mode', mode] + argv)
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        print('{:<14}{:>10.1f}{:>10.1f}{:>10.1f}{:>10}{:>10.1f}'.format(
+            mode, result['throughput'], result['p50_ms'], result['p99_ms'], result['nb_errors'], result['rss_mb']))
+
+
+if __name__ == '__main__':
+    main()
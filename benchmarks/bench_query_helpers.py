@@ -0,0 +1,242 @@
+"""
+Microbenchmarks of the query parsing / rewriting helpers run on every query, over a corpus of InfluxQL statements
+
+Each helper is timed over the whole corpus (or the part of it it applies to), several rounds in a row,
+and reported per call. Timings can be saved as a baseline and later compared against it:
+the script exits w/ status 1 if any helper got slower than the baseline by more than the threshold.
+
+Usage:
+    python benchmarks/bench_query_helpers.py [--corpus statements.txt] [--statements 3000] [--repeat 5]
+    python benchmarks/bench_query_helpers.py --save-baseline [--only helper,...]
+    python benchmarks/bench_query_helpers.py --compare [--threshold 0.2]
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from influxql_corpus import generate_corpus, load_corpus
+import cleanflux.utils.influx.query_sqlparsing as influx_query_parsing
+import cleanflux.utils.influx.query_modification as influx_query_modification
+import cleanflux.utils.influx.date_manipulation as influx_date_manipulation
+import cleanflux.utils.influx.query_time_bounds as influx_query_time_bounds
+from cleanflux.corrective_rules.loader import import_rules
+from cleanflux.corrective_rules.rule_list import all_rules
+from cleanflux.corrective_rules.rule_pipeline import QueryAnalysis, RulePipeline
+
+
+# ------------------------------------------------------------------------
+# GLOBALS
+
+default_baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'query_helpers.json')
+
+
+# ------------------------------------------------------------------------
+# INPUTS
+
+def disable_statsd():
+    # NB: like the daemon does when no statsd server is configured, whatever the version of datadog
+    from datadog.dogstatsd import statsd
+
+    def custom_send_to_server(*args, **kwargs):
+        return
+    setattr(statsd, '_send_to_server', custom_send_to_server)
+    setattr(statsd, '_send', custom_send_to_server)
+
+
+def copy_parsed(parsed):
+    # NB: the rewriting helpers replace a token of the statement, so a shallow copy w/ its own list of tokens
+    #     is enough to leave the original untouched
+    parsed_copy = copy.copy(parsed)
+    parsed_copy.tokens = list(parsed.tokens)
+    return parsed_copy
+
+
+def get_intervals(parsed_list):
+    intervals = []
+    for parsed in parsed_list:
+        interval = influx_query_parsing.extract_time_interval_group_by(parsed)
+        if interval is not None:
+            intervals.append(interval)
+        if influx_query_parsing.is_non_negative_derivative(parsed):
+            intervals.extend(influx_query_parsing.extract_non_negative_derivative_time_interval(parsed) or [])
+    return intervals
+
+
+def get_benchmarks(statements):
+    """
+    :return: list of (name, inputs, func, is_mutating)
+    NB: inputs of mutating helpers get copied before each round, outside of the timed section
+    """
+    parsed_list = [influx_query_parsing.sqlparse_query(statement) for statement in statements]
+    sum_group_by_time_list = [parsed for parsed in parsed_list if influx_query_parsing.is_sum_group_by_time(parsed)]
+    nnd_list = [parsed for parsed in parsed_list if influx_query_parsing.is_non_negative_derivative(parsed)]
+    intervals = get_intervals(parsed_list)
+    rule_pipeline = RulePipeline(import_rules('localhost', 8086, all_rules))
+
+    return [
+        ('sqlparse_query', statements, influx_query_parsing.sqlparse_query, False),
+        ('extract_group_by_helper', parsed_list,
+         lambda parsed: influx_query_parsing.extract_group_by_helper(parsed, 'value'), False),
+        ('extract_all_columns_in_select', parsed_list, influx_query_parsing.extract_all_columns_in_select, False),
+        ('change_sum_group_by_time_factor', sum_group_by_time_list,
+         lambda parsed: influx_query_modification.change_sum_group_by_time_factor(parsed, 6), True),
+        ('remove_non_negative_derivative', nnd_list, influx_query_modification.remove_non_negative_derivative, True),
+        ('influx_interval_to_timedelta', intervals, influx_date_manipulation.influx_interval_to_timedelta, False),
+        ('split_influx_time', intervals, influx_date_manipulation.split_influx_time, False),
+        # NB: w/o the cache of queries, to time the analysis itself
+        ('get_time_predicates', statements, influx_query_time_bounds.get_time_predicates.__wrapped__, False),
+        ('rule_pipeline_dispatch', parsed_list,
+         lambda parsed: rule_pipeline.dispatch(QueryAnalysis(parsed)), False),
+    ]
+
+
+# ------------------------------------------------------------------------
+# TIMING
+
+def time_benchmark(inputs, func, is_mutating, repeat):
+    """
+    :return: list of timings per call (in µs), one per round
+    """
+    timings = []
+    for _ in range(repeat):
+        round_inputs = [copy_parsed(parsed) for parsed in inputs] if is_mutating else inputs
+        start = time.perf_counter()
+        for round_input in round_inputs:
+            func(round_input)
+        timings.append((time.perf_counter() - start) * 1000 * 1000 / len(round_inputs))
+    return timings
+
+
+def run_benchmarks(statements, repeat, only=None):
+    """
+    :return: dict of name -> {nb_calls, min_us, mean_us, max_us}
+    """
+    results = {}
+    for name, inputs, func, is_mutating in get_benchmarks(statements):
+        if only and name not in only:
+            continue
+        if not inputs:
+            continue
+        # NB: 1 warm-up round, so that regex compilation & caches do not weigh on the 1rst round
+        time_benchmark(inputs, func, is_mutating, 1)
+        timings = time_benchmark(inputs, func, is_mutating, repeat)
+        results[name] = {
+            'nb_calls': len(inputs),
+            'min_us': min(timings),
+            'mean_us': sum(timings) / len(timings),
+            'max_us': max(timings),
+        }
+    return results
+
+
+# ------------------------------------------------------------------------
+# BASELINE
+
+def save_baseline(path, results, corpus_description, is_partial=False):
+    """
+    :param is_partial: True if only some helpers got timed (--only), their timings then replace the ones
+                       of the existing baseline, the other ones being kept
+    """
+    if is_partial and os.path.exists(path):
+        baseline = load_baseline(path)
+        if baseline['corpus'] == corpus_description:
+            results = dict(baseline['results'], **results)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({
+            'corpus': corpus_description,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def get_regressions(results, baseline, threshold):
+    """
+    :return: list of (name, baseline min µs, min µs, ratio) of the helpers slower than the baseline by > threshold
+    NB: compares the best rounds, the least sensitive to noise
+    """
+    regressions = []
+    for name, result in results.items():
+        baseline_result = baseline['results'].get(name)
+        if baseline_result is None:
+            continue
+        ratio = result['min_us'] / baseline_result['min_us'] - 1
+        if ratio > threshold:
+            regressions.append((name, baseline_result['min_us'], result['min_us'], ratio))
+    return regressions
+
+
+# ------------------------------------------------------------------------
+# MAIN
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the query parsing / rewriting helpers')
+    parser.add_argument('--corpus', help='file of InfluxQL statements, one per line (default: generated corpus)')
+    parser.add_argument('--statements', type=int, default=3000, help='nb of statements of the generated corpus')
+    parser.add_argument('--seed', type=int, default=42, help='seed of the generated corpus')
+    parser.add_argument('--repeat', type=int, default=5, help='nb of rounds per helper')
+    parser.add_argument('--only', help='comma-separated list of helpers to run')
+    parser.add_argument('--baseline', default=default_baseline_path, help='path of the baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='save timings as the new baseline')
+    parser.add_argument('--compare', action='store_true', help='compare timings against the baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='max slowdown vs the baseline before failing, e.g. 0.2 for +20%%')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    disable_statsd()
+
+    if args.corpus:
+        statements = load_corpus(args.corpus)
+        corpus_description = os.path.basename(args.corpus)
+    else:
+        statements = generate_corpus(args.statements, args.seed)
+        corpus_description = 'generated, {} statements, seed {}'.format(args.statements, args.seed)
+
+    baseline = None
+    if args.compare:
+        baseline = load_baseline(args.baseline)
+        if baseline['corpus'] != corpus_description:
+            print('WARNING: baseline measured on another corpus ({})'.format(baseline['corpus']))
+
+    only = set(args.only.split(',')) if args.only else None
+    results = run_benchmarks(statements, args.repeat, only)
+
+    print('corpus: {}, {} rounds'.format(corpus_description, args.repeat))
+    print('{:<34}{:>8}{:>10}{:>10}{:>10}{:>10}'.format('helper', 'calls', 'min µs', 'mean µs', 'max µs',
+                                                       'vs base' if baseline else ''))
+    for name, result in results.items():
+        delta = ''
+        if baseline and name in baseline['results']:
+            delta = '{:+.1%}'.format(result['min_us'] / baseline['results'][name]['min_us'] - 1)
+        print('{:<34}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10}'.format(
+            name, result['nb_calls'], result['min_us'], result['mean_us'], result['max_us'], delta))
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results, corpus_description, only is not None)
+        print('baseline saved to {}'.format(args.baseline))
+
+    if baseline:
+        regressions = get_regressions(results, baseline, args.threshold)
+        for name, baseline_us, us, ratio in regressions:
+            print('REGRESSION: {} {:.2f} µs -> {:.2f} µs ({:+.1%})'.format(name, baseline_us, us, ratio))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
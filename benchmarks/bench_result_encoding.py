@@ -0,0 +1,63 @@
+"""
+Benchmark of the output encoders used on the corrective path: encode time and payload size per format
+
+Usage:
+    python benchmarks/bench_result_encoding.py [--series 50] [--points 1000] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import timeit
+import zlib
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from cleanflux.utils.influx.result_encoding import JsonResultEncoder, CsvResultEncoder, MsgpackResultEncoder, msgpack
+
+
+def make_resultset_list(nb_series, nb_points, nb_statements=1, nan_ratio=0.05):
+    rng = np.random.default_rng(42)
+    index = pd.date_range('2024-01-01', periods=nb_points, freq='10s', tz='UTC')
+    resultset_list = []
+    for _ in range(nb_statements):
+        resultset = {}
+        for i in range(nb_series):
+            data = rng.random((nb_points, 3)) * 1000
+            data[rng.random((nb_points, 3)) < nan_ratio] = np.nan
+            df = pd.DataFrame(data, index=index, columns=['mean', 'max', 'min'])
+            resultset[('cpu', (('host', 'host-{}'.format(i)), ('dc', 'eu-west')))] = df
+        resultset_list.append(resultset)
+    return resultset_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark result encoders')
+    parser.add_argument('--series', type=int, default=50)
+    parser.add_argument('--points', type=int, default=1000)
+    parser.add_argument('--statements', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    resultset_list = make_resultset_list(args.series, args.points, args.statements)
+    encoders = [('json', JsonResultEncoder), ('csv', CsvResultEncoder)]
+    if msgpack is not None:
+        encoders.append(('msgpack', MsgpackResultEncoder))
+    else:
+        print('module msgpack not installed, skipping msgpack encoder')
+
+    print('{} statement(s) x {} series x {} points'.format(args.statements, args.series, args.points))
+    print('{:<10}{:>10}{:>14}{:>14}'.format('format', 'ms', 'bytes', 'gzip bytes'))
+    for precision in ['ms', None]:
+        print('epoch={}'.format(precision))
+        for name, encoder in encoders:
+            timings = timeit.repeat(lambda: encoder.encode(resultset_list, precision), number=1, repeat=args.repeat)
+            payload = encoder.encode(resultset_list, precision)
+            print('{:<10}{:>10.1f}{:>14}{:>14}'.format(name, min(timings) * 1000, len(payload),
+                                                       len(zlib.compress(payload, 6))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+"""
+In-process stand-in for InfluxDB, serving /query, /write & /ping w/ synthetic series
+
+Series are generated on the fly from the measurement, time bounds & GROUP BY of each SELECT:
+- measurements starting w/ `counter_` hold counters, wrapping at `counter_overflow`
+- other ones hold gauges
+- a ratio of values are NaNs (null)
+Time is frozen at startup, so that a same query always gets the same (cached) response.
+
+RPs & CQs of the schema follow the example of the README (1_week, 3_month & 10_year, downsampled by CQs),
+so that RP auto-selection works against it.
+
+Usage, standalone:
+    python benchmarks/fake_influxdb.py [--port 8086] [--series 10]
+"""
+import argparse
+import json
+import re
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import numpy as np
+
+
+# ------------------------------------------------------------------------
+# GLOBALS
+
+duration_units_ns = {'ns': 1, 'u': 10 ** 3, 'µ': 10 ** 3, 'ms': 10 ** 6, 's': 10 ** 9, 'm': 60 * 10 ** 9,
+                     'h': 3600 * 10 ** 9, 'd': 86400 * 10 ** 9, 'w': 7 * 86400 * 10 ** 9}
+epoch_units_ns = {'ns': 1, 'n': 1, 'u': 10 ** 3, 'ms': 10 ** 6, 's': 10 ** 9, 'm': 60 * 10 ** 9, 'h': 3600 * 10 ** 9}
+
+duration_re = re.compile(r'(\d+)(ns|u|µ|ms|s|m|h|d|w)')
+select_re = re.compile(r'^\s*SELECT\s+(?P<columns>.+?)\s+FROM\s+(?P<from>\S+)(?P<rest>.*)$', re.IGNORECASE | re.DOTALL)
+lower_bound_re = re.compile(r'time\s*>=?\s*(?P<bound>now\(\)(?:\s*-\s*[\dnsuµmhdw]+)?|\d+(?:ns|u|µ|ms|s)?|\'[^\']+\')',
+                            re.IGNORECASE)
+upper_bound_re = re.compile(r'time\s*<=?\s*(?P<bound>now\(\)(?:\s*[-+]\s*[\dnsuµmhdw]+)?|\d+(?:ns|u|µ|ms|s)?|\'[^\']+\')',
+                            re.IGNORECASE)
+group_by_time_re = re.compile(r'GROUP\s+BY\s+(?P<group_by>.+?)(?:\s+fill\(|\s+ORDER\s|\s+LIMIT\s|\s+SLIMIT\s|$)',
+                              re.IGNORECASE | re.DOTALL)
+alias_re = re.compile(r'\s+AS\s+"?(?P<alias>[^"]+)"?\s*$', re.IGNORECASE)
+function_re = re.compile(r'^\s*(?P<function>\w+)\s*\(')
+field_re = re.compile(r'^\s*"?(?P<field>[^"(]+)"?\s*$')
+limit_re = re.compile(r'\sLIMIT\s+(\d+)', re.IGNORECASE)
+
+DEFAULT_RPS = [
+    ['1_week', '168h0m0s', '1h0m0s', 1, True],
+    ['3_month', '2160h0m0s', '24h0m0s', 1, False],
+    ['10_year', '87600h0m0s', '168h0m0s', 1, False],
+]
+
+
+def get_default_cqs(schema):
+    cqs = []
+    for rp_from, rp_into, interval in (('1_week', '3_month', '10m'), ('3_month', '10_year', '1h')):
+        for kind, function in (('gauge', 'mean'), ('counter', 'sum')):
+            name = 'cq_{}_{}'.format(rp_into, kind)
+            cqs.append([name, 'CREATE CONTINUOUS QUERY {} ON {} BEGIN SELECT {}(value) AS value '
+                              'INTO "{}"."{}".:MEASUREMENT FROM "{}"."{}"./^{}_.*/ GROUP BY *, time({}) END'
+                        .format(name, schema, function, schema, rp_into, schema, rp_from, kind, interval)])
+    return cqs
+
+
+def parse_duration(duration):
+    return sum(int(number) * duration_units_ns[unit] for number, unit in duration_re.findall(duration))
+
+
+# ------------------------------------------------------------------------
+# FAKE BACKEND
+
+class FakeInfluxDB(object):
+    """
+    Synthetic InfluxDB, serving in background threads
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, schema='my_app', nb_series=10, point_interval='10s',
+                 nan_ratio=0.05, counter_overflow=2 ** 32, max_points_per_series=10000, cache_size=1024):
+        """
+        :param nb_series: nb of series (values of tag host) per measurement
+        :param point_interval: interval between raw points
+        :param max_points_per_series: nb of points of a series gets capped to this
+        :param cache_size: nb of responses kept, 0 to disable caching
+        """
+        self.schema = schema
+        self.nb_series = nb_series
+        self.point_interval = parse_duration(point_interval)
+        self.nan_ratio = nan_ratio
+        self.counter_overflow = counter_overflow
+        self.max_points_per_series = max_points_per_series
+        self.cache_size = cache_size
+        self.now = (time.time_ns() // 10 ** 9) * 10 ** 9
+
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.nb_queries = 0
+        self.nb_writes = 0
+        self.nb_points_written = 0
+
+        fake = self
+
+        class Handler(FakeInfluxDBRequestHandler):
+            backend = fake
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.httpd.server_address[:2]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='fake-influxdb')
+        self.thread.daemon = True
+        self.thread.start()
+        return self.address
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    # --------------------------------------------------------------------
+    # QUERIES
+
+    def query(self, q, epoch=None):
+        """
+        :return: JSON body of the response (bytes)
+        """
+        with self.lock:
+            self.nb_queries += 1
+            body = self.cache.get((q, epoch))
+            if body is not None:
+                self.cache.move_to_end((q, epoch))
+                return body
+        statements = [statement for statement in q.split(';') if statement.strip()]
+        results = []
+        for i, statement in enumerate(statements):
+            result = self.query_statement(statement.strip(), epoch)
+            result['statement_id'] = i
+            results.append(result)
+        body = json.dumps({'results': results}).encode()
+        if self.cache_size:
+            with self.lock:
+                self.cache[(q, epoch)] = body
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return body
+
+    def query_statement(self, statement, epoch):
+        upper = statement.upper()
+        if upper.startswith('SELECT'):
+            return self.select(statement, epoch)
+        if upper.startswith('SHOW DATABASES'):
+            return {'series': [{'name': 'databases', 'columns': ['name'], 'values': [['_internal'], [self.schema]]}]}
+        if upper.startswith('SHOW RETENTION POLICIES'):
+            return {'series': [{'columns': ['name', 'duration', 'shardGroupDuration', 'replicaN', 'default'],
+                                'values': DEFAULT_RPS}]}
+        if upper.startswith('SHOW CONTINUOUS QUERIES'):
+            return {'series': [{'name': '_internal', 'columns': ['name', 'query'], 'values': []},
+                               {'name': self.schema, 'columns': ['name', 'query'],
+                                'values': get_default_cqs(self.schema)}]}
+        if upper.startswith('SHOW TAG VALUES'):
+            return {'series': [{'name': 'gauge_cpu', 'columns': ['key', 'value'],
+                                'values': [['host', 'host-{}'.format(i)] for i in range(self.nb_series)]}]}
+        if upper.startswith('SHOW MEASUREMENTS'):
+            return {'series': [{'name': 'measurements', 'columns': ['name'],
+                                'values': [['counter_requests'], ['gauge_cpu'], ['gauge_mem']]}]}
+        return {}
+
+    def select(self, statement, epoch):
+        match = select_re.match(statement)
+        if match is None:
+            return {'error': 'error parsing query: {}'.format(statement)}
+        measurement = match.group('from').split('.')[-1].strip('"')
+        if measurement.startswith('/'):
+            measurement = 'gauge_cpu'
+        rest = match.group('rest')
+        columns = get_column_names(match.group('columns'))
+
+        start, end = self.get_time_bounds(rest)
+        interval = self.point_interval
+        by_host = False
+        group_by = group_by_time_re.search(rest)
+        if group_by is not None:
+            group_by = group_by.group('group_by')
+            time_interval = re.search(r'time\((\w+)', group_by)
+            if time_interval is not None:
+                interval = parse_duration(time_interval.group(1)) or interval
+            by_host = '*' in group_by or 'host' in group_by
+
+        start -= start % interval
+        nb_points = max(0, min(self.max_points_per_series, (end - start) // interval + 1))
+        limit = limit_re.search(rest)
+        if limit is not None:
+            nb_points = min(nb_points, int(limit.group(1)))
+        timestamps = start + np.arange(nb_points, dtype=np.int64) * interval
+
+        series_list = []
+        for i in range(self.nb_series if by_host else 1):
+            series = {'name': measurement, 'columns': ['time'] + columns,
+                      'values': self.get_values(measurement, i, timestamps, len(columns), epoch)}
+            if by_host:
+                series['tags'] = {'host': 'host-{}'.format(i)}
+            series_list.append(series)
+        return {'series': series_list}
+
+    def get_time_bounds(self, rest):
+        end = self.now
+        upper = upper_bound_re.search(rest)
+        if upper is not None:
+            end = self.parse_time_bound(upper.group('bound'))
+        start = end - 3600 * 10 ** 9
+        lower = lower_bound_re.search(rest)
+        if lower is not None:
+            start = self.parse_time_bound(lower.group('bound'))
+        return start, end
+
+    def parse_time_bound(self, bound):
+        if bound.lower().startswith('now()'):
+            shift = bound[5:].replace(' ', '')
+            if not shift:
+                return self.now
+            return self.now + (1 if shift[0] == '+' else -1) * parse_duration(shift[1:])
+        if bound.startswith("'"):
+            value = datetime.fromisoformat(bound.strip("'").replace('Z', '+00:00'))
+            return int(value.timestamp()) * 10 ** 9
+        unit = re.search(r'[a-zµ]+$', bound)
+        if unit is None:
+            return int(bound)
+        return int(bound[:unit.start()]) * duration_units_ns[unit.group(0)]
+
+    def get_values(self, measurement, series_index, timestamps, nb_columns, epoch):
+        seconds = timestamps // 10 ** 9
+        if measurement.startswith('counter_'):
+            rate = 1000 * (series_index + 1)
+            # NB: series i wraps i + 1 hours before now, so that wraps happen within the usual time ranges
+            elapsed = seconds - self.now // 10 ** 9 + 3600 * (series_index + 1)
+            values = (elapsed * rate % self.counter_overflow).astype(np.float64)
+        else:
+            values = 50 + 40 * np.sin(seconds / 3600.0 + series_index)
+        values = np.round(values, 3).tolist()
+        # NB: deterministic NaNs, so that a same query always gets the same response
+        nan_mask = ((seconds * 2654435761 + series_index) % 1000) < self.nan_ratio * 1000
+
+        if epoch is None:
+            times = [datetime.fromtimestamp(int(ts) // 10 ** 9, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+                     for ts in timestamps]
+        else:
+            times = (timestamps // epoch_units_ns.get(epoch, 1)).tolist()
+        return [[t] + [None if is_nan else value] * nb_columns
+                for t, value, is_nan in zip(times, values, nan_mask.tolist())]
+
+    # --------------------------------------------------------------------
+    # WRITES
+
+    def write(self, payload):
+        nb_points = sum(1 for line in payload.split(b'\n') if line and not line.startswith(b'#'))
+        with self.lock:
+            self.nb_writes += 1
+            self.nb_points_written += nb_points
+
+
+def get_column_names(columns):
+    """
+    :param columns: select clause
+    :return: name of each column in the response
+    """
+    names = []
+    depth = 0
+    current = ''
+    for c in columns + ',':
+        if c == ',' and depth == 0:
+            names.append(get_column_name(current))
+            current = ''
+            continue
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        current += c
+    return names
+
+
+def get_column_name(column):
+    alias = alias_re.search(column)
+    if alias is not None:
+        return alias.group('alias')
+    function = function_re.match(column)
+    if function is not None:
+        return function.group('function')
+    field = field_re.match(column)
+    if field is not None and field.group('field').strip() != '*':
+        return field.group('field').strip()
+    return 'value'
+
+
+# ------------------------------------------------------------------------
+# HTTP
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeInfluxDBRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # NB: headers & body are sent separately, which must not wait for delayed ACKs
+    disable_nagle_algorithm = True
+    backend = None
+
+    def do_GET(self):
+        url_parts = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url_parts.query)
+        endpoint = url_parts.path.rstrip('/')
+        if endpoint == '/ping':
+            self._send(204)
+            return
+        if endpoint != '/query':
+            self._send(404, b'{"error": "not found"}')
+            return
+        if self.command == 'POST' and 'application/x-www-form-urlencoded' in self.headers.get('Content-Type', ''):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            params.update(urllib.parse.parse_qs(body.decode()))
+        elif self.command == 'POST':
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        q = params.get('q', [''])[0]
+        epoch = params.get('epoch', [None])[0]
+        self._send(200, self.backend.query(q, epoch))
+
+    def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path.rstrip('/') != '/write':
+            self.do_GET()
+            return
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            payload = b''.join(chunks)
+        else:
+            payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.backend.write(payload)
+        self._send(204)
+
+    def _send(self, status, body=None):
+        self.send_response(status)
+        self.send_header('X-Influxdb-Version', '1.8.10-fake')
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+        else:
+            self.send_header('Content-Length', '0')
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(body)
+
+    def log_message(self, log_format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake InfluxDB serving synthetic series')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8086)
+    parser.add_argument('--schema', default='my_app')
+    parser.add_argument('--series', type=int, default=10)
+    parser.add_argument('--point-interval', default='10s')
+    parser.add_argument('--nan-ratio', type=float, default=0.05)
+    args = parser.parse_args()
+
+    fake = FakeInfluxDB(args.host, args.port, args.schema, args.series, args.point_interval, args.nan_ratio)
+    print('Fake InfluxDB serving {} on {}:{}'.format(args.schema, *fake.address))
+    fake.httpd.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
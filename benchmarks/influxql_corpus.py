@@ -0,0 +1,95 @@
+"""
+Corpus of InfluxQL statements, as sent by Grafana & co, for benchmarks
+
+Either generated (deterministically) by combining the usual shapes of dashboard queries,
+or loaded from a file of real-world statements (one per line, e.g. extracted from InfluxDB query logs).
+"""
+import random
+
+
+# ------------------------------------------------------------------------
+# GLOBALS
+
+measurements = ['cpu', 'mem', 'disk', 'gauge_load', 'counter_requests', 'counter_bytes_in', 'timer_api_latency',
+                'net.if.octets', 'docker_container_cpu']
+fields = ['value', 'usage_idle', 'usage_user', 'used_percent', 'count', 'mean', 'upper', '90_percentile']
+tags = ['host', 'dc', 'cpu', 'path', 'container_name']
+schemas = ['my_app', 'telegraf', 'metrics']
+rps = ['1_week', '3_month', '10_year', 'autogen']
+ranges = ['5m', '15m', '1h', '3h', '6h', '12h', '24h', '2d', '7d', '30d', '90d']
+intervals = ['1s', '10s', '20s', '30s', '1m', '2m', '5m', '10m', '30m', '1h', '3h', '12h', '1d']
+
+aggregates = ['mean({})', 'sum({})', 'max({})', 'min({})', 'count({})', 'last({})', 'median({})',
+              'percentile({}, 95)', 'non_negative_derivative(max({}), 1s)', 'non_negative_derivative(sum({}), 10s)',
+              'derivative(mean({}), 1m)', 'sum({}) / 60', '8 * non_negative_derivative(max({}), 1s)']
+
+
+# ------------------------------------------------------------------------
+# CORPUS
+
+def generate_corpus(nb_statements=3000, seed=42):
+    """
+    :return: list of statements
+    """
+    rng = random.Random(seed)
+    return [generate_statement(rng) for _ in range(nb_statements)]
+
+
+def load_corpus(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+def generate_statement(rng):
+    field = rng.choice(fields)
+    quoted_field = '"{}"'.format(field) if rng.random() < 0.8 else field
+
+    measurement = rng.choice(measurements)
+    kind = rng.random()
+    if kind < 0.6:
+        from_clause = '"{}"'.format(measurement)
+    elif kind < 0.8:
+        from_clause = '"{}"."{}"'.format(rng.choice(rps), measurement)
+    elif kind < 0.9:
+        from_clause = '"{}"."{}"."{}"'.format(rng.choice(schemas), rng.choice(rps), measurement)
+    else:
+        from_clause = '/^{}.*/'.format(measurement[:4])
+
+    is_raw = rng.random() < 0.1
+    if is_raw:
+        columns = [quoted_field]
+    else:
+        columns = []
+        for i in range(1 if rng.random() < 0.7 else rng.randint(2, 4)):
+            column = rng.choice(aggregates).format(quoted_field if i == 0 else '"{}"'.format(rng.choice(fields)))
+            if rng.random() < 0.4:
+                column += ' AS "{}_{}"'.format(field, i)
+            columns.append(column)
+
+    conditions = []
+    for _ in range(rng.randint(0, 2)):
+        conditions.append('"{}" = \'{}-{}\''.format(rng.choice(tags), rng.choice(tags), rng.randint(0, 99)))
+    if rng.random() < 0.1:
+        conditions.append('"{}" =~ /^(a|b|c)$/'.format(rng.choice(tags)))
+    time_kind = rng.random()
+    if time_kind < 0.7:
+        conditions.append('time >= now() - {}'.format(rng.choice(ranges)))
+    elif time_kind < 0.9:
+        start = rng.randint(1500000000, 1700000000) * 1000
+        conditions.append('time >= {}ms and time <= {}ms'.format(start, start + rng.randint(1, 720) * 3600 * 1000))
+    else:
+        conditions.append("time > '2024-0{}-01T00:00:00Z'".format(rng.randint(1, 9)))
+    statement = 'SELECT {} FROM {} WHERE {}'.format(', '.join(columns), from_clause, ' AND '.join(conditions))
+
+    if not is_raw:
+        group_by = ['time({})'.format(rng.choice(intervals))]
+        for _ in range(rng.randint(0, 2)):
+            group_by.append('"{}"'.format(rng.choice(tags)))
+        if rng.random() < 0.1:
+            group_by = ['*'] + group_by
+        statement += ' GROUP BY ' + ', '.join(group_by)
+        if rng.random() < 0.7:
+            statement += ' fill({})'.format(rng.choice(['null', 'none', '0', 'previous', 'linear']))
+    if rng.random() < 0.1:
+        statement += ' LIMIT {}'.format(rng.choice([1, 10, 100, 1000]))
+    return statement
@@ -114,7 +114,13 @@ def start_proxy(config):
                           config.aggregation_properties,
                           config.counter_overflows,
                           config.max_nb_points_per_query,
-                          config.max_nb_points_per_series)
+                          config.max_nb_points_per_series,
+                          shards=config.shards,
+                          rollups=config.rollups,
+                          downsample_raw_queries=config.downsample_raw_queries,
+                          downsample_raw_queries_min_window=config.downsample_raw_queries_min_window,
+                          downsample_raw_queries_max_nb_points=config.downsample_raw_queries_max_nb_points,
+                          measurement_cache_ttl=config.measurement_cache_ttl)
     http_proxy_daemon = HttpDaemon(config=config, cleanflux=cleanflux)
 
     daemon = daemonocle.Daemon(
@@ -1,11 +1,10 @@
 # coding=utf-8
 import logging
 from pprint import pprint
-import urllib.parse
-from influxdb import DataFrameClient
 
 from cleanflux.corrective_guard.corrective_guard import CorrectiveGuard
-from cleanflux.utils.influx.querying import pd_result_to_influx_result
+from cleanflux.utils.influx.querying import pd_query
+from cleanflux.utils.influx.shard_routing import ShardRouter
 
 
 class Cleanflux(object):
@@ -17,9 +16,15 @@ class Cleanflux(object):
                  rules,
                  auto_retrieve_retention_policies, retention_policies,
                  aggregation_properties, counter_overflows,
-                 max_nb_points_per_query, max_nb_points_per_series, safe_mode=True):
+                 max_nb_points_per_query, max_nb_points_per_series, safe_mode=True, shards=None, rollups=None,
+                 downsample_raw_queries=False, downsample_raw_queries_min_window='1d',
+                 downsample_raw_queries_max_nb_points=1000, measurement_cache_ttl=300):
         """
         :param rules: A list of rules to evaluate
+        :param shards: routing table of schemas / measurements to backends, see ShardRouter
+        :param rollups: pre-aggregated measurements, in addition to the ones discovered from CQs, see RollupCatalog
+        :param downsample_raw_queries: If set to True, aggregate queries on raw fields over long time windows
+        :param measurement_cache_ttl: in seconds, how long measurements of a schema are kept to resolve regexes
         :param safe_mode: If set to True, allow the query in case it can not be parsed
         :return:
         """
@@ -27,46 +32,71 @@ class Cleanflux(object):
         self.backend_port = backend_port
         self.backend_user = backend_user
         self.backend_password = backend_password
+        self.shard_router = ShardRouter(shards or [], backend_host, backend_port)
 
         self.guard = CorrectiveGuard(backend_host, backend_port, backend_user, backend_password,
                                      rules,
                                      auto_retrieve_retention_policies, retention_policies,
                                      aggregation_properties, counter_overflows,
-                                     max_nb_points_per_query, max_nb_points_per_series)
+                                     max_nb_points_per_query, max_nb_points_per_series,
+                                     self.shard_router, rollups,
+                                     downsample_raw_queries, downsample_raw_queries_min_window,
+                                     downsample_raw_queries_max_nb_points, measurement_cache_ttl)
         self.safe_mode = safe_mode
 
 
-    def get_alt_data(self, user, password, schema, queries, precision):
+    def get_alt_data(self, context):
+        """
+        :type context: RequestContext
+        :return: one pandas result per statement, None if no query needs to be reworked
+                 (or if the request is to be fanned out, see RequestContext.fanout_backends)
+        """
 
-        if not user and not password \
+        if not context.user and not context.password \
                 and self.backend_user and self.backend_password:
-            user = self.backend_user
-            password = self.backend_password
+            context.user = self.backend_user
+            context.password = self.backend_password
 
         got_alt_data = False
         alt_data_list = []
-        for query_string in queries:
+        for query_string in context.queries:
             logging.debug("Checking {}".format(query_string))
-            query_sanitized = urllib.parse.unquote(query_string)#.decode('string_escape')
-            alt_data = self.guard.get_data(user, password, schema, query_sanitized)
+            alt_data = self.guard.get_data(context, query_string)
             if alt_data is not None:
                 # logging.debug("Got alternative data for query")
                 got_alt_data = True
             alt_data_list.append(alt_data)
 
-        if not got_alt_data:
+        if context.error is not None:
             return None
 
-        pd_influx_client = DataFrameClient(self.backend_host, self.backend_port, user, password, schema)
+        if any(len(backends) > 1 for backends in context.fanouts.values()):
+            if got_alt_data or any(query_string not in context.fanouts for query_string in context.queries):
+                # NB: results of other statements can't be merged w/ the ones of the shards
+                context.error = "SHOW statements on a schema split over several shards must be sent " \
+                                "in a request of their own"
+                return None
+            # NB: other shards return no series for the measurements they do not hold
+            context.fanout_backends = []
+            for backends in context.fanouts.values():
+                for backend in backends:
+                    if backend not in context.fanout_backends:
+                        context.fanout_backends.append(backend)
+            return None
 
-        i = 0
-        for query_string in queries:
+        backends = set(context.backends.values())
+        if not got_alt_data:
+            if len(backends) <= 1:
+                # NB: request can be relayed as is
+                context.backend = next(iter(backends), None)
+                return None
+            logging.debug("Statements are spread over several shards, querying them one by one")
+
+        for i, query_string in enumerate(context.queries):
             if alt_data_list[i] is None:
-                result_df_dict = pd_influx_client.query(query_string)
+                backend_host, backend_port = context.backends.get(query_string, self.shard_router.default_backend)
+                result_df_dict = pd_query(backend_host, backend_port,
+                                          context.user, context.password, context.schema, query_string)
                 alt_data_list[i] = result_df_dict
-            i = i + 1
-
-        my_json = pd_result_to_influx_result(alt_data_list, precision)
-        # logging.debug("formatted output: {0}".format(my_json))
 
-        return my_json
+        return alt_data_list
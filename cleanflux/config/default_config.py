@@ -10,14 +10,80 @@ DEFAULT_CONFIG = {
     'backend_user': None,
     'backend_password': None,
 
-    # Corrective rules
+    # Identical replicas of the backend to spread reads over, e.g. [{'host': 'influx-1', 'port': 8086}, ...]
+    # leave empty to read from backend_host / backend_port only
+    'read_backends': [],
+    'read_health_check_interval': 5,  # in seconds, 0 to disable
+    # send a duplicate query to a second replica when first one is slower than the given percentile of latencies
+    'read_hedging': False,
+    'read_hedging_percentile': 95,
+    'read_hedging_min_delay_ms': 10,
+
+    # Routing of schemas / measurements to other backends, first match wins, e.g.
+    # [{'host': 'influx-2', 'port': 8086, 'schema': '^metrics$', 'measurement': '^cpu_'}, ...]
+    # unmatched data stays on backend_host / backend_port
+    'shards': [],
+
+    # Admin server, serving introspection views (e.g. /debug/queries), disabled if no port
+    'admin_host': 'localhost',
+    'admin_port': None,
+
+    # Sampling profiler, triggered on the admin server (/debug/profile)
+    'profiler': True,
+    'profiler_rate': 100,  # default nb of samples per second
+    'profiler_max_seconds': 60,
+
+    # Time the stages of each request (parse, rp_selection, backend, decode, rule_action, serialize...),
+    # sent back as a Server-Timing header and logged for requests slower than the threshold (None to disable)
+    'tracing': False,
+    'slow_request_threshold_ms': 1000,
+
+    # Track the top query shapes (statements w/ literals stripped) by count, backend time, rows & bytes returned
+    'query_stats': True,
+    'query_stats_capacity': 200,  # nb of fingerprints tracked
+    'query_stats_flush_interval': 60,  # in seconds, interval at which top ones get sent to statsd, 0 to disable
+    'query_stats_flush_top_n': 20,
+
+    # Capture /query requests (w/o credentials) into rotating gzip files of JSON lines, for replay, disabled if no dir
+    'capture_dir': None,
+    'capture_sample_rate': 1.0,  # ratio of requests captured
+    'capture_max_file_bytes': 64 * 1024 * 1024,  # uncompressed size at which a file gets rotated...
+    'capture_max_file_age': 300,  # ... or its age, in seconds
+    'capture_max_files': 10,  # nb of files kept, oldest ones being deleted
+
+    # Corrective rules, in order of precedence: the 1rst one applying to a query reworks it
     'rules': [
         'remove_partial_intervals_case_sum_group_by_time',
     ],
 
+    # Compress responses for clients sending an Accept-Encoding header (gzip or deflate)
+    'compression': True,
+    'compression_min_size': 1024,  # in bytes, smaller bodies are sent as is
+    'compression_level': 6,  # 1 (fastest) to 9 (smallest)
+
+    # Relay /write requests by chunks on pooled backend connections, bypassing query analysis
+    'write_fast_path': True,
+    'write_pool_max_idle': 16,
+    'write_pool_max_idle_age': 30,  # in seconds, older idle connections get closed rather than reused
+    'write_chunk_size': 64 * 1024,
+
+    # Buffer small writes sharing the same target (db, rp, precision, consistency) and send them as one.
+    # A batch rejected as a bad request (e.g. 1 malformed line) gets its writes re-sent one by one,
+    # so that each client gets its own status
+    'write_coalescing': False,
+    'write_coalescing_max_request_bytes': 64 * 1024,  # bigger writes are relayed directly
+    'write_coalescing_max_bytes': 1024 * 1024,  # flush when batch reaches this size...
+    'write_coalescing_max_delay_ms': 100,  # ... or when its oldest write is this old
+    'write_coalescing_max_pending_bytes': 64 * 1024 * 1024,  # backpressure threshold
+
     'max_nb_points_per_series': None,
     'max_nb_points_per_query': None,
 
+    # Aggregate queries on raw fields (w/o GROUP BY time()) over long time windows
+    'downsample_raw_queries': False,
+    'downsample_raw_queries_min_window': '1d',  # smaller windows are left as is
+    'downsample_raw_queries_max_nb_points': 1000,  # per series, unless max_nb_points_per_series is set
+
     # Max values of fields before overflow
     'counter_overflows': {},
 
@@ -28,6 +94,15 @@ DEFAULT_CONFIG = {
     'auto_retrieve_retention_policies': True, # enable / disable auto retrieve at startup
     'retention_policies': {}, # overrides
 
+    # Measurements of each schema, listed to resolve regexes in FROM clauses (e.g. FROM /^cpu.*/) for RP selection,
+    # are kept for this long, in seconds
+    'measurement_cache_ttl': 300,
+
+    # Rollups, i.e. aggregates of a measurement written into another one, in addition to the ones found in CQs, e.g.
+    # [{'schema': 'my_app', 'measurement': 'cpu', 'function': 'mean', 'field': 'value', 'interval': '1h',
+    #   'rollup_rp': '1_year', 'rollup_measurement': 'cpu_1h', 'rollup_field': 'value'}, ...]
+    'rollups': [],
+
     # Run in foreground?
     'foreground': False,
 
@@ -1,8 +1,14 @@
 import logging
+import threading
 from datadog import statsd
 
 from cleanflux.corrective_rules.loader import import_rules
+from cleanflux.corrective_rules.rule_pipeline import QueryAnalysis, RulePipeline
 from cleanflux.utils.influx.querying import pd_query, get_rp_list
+from cleanflux.utils.influx.shard_routing import ShardRouter
+from cleanflux.utils.influx.rollup_catalog import RollupCatalog
+from cleanflux.utils.influx.measurement_catalog import MeasurementCatalog
+from cleanflux.utils.tracing import stage
 import cleanflux.utils.influx.query_sqlparsing as influx_query_parsing
 import cleanflux.utils.influx.rp_auto_selection as influx_rp_auto_selection
 
@@ -17,8 +23,12 @@ class CorrectiveGuard(object):
                  rule_names,
                  auto_retrieve_retention_policies, retention_policies,
                  aggregation_properties, counter_overflows,
-                 max_nb_points_per_query, max_nb_points_per_series):
-        self.rules = import_rules(backend_host, backend_port, rule_names)
+                 max_nb_points_per_query, max_nb_points_per_series,
+                 shard_router=None, rollups=None,
+                 downsample_raw_queries=False, downsample_raw_queries_min_window='1d',
+                 downsample_raw_queries_max_nb_points=1000, measurement_cache_ttl=300):
+        self.rules = import_rules(backend_host, backend_port, rule_names, {'counter_overflows': counter_overflows})
+        self.rule_pipeline = RulePipeline(self.rules)
         self.auto_retrieve_retention_policies = auto_retrieve_retention_policies
         self.retention_policies = retention_policies
         self.aggregation_properties = aggregation_properties
@@ -29,6 +39,17 @@ class CorrectiveGuard(object):
         self.backend_port = backend_port
         self.backend_user = backend_user
         self.backend_password = backend_password
+        self.rollup_catalog = RollupCatalog(rollups)
+        self.measurement_catalog = MeasurementCatalog(backend_user, backend_password, measurement_cache_ttl)
+        self.downsample_raw_queries = downsample_raw_queries
+        self.downsample_raw_queries_min_window = downsample_raw_queries_min_window
+        self.downsample_raw_queries_max_nb_points = downsample_raw_queries_max_nb_points
+        self.shard_router = shard_router
+        if shard_router is None:
+            self.shard_router = ShardRouter([], backend_host, backend_port)
+        # nb of queries each rule / rewrite applied to
+        self.lock = threading.Lock()
+        self.nb_fires = {name: 0 for name in self.rules}
 
 
     @statsd.timed('timer_corrective_guard', use_ms=True)
@@ -37,8 +58,13 @@ class CorrectiveGuard(object):
             logging.info("Automatic retrieval of RPs disabled by config")
             return
         logging.info("Automatic retrieval of active RPs from DB has started")
-        retention_policies_auto = get_rp_list(self.backend_host, self.backend_port,
-                                              self.backend_user, self.backend_password)
+        retention_policies_auto = {}
+        for backend_host, backend_port in self.shard_router.backends:
+            # NB: a schema split over several shards has the same RPs on each of them
+            for schema, rp_list in get_rp_list(backend_host, backend_port,
+                                               self.backend_user, self.backend_password,
+                                               rollup_catalog=self.rollup_catalog).items():
+                retention_policies_auto.setdefault(schema, rp_list)
         for rp, props in retention_policies_auto.items():
             if rp in self.retention_policies:
                 retention_policies_auto[rp] = self.retention_policies[rp]
@@ -46,63 +72,366 @@ class CorrectiveGuard(object):
 
 
     @statsd.timed('timer_corrective_guard', use_ms=True)
-    def get_data(self, user, password, schema, query):
+    def get_data(self, context, query):
+        """
+        :param context: parameters of the HTTP request the query belongs to
+        :type context: RequestContext
+        :param query: a single statement
+        :return: reworked data, None if query does not need to be reworked
+        """
+        user = context.user
+        password = context.password
+        schema = context.schema
 
         # prevent expensive parsing of query case not select
         if not query.upper().startswith('SELECT '):
+            self.route_statement(context, query)
             return None
 
         parsed_query = influx_query_parsing.sqlparse_query(query)
 
         if not influx_query_parsing.is_select(parsed_query):
+            self.route_statement(context, query)
             return None
 
+        context_query = query
+        if influx_query_parsing.extract_subquery(parsed_query) is not None:
+            query, parsed_query, from_parts, query_is_modified, (backend_host, backend_port) = \
+                self.rewrite_nested_query(context, context_query, query, parsed_query)
+        else:
+            from_parts_list = influx_query_parsing.extract_measurements_from_query(schema, parsed_query)
+            if from_parts_list is not None and influx_query_parsing.is_multi_measurement_query(from_parts_list):
+                statements, (backend_host, backend_port) = self.rewrite_multi_measurement_query(
+                    context, context_query, query, parsed_query, from_parts_list)
+                if statements is not None and len(statements) > 1:
+                    # NB: each statement selects from its own measurements, so results do not overlap
+                    result_df_dict = {}
+                    for query, (statement_host, statement_port) in statements:
+                        result_df_dict.update(pd_query(statement_host, statement_port, user, password, schema, query))
+                    return result_df_dict
+                query_is_modified = statements is not None
+                if query_is_modified:
+                    query, (backend_host, backend_port) = statements[0]
+                    parsed_query = influx_query_parsing.sqlparse_query(query)
+                # NB: rules apply to a single measurement
+                from_parts = None
+            else:
+                from_parts = from_parts_list[0] if from_parts_list is not None else None
+                query, parsed_query, query_is_modified, (backend_host, backend_port) = self.rewrite_query(
+                    context, context_query, query, parsed_query, from_parts)
+
+        # NB: 1rst rule whose pre-filters & check pass applies, most queries not getting any rule checked
+        for name, rule in self.rule_pipeline.dispatch(QueryAnalysis(parsed_query, from_parts)):
+            if rule.check(query, parsed_query):
+                more = {'backend': (backend_host, backend_port), 'from_parts': from_parts}
+                self.count_fire(name)
+                with stage('rule_action'):
+                    return rule.action(user, password, schema, query, parsed_query, more)
+
+        if query_is_modified:
+            result_df_dict = pd_query(backend_host, backend_port, user, password, schema, query)
+            return result_df_dict
+
+        return None
+
+    def rewrite_query(self, context, context_query, query, parsed_query, from_parts, is_subquery=False):
+        """
+        Apply RP selection & limits of nb of points to a query selecting from a measurement
+        :param context_query: statement as sent by the client, for routing
+        :param is_subquery: True if query is the innermost statement of a query w/ subqueries
+        :return: (query, parsed query, whether it got reworked, backend (host, port))
+        """
         query_is_modified = False
+        backend_host, backend_port = self.route(context, context_query, from_parts)
+        if from_parts is None or influx_query_parsing.is_regexp_measurement(from_parts['measurement']):
+            # NB: measurements matching a regex are resolved for flat queries only, see rewrite_multi_measurement_query()
+            return query, parsed_query, query_is_modified, (backend_host, backend_port)
 
-        from_parts = influx_query_parsing.extract_measurement_from_query(schema, parsed_query)
+        # NB: rows of a subquery may be counted or summed by the outer statements, so are left raw
+        if self.downsample_raw_queries and not is_subquery:
+            query_downsampled = influx_rp_auto_selection.update_query_to_downsample_raw_query(
+                from_parts, query, parsed_query,
+                self.retention_policies, self.aggregation_properties,
+                self.get_max_nb_points_per_series(context) or self.downsample_raw_queries_max_nb_points,
+                self.downsample_raw_queries_min_window)
+            if query_downsampled is not None:
+                self.count_fire('downsample_raw_query')
+                query_is_modified = True
+                context.downsampled = True
+                query = query_downsampled
+                parsed_query = influx_query_parsing.sqlparse_query(query)
 
         query_auto_rp = influx_rp_auto_selection.update_query_with_right_rp(from_parts, query, parsed_query,
                                                                             self.retention_policies,
-                                                                            self.aggregation_properties, False)
+                                                                            self.aggregation_properties, False,
+                                                                            self.rollup_catalog, is_subquery)
         if query_auto_rp is not None:
+            self.count_fire('auto_rp')
             query_is_modified = True
+            # NB: query might now target a rollup, stored on another shard
+            backend_host, backend_port = self.route(context, context_query, from_parts)
             query = query_auto_rp
 
+        query_limit_nb_points = self.limit_nb_points(context, from_parts, query, parsed_query,
+                                                     (backend_host, backend_port))
+        if query_limit_nb_points is not None:
+            query_is_modified = True
+            query = query_limit_nb_points
+
+        return query, parsed_query, query_is_modified, (backend_host, backend_port)
+
+    def rewrite_multi_measurement_query(self, context, context_query, query, parsed_query, from_parts_list):
+        """
+        Apply RP selection & limits of nb of points to a query selecting from several measurements, or from the ones
+        matching regexes, which get resolved against the measurements of the schema.
+        On a schema split over several shards, query gets split into one statement per shard, each one selecting
+        from the measurements the shard holds.
+        :param context_query: statement as sent by the client, for routing
+        :param from_parts_list: as returned by extract_measurements_from_query()
+        :return: (list of reworked statements w/ the backend (host, port) each one is sent to, whose results are
+                  to be merged, None if query is left unchanged, backend (host, port) of the query)
+        """
+        schema = from_parts_list[0]['schema']
+        if schema is None:
+            return None, self.route(context, context_query, from_parts_list[0])
+
+        from_parts_by_backend = self.split_from_parts_by_backend(from_parts_list)
+        if from_parts_by_backend is None:
+            # NB: better no answer than the one of a single shard
+            context.error = "Could not resolve the measurements of a schema split over several shards: " + query
+            return None, self.route(context, context_query, from_parts_list[0])
+        if len(from_parts_by_backend) <= 1:
+            backend = next(iter(from_parts_by_backend), None)
+            if backend is None:
+                backend = self.route(context, context_query, {'schema': schema, 'rp': None, 'measurement': None})
+            context.backends[context_query] = backend
+            queries = self.rewrite_multi_measurement_query_on_backend(context, query, parsed_query,
+                                                                      from_parts_list, backend)
+            if queries is None:
+                return None, backend
+            return [(statement, backend) for statement in queries], backend
+
+        self.count_fire('split_multi_measurement_query')
+        statements = []
+        for backend, backend_from_parts_list in from_parts_by_backend.items():
+            from_clause = ', '.join(influx_rp_auto_selection.get_measurement_path(from_parts['schema'],
+                                                                                  from_parts['rp'],
+                                                                                  from_parts['measurement'])
+                                    for from_parts in backend_from_parts_list)
+            backend_query = influx_rp_auto_selection.rework_statement_for_rp(
+                influx_query_parsing.sqlparse_query(query), from_clause, None, None)
+            backend_queries = self.rewrite_multi_measurement_query_on_backend(
+                context, backend_query, influx_query_parsing.sqlparse_query(backend_query),
+                backend_from_parts_list, backend)
+            statements.extend((statement, backend) for statement in backend_queries or [backend_query])
+        backend = statements[0][1]
+        context.backends[context_query] = backend
+        return statements, backend
+
+    def split_from_parts_by_backend(self, from_parts_list):
+        """
+        :param from_parts_list: as returned by extract_measurements_from_query()
+        :return: dict of backend (host, port) -> from_parts of the measurements it holds, those matching regexes
+                 being resolved against each shard of a schema split by measurement,
+                 None if some could not be resolved
+        """
+        from_parts_by_backend = {}
+        for from_parts in from_parts_list:
+            schema = from_parts['schema']
+            measurement = from_parts['measurement']
+            backend = self.shard_router.get_schema_backend(schema)
+            if backend is not None:
+                from_parts_by_backend.setdefault(backend, []).append(from_parts)
+                continue
+            if not influx_query_parsing.is_regexp_measurement(measurement):
+                backend = self.shard_router.get_backend(schema, measurement)
+                from_parts_by_backend.setdefault(backend, []).append(from_parts)
+                continue
+            for backend_host, backend_port in self.shard_router.get_schema_backends(schema):
+                measurements = self.measurement_catalog.resolve(backend_host, backend_port, schema, measurement)
+                if measurements is None:
+                    logging.warning('Could not resolve measurements matching {} on {}:{}'.format(
+                        measurement, backend_host, backend_port))
+                    return None
+                for resolved_measurement in measurements:
+                    # NB: measurements found on a shard they are not routed to are left aside, as for writes
+                    if self.shard_router.get_backend(schema, resolved_measurement) == (backend_host, backend_port):
+                        from_parts_by_backend.setdefault((backend_host, backend_port), []).append(
+                            dict(from_parts, measurement=resolved_measurement))
+        return from_parts_by_backend
+
+    def rewrite_multi_measurement_query_on_backend(self, context, query, parsed_query, from_parts_list, backend):
+        """
+        :param backend: (host, port) holding all the measurements of the query
+        :return: list of reworked statements, whose results are to be merged, None if query is left unchanged
+        """
+        backend_host, backend_port = backend
+        schema = from_parts_list[0]['schema']
+        queries = None
+        if schema in self.retention_policies and all(from_parts['rp'] is None for from_parts in from_parts_list):
+            measurement_lists = []
+            for from_parts in from_parts_list:
+                measurement = from_parts['measurement']
+                if not influx_query_parsing.is_regexp_measurement(measurement):
+                    measurement_lists.append([measurement])
+                    continue
+                measurements = self.measurement_catalog.resolve(backend_host, backend_port, schema, measurement)
+                if measurements is None:
+                    logging.warning('Could not resolve measurements matching ' + measurement)
+                    measurement_lists = None
+                    break
+                measurement_lists.append(measurements)
+            if measurement_lists is not None:
+                queries = influx_rp_auto_selection.update_multi_measurement_query_with_right_rp(
+                    from_parts_list, measurement_lists, query, parsed_query,
+                    self.retention_policies, self.aggregation_properties)
+                if queries is not None:
+                    self.count_fire('auto_rp')
+
+        query_is_modified = queries is not None
+        new_queries = []
+        for statement in queries or [query]:
+            query_limit_nb_points = self.limit_nb_points(context, from_parts_list[0], statement,
+                                                         influx_query_parsing.sqlparse_query(statement), backend)
+            if query_limit_nb_points is not None:
+                query_is_modified = True
+                statement = query_limit_nb_points
+            new_queries.append(statement)
+
+        if not query_is_modified:
+            return None
+        return new_queries
+
+    def limit_nb_points(self, context, from_parts, query, parsed_query, backend):
+        """
+        :param backend: (host, port) the query is sent to
+        :return: reworked query, None if its nb of points is within limits
+        """
         if self.max_nb_points_per_query is not None:
             query_limit_nb_points = influx_rp_auto_selection.update_query_to_limit_nb_points_for_query(
-                self.backend_host, self.backend_port, user, password, from_parts,
+                backend[0], backend[1], context.user, context.password, from_parts,
                 query, parsed_query,
                 self.aggregation_properties,
                 self.max_nb_points_per_query)
             if query_limit_nb_points is not None:
-                query_is_modified = True
-                query = query_limit_nb_points
-        elif self.max_nb_points_per_series is not None:
+                self.count_fire('limit_nb_points_for_query')
+            return query_limit_nb_points
+        if self.get_max_nb_points_per_series(context) is not None:
             query_limit_nb_points = influx_rp_auto_selection.update_query_to_limit_nb_points_per_series(
                 from_parts, query, parsed_query,
-                self.aggregation_properties, self.max_nb_points_per_series)
+                self.aggregation_properties, self.get_max_nb_points_per_series(context))
             if query_limit_nb_points is not None:
-                query_is_modified = True
-                query = query_limit_nb_points
-
-        # for rule in self.rules.itervalues():
-        if 'handle_counter_wrap_non_negative_derivative' in self.rules:
-            if from_parts['schema'] is not None and from_parts['schema'] in self.counter_overflows:
-                measurement_overflows = self.counter_overflows[from_parts['schema']]
-                if from_parts['measurement'] in measurement_overflows:
-                    if from_parts['measurement'] in measurement_overflows:
-                        # NB: should do it for each field, instead of for whole measurement
-                        rule = self.rules['handle_counter_wrap_non_negative_derivative']
-                        if rule.check(query):
-                            more = {'overflow_value': measurement_overflows[from_parts['measurement']]}
-                            return rule.action(user, password, schema, query, more)
-        if 'remove_partial_intervals_case_sum_group_by_time' in self.rules:
-            rule = self.rules['remove_partial_intervals_case_sum_group_by_time']
-            if rule.check(query, parsed_query):
-                return rule.action(user, password, schema, query, parsed_query)
+                self.count_fire('limit_nb_points_per_series')
+            return query_limit_nb_points
+        return None
 
-        if query_is_modified:
-            result_df_dict = pd_query(self.backend_host, self.backend_port, user, password, schema, query)
-            return result_df_dict
+    def rewrite_nested_query(self, context, context_query, query, parsed_query):
+        """
+        Apply RP selection & limits of nb of points to the innermost statement of a query w/ subqueries, which reads
+        the data, and align GROUP BY time() of the outer statements on it
+        :param context_query: statement as sent by the client, for routing
+        :return: (query, parsed query, from_parts of the innermost statement, whether it got reworked,
+                  backend (host, port))
+        """
+        subquery = influx_query_parsing.extract_subquery(parsed_query)
+        parsed_subquery = influx_query_parsing.sqlparse_query(subquery)
+        subquery_interval = influx_query_parsing.extract_time_interval_group_by(parsed_subquery)
+        if influx_query_parsing.extract_subquery(parsed_subquery) is not None:
+            new_subquery, parsed_subquery, from_parts, is_modified, backend = self.rewrite_nested_query(
+                context, context_query, subquery, parsed_subquery)
+        else:
+            from_parts = influx_query_parsing.extract_measurement_from_query(context.schema, parsed_subquery)
+            new_subquery, parsed_subquery, is_modified, backend = self.rewrite_query(
+                context, context_query, subquery, parsed_subquery, from_parts, True)
+        if not is_modified:
+            return query, parsed_query, from_parts, False, backend
 
-        return None
+        new_subquery_interval = influx_query_parsing.extract_time_interval_group_by(parsed_subquery)
+        from_id = influx_query_parsing.extract_from_helper(parsed_query, 'index')
+        parsed_query.tokens[from_id] = '(' + new_subquery + ')'
+        query_aligned = influx_rp_auto_selection.update_query_to_fit_subquery_interval(
+            parsed_query, subquery_interval, new_subquery_interval)
+        if query_aligned is not None:
+            self.count_fire('fit_subquery_interval')
+            query = query_aligned
+        else:
+            query = influx_query_parsing.stringify_sqlparsed(parsed_query)
+        return query, parsed_query, from_parts, True, backend
+
+    def get_max_nb_points_per_series(self, context):
+        """
+        :type context: RequestContext
+        :return: max nb of points per series hinted by client, capped by config
+        """
+        if context.max_nb_points is None:
+            return self.max_nb_points_per_series
+        if self.max_nb_points_per_series is None:
+            return context.max_nb_points
+        return min(context.max_nb_points, self.max_nb_points_per_series)
+
+    def route(self, context, query, from_parts=None):
+        """
+        Select the backend holding the data of the query and record it in context
+        :type context: RequestContext
+        :param from_parts: as returned by extract_measurement_from_query(), None if query is not a SELECT
+        :return: (host, port)
+        """
+        schema = context.schema
+        measurement = None
+        if from_parts is not None:
+            schema = from_parts['schema'] or schema
+            measurement = from_parts['measurement']
+        backend = self.shard_router.get_backend(schema, measurement)
+        context.backends[query] = backend
+        return backend
+
+    def route_statement(self, context, query):
+        """
+        Select the backend(s) holding the data of a statement that is not a SELECT and record them in context.
+        On a schema split by measurement, SHOW statements listing measurements, series, tags or fields go to
+        the shard(s) of the measurements they are FROM, or to every shard of the schema w/o a FROM (or FROM a regex)
+        :type context: RequestContext
+        """
+        show = influx_query_parsing.extract_measurements_from_show(context.schema, query)
+        if show is None:
+            self.route(context, query)
+            return
+        schema, from_parts_list = show
+        if schema is None or self.shard_router.get_schema_backend(schema) is not None:
+            self.route(context, query, {'schema': schema, 'rp': None, 'measurement': None})
+            return
+
+        if from_parts_list is None or any(influx_query_parsing.is_regexp_measurement(from_parts['measurement'])
+                                          for from_parts in from_parts_list):
+            backends = self.shard_router.get_schema_backends(schema)
+        else:
+            backends = []
+            for from_parts in from_parts_list:
+                backend = self.shard_router.get_backend(from_parts['schema'], from_parts['measurement'])
+                if backend not in backends:
+                    backends.append(backend)
+        context.fanouts[query] = backends
+        if len(backends) == 1:
+            context.backends[query] = backends[0]
+
+    # --------------------------------------------------------------------
+    # INTROSPECTION
+
+    def count_fire(self, name):
+        with self.lock:
+            self.nb_fires[name] = self.nb_fires.get(name, 0) + 1
+
+    def get_fire_counts(self):
+        with self.lock:
+            return dict(self.nb_fires)
+
+    def get_state(self):
+        return {
+            'rules': sorted(self.rules),
+            'rule_prefilters': self.rule_pipeline.get_state(),
+            'nb_fires': self.get_fire_counts(),
+            'max_nb_points_per_query': self.max_nb_points_per_query,
+            'max_nb_points_per_series': self.max_nb_points_per_series,
+            'downsample_raw_queries': self.downsample_raw_queries,
+            'measurements': self.measurement_catalog.get_state(),
+        }
@@ -1,7 +1,64 @@
+class RulePrefilter(object):
+    """
+    Static conditions a query must meet for a rule to be checked, evaluated once per query against its QueryAnalysis.
+    They are necessary conditions only: check() stays the one deciding whether the rule applies.
+    """
+
+    __slots__ = ('functions', 'group_by_time', 'measurements')
+
+    def __init__(self, functions=None, group_by_time=False, measurements=None):
+        """
+        :param functions: names (lower case) of functions, one of which at least must be called in SELECT,
+                          None for any query
+        :param group_by_time: True if the query must have a GROUP BY time()
+        :param measurements: dict of schema -> measurements (None for any measurement of schema) the query must
+                             select from, None for any
+        """
+        self.functions = frozenset(functions) if functions is not None else None
+        self.group_by_time = group_by_time
+        self.measurements = None
+        if measurements is not None:
+            self.measurements = {schema: frozenset(schema_measurements) if schema_measurements is not None else None
+                                 for schema, schema_measurements in measurements.items()}
+
+    def match_measurement(self, schema, measurement):
+        if self.measurements is None:
+            return True
+        if schema not in self.measurements:
+            return False
+        schema_measurements = self.measurements[schema]
+        return schema_measurements is None or measurement in schema_measurements
+
+    def get_state(self):
+        return {
+            'functions': sorted(self.functions) if self.functions is not None else None,
+            'group_by_time': self.group_by_time,
+            'measurements': {schema: sorted(schema_measurements) if schema_measurements is not None else None
+                             for schema, schema_measurements in self.measurements.items()}
+            if self.measurements is not None else None,
+        }
+
+
 class CorrectiveRule(object):
-    def __init__(self, backend_host, backend_port):
+    # NB: checked against any query by default
+    prefilter = RulePrefilter()
+
+    def __init__(self, backend_host, backend_port, conf=None):
+        """
+        :param conf: settings of the guard rules may depend on, e.g. {'counter_overflows': ...}
+        """
         self.backend_host = backend_host
         self.backend_port = backend_port
+        self.conf = conf or {}
+
+    def get_backend(self, more=None):
+        """
+        :param more: as passed to action()
+        :return: (host, port) of the backend the query got routed to
+        """
+        if more and 'backend' in more:
+            return more['backend']
+        return self.backend_host, self.backend_port
 
     @staticmethod
     def description():
@@ -10,6 +67,12 @@ class CorrectiveRule(object):
         """
         pass
 
+    def get_prefilter(self):
+        """
+        :return: RulePrefilter, conditions a query must meet for check() to be called
+        """
+        return self.prefilter
+
     def check(self, query, parsed_query):
         """
         Check if a given query is permitted
@@ -27,7 +90,8 @@ class CorrectiveRule(object):
         :param schema:
         :param query:
         :param parsed_query:
-        :param more:
+        :param more: dict w/ keys backend ((host, port) the query got routed to) & from_parts (measurement path
+                     the query selects from, None if several ones)
         :return: Reworked data
         """
         pass
@@ -6,7 +6,7 @@ from pprint import pprint
 from datadog import statsd
 
 from cleanflux.utils.influx.querying import pd_query
-from cleanflux.corrective_rules.corrective_rule import CorrectiveRule
+from cleanflux.corrective_rules.corrective_rule import CorrectiveRule, RulePrefilter
 import cleanflux.utils.influx.query_sqlparsing as influx_query_parsing
 import cleanflux.utils.influx.query_modification as influx_query_modification
 import cleanflux.utils.influx.date_manipulation as influx_date_manipulation
@@ -18,19 +18,28 @@ class RuleChecker(CorrectiveRule):
     def description():
         return "Handles counter overflows when using function non_negative_derivative"
 
+    def get_prefilter(self):
+        # NB: only measurements w/ a known overflow value, see counter_overflows
+        counter_overflows = self.conf.get('counter_overflows') or {}
+        return RulePrefilter(functions=['non_negative_derivative'], group_by_time=True,
+                             measurements={schema: list(measurement_overflows)
+                                           for schema, measurement_overflows in counter_overflows.items()})
+
     @statsd.timed('timer_check_handle_counter_wrap_non_negative_derivative', use_ms=True)
     def check(self, query, parsed_query):
         is_non_negative_derivative = influx_query_parsing.is_non_negative_derivative(parsed_query)
-        is_lower_time_bound_parsable = influx_query_parsing.is_lower_time_bound_parsable(parsed_query)
+        is_lower_time_bound_parsable = influx_query_parsing.is_lower_time_bound_parsable(query)
         return is_non_negative_derivative and is_lower_time_bound_parsable
 
     @statsd.timed('timer_handle_counter_wrap_non_negative_derivative', use_ms=True)
-    def action(self, user, password, schema, query, more=None):
+    def action(self, user, password, schema, query, parsed_query, more=None):
 
-        overflow_value = more['overflow_value']
+        # NB: should do it for each field, instead of for whole measurement
+        from_parts = more['from_parts']
+        overflow_value = self.conf['counter_overflows'][from_parts['schema']][from_parts['measurement']]
 
-        nnd_interval_list = influx_query_parsing.extract_non_negative_derivative_time_interval(query)
-        nnd_column_list = influx_query_parsing.extract_non_negative_derivative_column_name(query)
+        nnd_interval_list = influx_query_parsing.extract_non_negative_derivative_time_interval(parsed_query)
+        nnd_column_list = influx_query_parsing.extract_non_negative_derivative_column_name(parsed_query)
 
         nnd_interval_ms_list = []
         for nnd_interval in nnd_interval_list:
@@ -47,20 +56,22 @@ class RuleChecker(CorrectiveRule):
                 nb_default_column_name += 1
                 default_column_name_map[i] = nnd_column
 
-        alt_query = influx_query_modification.remove_non_negative_derivative(query, None, forced_column_name_map=default_column_name_map)
-        if alt_query is None:
-            return None
-
-        group_by_interval_influx = influx_query_parsing.extract_time_interval_group_by(query)
+        group_by_interval_influx = influx_query_parsing.extract_time_interval_group_by(parsed_query)
         if group_by_interval_influx is None:
             logging.error('Could not extract group by time interval from query')
             return None
+
+        alt_parsed_query = influx_query_modification.remove_non_negative_derivative(parsed_query, None, forced_column_name_map=default_column_name_map)
+        if alt_parsed_query is None:
+            return None
+        alt_query = influx_query_parsing.stringify_sqlparsed(alt_parsed_query)
         group_by_interval_parts = influx_date_manipulation.split_influx_time(group_by_interval_influx)
         number_group_by_interval = group_by_interval_parts['number']
         unit_group_by_interval = group_by_interval_parts['unit']
         query_time_shift = str(2 * number_group_by_interval) + unit_group_by_interval
         alt_query = influx_query_modification.extend_lower_time_bound(alt_query, query_time_shift)
-        result_df_dict = pd_query(self.backend_host, self.backend_port, user, password, schema, alt_query)
+        backend_host, backend_port = self.get_backend(more)
+        result_df_dict = pd_query(backend_host, backend_port, user, password, schema, alt_query)
 
         # remove counter wrapping
         for series_name in result_df_dict:
@@ -2,14 +2,19 @@ import logging
 import importlib
 
 
-def import_rules(backend_host, backend_port, rule_names):
+def import_rules(backend_host, backend_port, rule_names, conf=None):
+    """
+    :param rule_names: names of modules of cleanflux.corrective_rules, each defining a RuleChecker (CorrectiveRule)
+    :param conf: settings of the guard passed to each rule, see CorrectiveRule
+    :return: dict of name -> rule, in the order of rule_names, which is their order of precedence
+    """
     rules = {}
     for rule_name in rule_names:
         try:
             rule_module = import_rule("cleanflux.corrective_rules.{}".format(rule_name))
-            rules[rule_name] = rule_module.RuleChecker(backend_host, backend_port)
+            rules[rule_name] = rule_module.RuleChecker(backend_host, backend_port, conf)
         except Exception as e:
-            logging.error("Could not load rule: %s. Error: %s", rule_name, e.message)
+            logging.error("Could not load rule: %s. Error: %s", rule_name, e)
     return rules
 
 
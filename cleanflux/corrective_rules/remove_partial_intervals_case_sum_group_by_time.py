@@ -4,7 +4,7 @@ import logging
 from datadog import statsd
 
 from cleanflux.utils.influx.querying import pd_query
-from cleanflux.corrective_rules.corrective_rule import CorrectiveRule
+from cleanflux.corrective_rules.corrective_rule import CorrectiveRule, RulePrefilter
 import cleanflux.utils.influx.query_sqlparsing as influx_query_parsing
 import cleanflux.utils.influx.query_modification as influx_query_modification
 import cleanflux.utils.influx.date_manipulation as influx_date_manipulation
@@ -12,6 +12,8 @@ import cleanflux.utils.influx.date_manipulation as influx_date_manipulation
 
 class RuleChecker(CorrectiveRule):
 
+    prefilter = RulePrefilter(functions=['sum'], group_by_time=True)
+
     @staticmethod
     def description():
         return "Removes start and end partial intervals case doing a SUM() along with a GROUP BY time()"
@@ -27,7 +29,8 @@ class RuleChecker(CorrectiveRule):
 
         query, group_by_interval = self.rework_query(query, parsed_query)
 
-        result_df_dict = pd_query(self.backend_host, self.backend_port, user, password, schema, query)
+        backend_host, backend_port = self.get_backend(more)
+        result_df_dict = pd_query(backend_host, backend_port, user, password, schema, query)
 
         result_df_dict = self.rework_data(result_df_dict, group_by_interval)
 
@@ -0,0 +1,78 @@
+import cleanflux.utils.influx.query_sqlparsing as influx_query_parsing
+
+
+# ------------------------------------------------------------------------
+# QUERY ANALYSIS
+
+class QueryAnalysis(object):
+    """
+    Properties of a query pre-filters of rules get evaluated against, extracted once per query
+    """
+
+    __slots__ = ('functions', 'group_by_time', 'schema', 'measurement')
+
+    def __init__(self, parsed_query, from_parts=None):
+        """
+        :param from_parts: measurement path the query selects from, None if unknown or several ones
+        """
+        self.functions = influx_query_parsing.extract_function_names_in_select(parsed_query)
+        self.group_by_time = influx_query_parsing.is_grouped_by_time(parsed_query)
+        self.schema = from_parts['schema'] if from_parts is not None else None
+        self.measurement = from_parts['measurement'] if from_parts is not None else None
+
+
+# ------------------------------------------------------------------------
+# PIPELINE
+
+class RulePipeline(object):
+    """
+    Rules compiled into a dispatch table on their pre-filters (see RulePrefilter), so that only the rules
+    a query may trigger get checked, in the order they got configured.
+    The table is built once, rules or their pre-filters changing afterwards are not taken into account.
+    """
+
+    __slots__ = ('rules', 'tables')
+
+    def __init__(self, rules):
+        """
+        :param rules: dict of name -> CorrectiveRule, in order of precedence
+        """
+        # (name, rule, pre-filter) in order of precedence
+        self.rules = tuple((name, rule, rule.get_prefilter()) for name, rule in rules.items())
+        # has GROUP BY time() -> (dict of function name -> indexes of rules, indexes of rules for any function)
+        self.tables = {is_grouped_by_time: self.compile_table(is_grouped_by_time)
+                       for is_grouped_by_time in (False, True)}
+
+    def compile_table(self, is_grouped_by_time):
+        by_function = {}
+        any_function = []
+        for i, (name, rule, prefilter) in enumerate(self.rules):
+            if prefilter.group_by_time and not is_grouped_by_time:
+                continue
+            if prefilter.functions is None:
+                any_function.append(i)
+                continue
+            for function in prefilter.functions:
+                by_function.setdefault(function, []).append(i)
+        return {function: tuple(indexes) for function, indexes in by_function.items()}, tuple(any_function)
+
+    def dispatch(self, analysis):
+        """
+        :type analysis: QueryAnalysis
+        :return: list of (name, rule) whose pre-filters the query meets, in order of precedence
+        """
+        by_function, any_function = self.tables[analysis.group_by_time]
+        indexes = set(any_function)
+        for function in analysis.functions:
+            indexes.update(by_function.get(function, ()))
+        if not indexes:
+            return []
+        candidates = []
+        for i in sorted(indexes):
+            name, rule, prefilter = self.rules[i]
+            if prefilter.match_measurement(analysis.schema, analysis.measurement):
+                candidates.append((name, rule))
+        return candidates
+
+    def get_state(self):
+        return {name: prefilter.get_state() for name, rule, prefilter in self.rules}
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import atexit
 import logging
 import logging.handlers
 import sys
@@ -11,7 +12,16 @@ from datadog.dogstatsd import statsd # global object
 
 from cleanflux.proxy import server
 from cleanflux.proxy import request_handler
+from cleanflux.proxy.connection_pool import ConnectionPool
+from cleanflux.proxy.write_coalescer import WriteCoalescer
+from cleanflux.proxy.admin_server import start_admin_server
+from cleanflux.proxy.admin_views import get_admin_views
+from cleanflux.proxy.admin_metrics import Counters
+from cleanflux.proxy.query_capture import QueryCapture
 from cleanflux.utils.influx.querying import robustify_influxdb_client
+from cleanflux.utils.influx.backend_pool import BackendPool, register_read_pool
+from cleanflux.utils.influx.query_stats import QueryStats
+from cleanflux.utils.profiling import SamplingProfiler
 
 
 def add_custom_print_exception():
@@ -95,11 +105,56 @@ class HttpDaemon(object):
             setattr(statsd, '_send_to_server', custom_send_to_server)
             setattr(statsd, '_send', custom_send_to_server)
 
+    def configure_read_pool(self):
+        if not self.config.read_backends:
+            return None
+        backends = [(backend['host'], backend.get('port', 8086)) for backend in self.config.read_backends]
+        pool = BackendPool(backends,
+                           health_check_interval=self.config.read_health_check_interval,
+                           hedging=self.config.read_hedging,
+                           hedging_percentile=self.config.read_hedging_percentile,
+                           hedging_min_delay_ms=self.config.read_hedging_min_delay_ms)
+        register_read_pool(self.config.backend_host, self.config.backend_port, pool)
+        logging.info("Reads are spread over: {}".format(', '.join(b.netloc for b in pool.backends)))
+        return pool
+
+    def configure_query_stats(self):
+        if not self.config.query_stats:
+            return None
+        return QueryStats(self.config.query_stats_capacity,
+                          flush_interval=self.config.query_stats_flush_interval,
+                          flush_top_n=self.config.query_stats_flush_top_n)
+
+    def configure_query_capture(self):
+        if not self.config.capture_dir:
+            return None
+        capture = QueryCapture(self.config.capture_dir,
+                               sample_rate=self.config.capture_sample_rate,
+                               max_file_bytes=self.config.capture_max_file_bytes,
+                               max_file_age=self.config.capture_max_file_age,
+                               max_files=self.config.capture_max_files)
+        # NB: complete the file being written on shutdown
+        atexit.register(capture.close)
+        logging.info("Capturing {:.0%} of queries into {}".format(self.config.capture_sample_rate,
+                                                                  self.config.capture_dir))
+        return capture
+
+    def configure_admin_server(self):
+        if not self.config.admin_port:
+            return None
+        self.handler_class.request_counters = Counters(('method', 'endpoint', 'code'))
+        profiler = None
+        if self.config.profiler:
+            profiler = SamplingProfiler(self.config.profiler_max_seconds)
+        views = get_admin_views(self.handler_class, self.cleanflux, profiler, self.config.profiler_rate)
+        return start_admin_server(self.config.admin_host, self.config.admin_port, views)
+
     def run(self):
         self.configure_logging()
         self.configure_statsd()
         # robustify_httplib_response_read()
         robustify_influxdb_client()
+        read_pool = self.configure_read_pool()
         self.show_startup_message()
 
         self.cleanflux.guard.enrich_rp_conf_from_db()
@@ -113,6 +168,43 @@ class HttpDaemon(object):
         self.handler_class.protocol_version = self.protocol
         self.handler_class.cleanflux = self.cleanflux
         self.handler_class.backend_address = backend_address
+        self.handler_class.read_pool = read_pool
+        self.handler_class.compression_enabled = self.config.compression
+        self.handler_class.compression_min_size = self.config.compression_min_size
+        self.handler_class.compression_level = self.config.compression_level
+        self.handler_class.tracing = self.config.tracing
+        self.handler_class.slow_request_threshold_ms = self.config.slow_request_threshold_ms
+        if self.config.write_fast_path:
+            self.handler_class.write_connection_pool = ConnectionPool(self.config.backend_host,
+                                                                      self.config.backend_port,
+                                                                      self.config.write_pool_max_idle,
+                                                                      max_idle_age=self.config.write_pool_max_idle_age)
+            self.handler_class.write_chunk_size = self.config.write_chunk_size
+            if self.config.write_coalescing:
+                self.handler_class.write_coalescer = WriteCoalescer(
+                    self.handler_class.write_connection_pool,
+                    self.config.write_coalescing_max_request_bytes,
+                    self.config.write_coalescing_max_bytes,
+                    self.config.write_coalescing_max_delay_ms,
+                    self.config.write_coalescing_max_pending_bytes)
+
+        shard_router = self.cleanflux.shard_router
+        if shard_router.is_active:
+            logging.info("Data is sharded over: {}".format(', '.join("{}:{}".format(*b) for b in shard_router.backends)))
+            self.handler_class.shard_router = shard_router
+            self.handler_class.shard_write_pools = {}
+            for backend_host, backend_port in shard_router.backends:
+                pool = None
+                if (backend_host, backend_port) == backend_address:
+                    pool = self.handler_class.write_connection_pool
+                if pool is None:
+                    pool = ConnectionPool(backend_host, backend_port, self.config.write_pool_max_idle,
+                                          max_idle_age=self.config.write_pool_max_idle_age)
+                self.handler_class.shard_write_pools[(backend_host, backend_port)] = pool
+
+        self.handler_class.query_stats = self.configure_query_stats()
+        self.handler_class.query_capture = self.configure_query_capture()
+        self.configure_admin_server()
 
         httpd = self.server_class(server_address, self.handler_class)
         self.serve_forever(httpd)
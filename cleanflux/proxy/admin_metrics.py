@@ -0,0 +1,87 @@
+import threading
+
+
+# ------------------------------------------------------------------------
+# COUNTERS
+
+class Counters(object):
+    """
+    Thread-safe counters, by tuple of label values
+    """
+
+    def __init__(self, label_names):
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def increment(self, key, value=1):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def get_samples(self):
+        """
+        :return: list of (labels, value)
+        """
+        with self.lock:
+            values = list(self.values.items())
+        return [(dict(zip(self.label_names, key)), value) for key, value in values]
+
+
+# ------------------------------------------------------------------------
+# PROMETHEUS TEXT FORMAT
+
+class Metric(object):
+    """
+    A metric family, i.e. a name and the samples for each of its label sets
+    """
+
+    __slots__ = ('name', 'type', 'help', 'samples')
+
+    def __init__(self, name, metric_type, help_text, samples=None):
+        """
+        :param metric_type: counter or gauge
+        :param samples: list of (labels dict, value)
+        """
+        self.name = name
+        self.type = metric_type
+        self.help = help_text
+        self.samples = samples if samples is not None else []
+
+    def add(self, value, **labels):
+        self.samples.append((labels, value))
+        return self
+
+
+def render_prometheus(metrics):
+    """
+    :param metrics: list of Metric
+    :return: metrics in Prometheus text exposition format
+    """
+    lines = []
+    for metric in metrics:
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+        for labels, value in metric.samples:
+            lines.append('{}{} {}'.format(metric.name, format_labels(labels), format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape_label_value(value))
+                          for name, value in sorted(labels.items())) + '}'
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,66 @@
+import json
+import logging
+import threading
+import urllib.parse
+import http.client
+from http.server import BaseHTTPRequestHandler
+
+from cleanflux.proxy.server import ThreadingHTTPServer
+
+
+# ------------------------------------------------------------------------
+# HANDLER
+
+class AdminRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the introspection views of the proxy, on a port of its own
+    """
+
+    # path -> function taking the dict of query parameters and returning a JSON-serializable object,
+    # or a str sent as plain text (e.g. Prometheus metrics)
+    views = {}
+
+    def do_GET(self):
+        url_parts = urllib.parse.urlsplit(self.path)
+        view = self.views.get(url_parts.path.rstrip('/'))
+        if view is None:
+            self._send(http.client.NOT_FOUND, 'text/plain', b'Available views: ' + ', '.join(sorted(self.views)).encode())
+            return
+        params = {key: values[0] for key, values in urllib.parse.parse_qs(url_parts.query).items()}
+        try:
+            result = view(params)
+        except Exception as e:
+            logging.error("Could not render admin view {}: {}".format(url_parts.path, e))
+            self._send(http.client.INTERNAL_SERVER_ERROR, 'text/plain', str(e).encode())
+            return
+        if isinstance(result, str):
+            self._send(http.client.OK, 'text/plain; version=0.0.4; charset=utf-8', result.encode())
+        else:
+            self._send(http.client.OK, 'application/json', json.dumps(result, indent=2, default=str).encode())
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, log_format, *args):
+        logging.debug("admin: " + log_format % args)
+
+
+# ------------------------------------------------------------------------
+# SERVER
+
+def start_admin_server(host, port, views):
+    """
+    Serve the admin views in a background thread
+    :param views: dict of path -> view, see AdminRequestHandler
+    """
+    handler_class = type('BoundAdminRequestHandler', (AdminRequestHandler,), {'views': views})
+    httpd = ThreadingHTTPServer((host, port), handler_class)
+    thread = threading.Thread(target=httpd.serve_forever, name='admin-server')
+    thread.daemon = True
+    thread.start()
+    logging.info("Serving admin views on {}:{}...".format(host, port))
+    return httpd
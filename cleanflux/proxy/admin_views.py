@@ -0,0 +1,133 @@
+from cleanflux.proxy.admin_metrics import Metric, render_prometheus
+
+
+# ------------------------------------------------------------------------
+# VIEWS
+
+def get_admin_views(handler_class, cleanflux, profiler=None, profiler_rate=100):
+    """
+    :param handler_class: ProxyRequestHandler, once configured by the daemon
+    :type cleanflux: Cleanflux
+    :param profiler: SamplingProfiler, None to disable profiling
+    :param profiler_rate: default nb of samples per second
+    :return: dict of path -> view, see AdminRequestHandler
+    """
+    guard = cleanflux.guard
+    views = {
+        '/metrics': lambda params: render_prometheus(collect_metrics(handler_class, cleanflux)),
+        '/debug/pools': lambda params: get_pools_state(handler_class),
+        '/debug/coalescer': lambda params: handler_class.write_coalescer.get_state()
+        if handler_class.write_coalescer is not None else None,
+        '/debug/rps': lambda params: guard.retention_policies,
+        '/debug/rollups': lambda params: guard.rollup_catalog.get_state(),
+        '/debug/shards': lambda params: cleanflux.shard_router.get_state(),
+        '/debug/rules': lambda params: guard.get_state(),
+    }
+    query_stats = handler_class.query_stats
+    if query_stats is not None:
+        views['/debug/queries'] = lambda params: {
+            'state': query_stats.get_state(),
+            'top': query_stats.get_top(int(params.get('n', 50)), params.get('sort', 'count')),
+        }
+    if handler_class.query_capture is not None:
+        views['/debug/capture'] = lambda params: handler_class.query_capture.get_state()
+    if profiler is not None:
+        views['/debug/profile'] = lambda params: profiler.profile(
+            float(params.get('seconds', 10)), float(params.get('rate', profiler_rate)),
+            params.get('all_threads', '0').lower() in ('1', 'true'))
+    return views
+
+
+def get_pools_state(handler_class):
+    write_pools = {}
+    if handler_class.shard_write_pools is not None:
+        write_pools = {"{}:{}".format(*backend): pool.get_state()
+                       for backend, pool in handler_class.shard_write_pools.items()}
+    elif handler_class.write_connection_pool is not None:
+        pool = handler_class.write_connection_pool
+        write_pools = {"{}:{}".format(pool.host, pool.port): pool.get_state()}
+    return {
+        'read': handler_class.read_pool.get_state() if handler_class.read_pool is not None else None,
+        'write': write_pools,
+    }
+
+
+# ------------------------------------------------------------------------
+# METRICS
+
+def collect_metrics(handler_class, cleanflux):
+    """
+    :return: list of Metric
+    NB: only reads counters & sizes kept up to date by the proxy, so that scraping stays cheap
+    """
+    metrics = []
+
+    if handler_class.request_counters is not None:
+        metrics.append(Metric('cleanflux_requests_total', 'counter', 'Requests handled, by method, endpoint & status',
+                              handler_class.request_counters.get_samples()))
+
+    rules = Metric('cleanflux_rule_fires_total', 'counter', 'Queries reworked, by rule / rewrite')
+    for name, nb_fires in sorted(cleanflux.guard.get_fire_counts().items()):
+        rules.add(nb_fires, rule=name)
+    metrics.append(rules)
+
+    if handler_class.read_pool is not None:
+        state = handler_class.read_pool.get_state()
+        up = Metric('cleanflux_read_backend_up', 'gauge', 'Whether a read replica is considered healthy')
+        outstanding = Metric('cleanflux_read_backend_outstanding', 'gauge', 'Requests in flight to a read replica')
+        for backend in state['backends']:
+            up.add(backend['healthy'], backend=backend['netloc'])
+            outstanding.add(backend['outstanding'], backend=backend['netloc'])
+        metrics.extend([
+            up, outstanding,
+            Metric('cleanflux_read_hedged_total', 'counter', 'Hedged read requests').add(state['nb_hedged']),
+            Metric('cleanflux_read_hedges_won_total', 'counter', 'Hedged read requests answered by the hedge first')
+            .add(state['nb_hedges_won']),
+            Metric('cleanflux_read_failovers_total', 'counter', 'Read requests retried on another replica')
+            .add(state['nb_failovers']),
+        ])
+
+    write_pools = get_pools_state(handler_class)['write']
+    if write_pools:
+        idle = Metric('cleanflux_write_pool_idle_connections', 'gauge', 'Idle keep-alive connections to a backend')
+        active = Metric('cleanflux_write_pool_active_connections', 'gauge', 'Connections to a backend in use')
+        for netloc, state in sorted(write_pools.items()):
+            idle.add(state['idle'], backend=netloc)
+            active.add(state['active'], backend=netloc)
+        metrics.extend([idle, active])
+
+    if handler_class.write_coalescer is not None:
+        state = handler_class.write_coalescer.get_state()
+        metrics.extend([
+            Metric('cleanflux_write_coalescer_batches', 'gauge', 'Write batches being filled')
+            .add(state['nb_batches']),
+            Metric('cleanflux_write_coalescer_pending_bytes', 'gauge', 'Bytes of writes waiting to be flushed')
+            .add(state['pending_bytes']),
+            Metric('cleanflux_write_coalescer_flushes_total', 'counter', 'Write batches flushed')
+            .add(state['nb_flushes']),
+            Metric('cleanflux_write_coalescer_rejected_total', 'counter', 'Writes rejected for lack of room')
+            .add(state['nb_rejected']),
+        ])
+
+    if handler_class.query_stats is not None:
+        state = handler_class.query_stats.get_state()
+        metrics.extend([
+            Metric('cleanflux_query_fingerprints', 'gauge', 'Query fingerprints tracked')
+            .add(state['nb_fingerprints']),
+            Metric('cleanflux_query_fingerprint_evictions_total', 'counter', 'Query fingerprints evicted')
+            .add(state['nb_evictions']),
+        ])
+
+    if handler_class.query_capture is not None:
+        state = handler_class.query_capture.get_state()
+        metrics.extend([
+            Metric('cleanflux_query_capture_records_total', 'counter', 'Query requests written to capture files')
+            .add(state['nb_captured']),
+            Metric('cleanflux_query_capture_dropped_total', 'counter', 'Query requests not captured, queue being full')
+            .add(state['nb_dropped']),
+        ])
+
+    metrics.append(Metric('cleanflux_retention_policies', 'gauge', 'Retention policies known, by schema',
+                          [({'schema': schema}, len(rps))
+                           for schema, rps in sorted(cleanflux.guard.retention_policies.items())]))
+    return metrics
@@ -0,0 +1,39 @@
+class ChunkedWriter(object):
+    """
+    Writes a response body using HTTP/1.1 chunked transfer encoding
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        # NB: body bytes, framing excluded
+        self.nb_bytes = 0
+
+    def write(self, data):
+        # NB: an empty chunk would mean end of body
+        if not data:
+            return
+        # NB: frame written at once, wfile being unbuffered and Nagle's algorithm disabled
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.nb_bytes += len(data)
+
+    def close(self):
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+
+class PlainWriter(object):
+    """
+    Writes a response body as is, for when its length is known or connection gets closed afterwards
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.nb_bytes = 0
+
+    def write(self, data):
+        if data:
+            self.wfile.write(data)
+            self.nb_bytes += len(data)
+
+    def close(self):
+        self.wfile.flush()
@@ -0,0 +1,94 @@
+import zlib
+
+
+# NB: HTTP 'deflate' is actually the zlib format (RFC 1950), not raw deflate
+encoding_wbits = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'x-gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+# by order of preference, when client has no preference
+supported_encodings = ('gzip', 'deflate')
+
+
+def parse_accept_encoding(accept_encoding):
+    """
+    Parse an Accept-Encoding header
+    :return: dict of encoding -> q-value
+    """
+    accepted = {}
+    if not accept_encoding:
+        return accepted
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Select the content encoding to use for a response
+    :param accept_encoding: value of the Accept-Encoding request header
+    :return: a supported encoding, or None for identity
+    """
+    accepted = parse_accept_encoding(accept_encoding)
+    best_encoding = None
+    best_q = 0.0
+    for encoding in supported_encodings:
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        if q > best_q:
+            best_encoding = encoding
+            best_q = q
+    return best_encoding
+
+
+def is_encoding_accepted(accept_encoding, encoding):
+    accepted = parse_accept_encoding(accept_encoding)
+    encoding = encoding.lower()
+    if encoding == 'identity':
+        return True
+    return accepted.get(encoding, accepted.get('*', 0.0)) > 0
+
+
+class StreamCompressor(object):
+    """
+    Incremental compressor for a Content-Encoding
+    """
+
+    def __init__(self, encoding, level=6):
+        self.encoding = encoding
+        self.compressobj = zlib.compressobj(level, zlib.DEFLATED, encoding_wbits[encoding])
+
+    def compress(self, data):
+        return self.compressobj.compress(data)
+
+    def flush(self):
+        return self.compressobj.flush()
+
+
+def encode_content_body(data, encoding, level=6):
+    if encoding == 'identity':
+        return data
+    if encoding not in encoding_wbits:
+        raise Exception("Unknown Content-Encoding: %s" % encoding)
+    compressor = StreamCompressor(encoding, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decode_content_body(data, encoding):
+    if encoding == 'identity':
+        return data
+    if encoding not in encoding_wbits:
+        raise Exception("Unknown Content-Encoding: %s" % encoding)
+    return zlib.decompress(data, encoding_wbits[encoding])
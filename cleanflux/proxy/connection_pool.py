@@ -0,0 +1,81 @@
+from http.client import HTTPConnection
+import select
+import threading
+import time
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of keep-alive connections towards a single backend
+    """
+
+    def __init__(self, host, port, max_idle=16, timeout=45, max_idle_age=30):
+        """
+        :param max_idle_age: in seconds, idle connections older than this get closed rather than reused,
+                             as backends or load balancers in between may have dropped them
+        """
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.max_idle_age = max_idle_age
+        self.lock = threading.Lock()
+        # (connection, time it got released)
+        self.idle_conns = []
+        self.nb_active = 0
+        self.nb_stale = 0
+
+    def acquire(self, fresh=False):
+        """
+        Get an idle connection, or open a new one if none is available
+        :param fresh: True to open a new connection whatever the idle ones, e.g. to retry on a stale one
+        :rtype: HTTPConnection
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.nb_active += 1
+            while self.idle_conns and not fresh:
+                conn, released_at = self.idle_conns.pop()
+                if now - released_at <= self.max_idle_age and not is_closed(conn):
+                    return conn
+                self.nb_stale += 1
+                conn.close()
+        return HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def release(self, conn):
+        """
+        Give back a connection whose response has been fully read
+        """
+        with self.lock:
+            self.nb_active -= 1
+            if len(self.idle_conns) < self.max_idle:
+                self.idle_conns.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def discard(self, conn):
+        """
+        Drop a connection that is in an unknown state
+        """
+        with self.lock:
+            self.nb_active -= 1
+        conn.close()
+
+    def get_state(self):
+        with self.lock:
+            return {'host': self.host, 'port': self.port,
+                    'idle': len(self.idle_conns), 'active': self.nb_active, 'stale': self.nb_stale}
+
+
+def is_closed(conn):
+    """
+    :return: True if the peer closed an idle connection (or sent unexpected data on it), which can't be reused then
+    NB: an idle keep-alive socket is never readable, unless at EOF
+    """
+    if conn.sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
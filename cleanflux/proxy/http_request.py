@@ -2,6 +2,43 @@ from http.client import HTTPSConnection, HTTPConnection, IncompleteRead
 import urllib.parse
 import threading
 
+from cleanflux.proxy.connection_pool import ConnectionPool
+
+
+# ------------------------------------------------------------------------
+# GLOBALS
+
+# methods whose requests can be sent again after a failure
+idempotent_methods = ('GET', 'HEAD')
+
+# keep-alive connections of the requests sent through a BackendPool, by backend netloc, see HTTPRequest.release()
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool(backend, timeout):
+    """
+    :type backend: Backend
+    :rtype: ConnectionPool
+    """
+    with connection_pools_lock:
+        pool = connection_pools.get(backend.netloc)
+        if pool is None:
+            pool = connection_pools[backend.netloc] = ConnectionPool(backend.host, backend.port, timeout=timeout)
+        return pool
+
+
+def is_replayable(method, exception):
+    """
+    :return: whether a request that failed w/ exception can be sent again, i.e. it is idempotent and most likely
+             never got processed by the backend (connection refused, or kept-alive one closed by the backend)
+    NB: a timeout is not, backend possibly still processing the request
+    """
+    return method in idempotent_methods and isinstance(exception, ConnectionError)
+
+
+# ------------------------------------------------------------------------
+# REQUESTS
 
 class HTTPRequest(object):
     """
@@ -10,32 +47,115 @@ class HTTPRequest(object):
 
     def __init__(self):
         self.tls = threading.local()
-        self.tls.conns = {}
 
-    def request(self, url, body=None, headers=None, timeout=45, max_retries=3, method="GET"):
+    def request(self, url, body=None, headers=None, timeout=45, max_retries=3, method="GET", pool=None):
+        """
+        :param pool: if set, BackendPool the request gets sent to (w/ failover & hedging), instead of url's netloc.
+                     Response must then be given back w/ release() once read.
+        """
         if headers is None:
             headers = dict()
 
         parsed = urllib.parse.urlsplit(url)
-        origin = (parsed.scheme, parsed.netloc)
 
-        for i in range(1, max_retries):
+        if pool is not None:
+            def request_backend(backend):
+                return self.request_pooled(parsed._replace(netloc=backend.netloc), body, headers, timeout, method,
+                                           backend)
+
+            def discard_response(backend, response):
+                self.release(response)
+            return pool.execute(request_backend, discard_response)
+
+        for i in range(1, max_retries + 1):
+            try:
+                return self.request_once(parsed, body, headers, timeout, method)
+            except Exception as e:
+                if i >= max_retries or not is_replayable(method, e):
+                    raise e
+
+    def request_once(self, parsed, body, headers, timeout, method):
+        origin = (parsed.scheme, parsed.netloc)
+        for is_retry in (False, True):
+            # NB: a kept-alive connection might have been closed by the backend in the meantime
+            is_reused = origin in self.get_conns()
             try:
                 conn = self.create_conn(parsed, origin, timeout)
-                conn.request(method, url, body=body, headers=headers)
+                conn.request(method, urllib.parse.urlunsplit(parsed), body=body, headers=headers)
                 return conn.getresponse()
             except IncompleteRead as e:
                 return e.partial
             except Exception as e:
-                if origin in self.tls.conns:
-                    del self.tls.conns[origin]
-                if i >= max_retries:
-                    raise e
+                conns = self.get_conns()
+                if origin in conns:
+                    del conns[origin]
+                if is_reused and not is_retry and is_replayable(method, e):
+                    continue
+                raise
+
+    def request_pooled(self, parsed, body, headers, timeout, method, backend):
+        """
+        Run a request of a BackendPool, in one of its worker threads while the response gets read by the caller:
+        connection is taken out of a shared pool rather than the thread-local ones, and only given back once
+        the response has been read to the end, see release()
+        :type backend: Backend
+        """
+        connection_pool = None
+        if parsed.scheme == 'https':
+            conn = HTTPSConnection(parsed.netloc, timeout=timeout)
+        else:
+            connection_pool = get_connection_pool(backend, timeout)
+            conn = connection_pool.acquire()
+        for is_retry in (False, True):
+            try:
+                conn.request(method, urllib.parse.urlunsplit(parsed), body=body, headers=headers)
+                response = conn.getresponse()
+            except Exception as e:
+                if connection_pool is None:
+                    conn.close()
+                    raise
+                connection_pool.discard(conn)
+                if is_retry or not is_replayable(method, e):
+                    raise
+                conn = connection_pool.acquire(fresh=True)
+                continue
+            # NB: kept along w/ the response until it gets released
+            response.connection_pool = connection_pool
+            response.pooled_conn = conn
+            return response
+
+    @staticmethod
+    def release(response):
+        """
+        Give the connection of a response got through a BackendPool back to its pool if the response has been read
+        to the end, close it otherwise
+        :type response: HTTPResponse
+        """
+        conn = getattr(response, 'pooled_conn', None)
+        if conn is None:
+            return
+        response.pooled_conn = None
+        connection_pool = response.connection_pool
+        if connection_pool is not None and response.isclosed() and not response.will_close:
+            connection_pool.release(conn)
+            return
+        response.close()
+        if connection_pool is not None:
+            connection_pool.discard(conn)
+        else:
+            conn.close()
+
+    def get_conns(self):
+        # NB: thread-local storage has to be initialized in each thread using it
+        if not hasattr(self.tls, 'conns'):
+            self.tls.conns = {}
+        return self.tls.conns
 
     def create_conn(self, parsed, origin, timeout):
-        if origin not in self.tls.conns:
+        conns = self.get_conns()
+        if origin not in conns:
             if parsed.scheme == 'https':
-                self.tls.conns[origin] = HTTPSConnection(parsed.netloc, timeout=timeout)
+                conns[origin] = HTTPSConnection(parsed.netloc, timeout=timeout)
             else:
-                self.tls.conns[origin] = HTTPConnection(parsed.netloc, timeout=timeout)
-        return self.tls.conns[origin]
+                conns[origin] = HTTPConnection(parsed.netloc, timeout=timeout)
+        return conns[origin]
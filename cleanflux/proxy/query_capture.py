@@ -0,0 +1,212 @@
+import glob
+import gzip
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+
+# ------------------------------------------------------------------------
+# GLOBALS
+
+capture_file_prefix = 'queries-'
+capture_file_suffix = '.jsonl.gz'
+# NB: files being written are renamed once complete, so that readers only see complete files
+partial_file_suffix = '.part'
+
+
+# ------------------------------------------------------------------------
+# CAPTURE
+
+class QueryCapture(object):
+    """
+    Capture of /query requests, for later replay (see cleanflux.replay).
+
+    Requests are handed to a writer thread through a bounded queue, so that request handlers never wait on disk:
+    when the queue is full, requests are dropped (and counted as such).
+    Records get written as JSON lines in gzip files, rotated by size & age, only the most recent ones being kept.
+    """
+
+    def __init__(self, directory, sample_rate=1.0, max_file_bytes=64 * 1024 * 1024, max_file_age=300,
+                 max_files=10, max_queue_size=10000):
+        """
+        :param directory: where capture files get written, created if missing
+        :param sample_rate: ratio of requests captured, 1.0 to capture all of them
+        :param max_file_bytes: size (uncompressed) at which a file gets rotated
+        :param max_file_age: in seconds, age at which a file gets rotated
+        :param max_files: nb of complete files kept, oldest ones being deleted
+        :param max_queue_size: nb of records waiting to be written before dropping new ones
+        """
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_file_bytes = max_file_bytes
+        self.max_file_age = max_file_age
+        self.max_files = max_files
+        self.queue = queue.Queue(max_queue_size)
+
+        self.nb_captured = 0
+        self.nb_dropped = 0
+        self.nb_files = 0
+
+        self.file = None
+        self.file_path = None
+        self.file_bytes = 0
+        self.file_opened_at = None
+        self.is_closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        self.writer = threading.Thread(target=self._run_writer, name='query-capture')
+        self.writer.daemon = True
+        self.writer.start()
+
+    # --------------------------------------------------------------------
+    # PUBLIC
+
+    def capture(self, method, path, context, start, duration_ms, nb_bytes, reworked):
+        """
+        :param path: endpoint, e.g. /query
+        :type context: RequestContext
+        :param start: wall-clock time (epoch in seconds) at which the request got received
+        :param duration_ms: time to answer the request
+        :param nb_bytes: nb of bytes of body sent back
+        :param reworked: whether the response came from the corrective pipeline rather than the backend
+        NB: credentials (u & p params) are never captured
+        """
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        params = context.params
+        record = {
+            'ts': round(start, 6),
+            'method': method,
+            'path': path,
+            'db': context.schema,
+            'rp': params['rp'][0] if params.get('rp') else None,
+            'epoch': context.precision,
+            'q': ';'.join(params.get('q', [])),
+            'duration_ms': round(duration_ms, 3),
+            'nb_bytes': nb_bytes,
+            'reworked': reworked,
+        }
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.nb_dropped += 1
+
+    def close(self, timeout=10):
+        """
+        Write pending records and complete the current file
+        """
+        if self.is_closed:
+            return
+        self.is_closed = True
+        self.queue.put(None)
+        self.writer.join(timeout)
+
+    def get_state(self):
+        return {
+            'directory': self.directory,
+            'sample_rate': self.sample_rate,
+            'nb_captured': self.nb_captured,
+            'nb_dropped': self.nb_dropped,
+            'nb_pending': self.queue.qsize(),
+            'nb_files': self.nb_files,
+            'current_file': self.file_path,
+        }
+
+    # --------------------------------------------------------------------
+    # WRITER
+
+    def _run_writer(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=1)
+            except queue.Empty:
+                record = False
+            if record is None:
+                self._close_file()
+                return
+            try:
+                if record:
+                    self._write(record)
+                if self.file is not None and time.monotonic() - self.file_opened_at >= self.max_file_age:
+                    self._close_file()
+            except Exception as e:
+                logging.error("Query capture failed: {}".format(e))
+                self._close_file()
+
+    def _write(self, record):
+        if self.file is None:
+            self._open_file()
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode()
+        self.file.write(line)
+        self.file_bytes += len(line)
+        self.nb_captured += 1
+        if self.file_bytes >= self.max_file_bytes:
+            self._close_file()
+
+    def _open_file(self):
+        name = '{}{}-{:06d}{}'.format(capture_file_prefix, time.strftime('%Y%m%dT%H%M%S'), self.nb_files,
+                                      capture_file_suffix)
+        self.file_path = os.path.join(self.directory, name)
+        self.file = gzip.open(self.file_path + partial_file_suffix, 'wb')
+        self.file_bytes = 0
+        self.file_opened_at = time.monotonic()
+        self.nb_files += 1
+
+    def _close_file(self):
+        if self.file is None:
+            return
+        try:
+            self.file.close()
+            os.rename(self.file_path + partial_file_suffix, self.file_path)
+        except (IOError, OSError) as e:
+            logging.error("Could not complete query capture file {}: {}".format(self.file_path, e))
+        self.file = None
+        self.file_path = None
+        self._remove_old_files()
+
+    def _remove_old_files(self):
+        paths = sorted(glob.glob(os.path.join(self.directory, capture_file_prefix + '*' + capture_file_suffix)))
+        for path in paths[:max(len(paths) - self.max_files, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# ------------------------------------------------------------------------
+# READING
+
+def get_capture_files(paths):
+    """
+    :param paths: capture files and / or directories of capture files
+    :return: capture files, oldest first
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, capture_file_prefix + '*' + capture_file_suffix))))
+        else:
+            files.append(path)
+    return files
+
+
+def iter_capture_records(paths):
+    """
+    :param paths: capture files and / or directories of capture files
+    :return: iterator of records, in the order they got captured
+    NB: a truncated file (e.g. daemon killed) is read up to its last complete record
+    """
+    for path in get_capture_files(paths):
+        with gzip.open(path, 'rt') as f:
+            try:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        break
+            except (EOFError, OSError) as e:
+                logging.warning("Capture file {} is truncated: {}".format(path, e))
@@ -0,0 +1,97 @@
+import urllib.parse
+
+from cleanflux.utils.influx.query_sqlparsing import split_statements
+
+
+# URL parameter & header hinting the max nb of points per series to return
+max_nb_points_param = 'max_data_points'
+max_nb_points_header = 'X-Cleanflux-Max-Data-Points'
+
+
+class RequestContext(object):
+    """
+    Parameters of a /query request, parsed once and shared by the whole corrective pipeline
+    """
+
+    __slots__ = ('user', 'password', 'schema', 'queries', 'precision', 'chunked', 'chunk_size', 'params',
+                 'max_nb_points', 'backends', 'backend', 'fanouts', 'fanout_backends', 'downsampled', 'error')
+
+    def __init__(self, user=None, password=None, schema=None, queries=None, precision=None,
+                 chunked=False, chunk_size=None, params=None, max_nb_points=None):
+        self.user = user
+        self.password = password
+        self.schema = schema
+        self.queries = queries if queries is not None else []
+        self.precision = precision
+        self.chunked = chunked
+        self.chunk_size = chunk_size
+        self.params = params if params is not None else {}
+        # max nb of points per series the client can render (e.g. Grafana's maxDataPoints), if hinted
+        self.max_nb_points = max_nb_points
+        # (host, port) each statement got routed to, and the one the whole request gets relayed to
+        self.backends = {}
+        self.backend = None
+        # backends each SHOW statement on a schema split by measurement has to be sent to, and the ones the whole
+        # request gets sent to, their results being merged (see merge_query_results())
+        self.fanouts = {}
+        self.fanout_backends = None
+        # whether a raw query got aggregated
+        self.downsampled = False
+        # why the request can't be answered, if so
+        self.error = None
+
+    @classmethod
+    def from_params(cls, parsed_params):
+        """
+        Build context from already decoded parameters
+        :param parsed_params: dict of parameter name -> list of values
+        """
+        queries = []
+        for q in parsed_params.get('q', []):
+            queries.extend(split_statements(q))
+
+        chunk_size = parse_positive_int(get_first_param_value(parsed_params, 'chunk_size'))
+
+        return cls(user=get_first_param_value(parsed_params, 'u'),
+                   password=get_first_param_value(parsed_params, 'p'),
+                   schema=get_first_param_value(parsed_params, 'db'),
+                   queries=queries,
+                   precision=get_first_param_value(parsed_params, 'epoch'),
+                   chunked=get_first_param_value(parsed_params, 'chunked') == 'true',
+                   chunk_size=chunk_size,
+                   params=parsed_params,
+                   max_nb_points=parse_positive_int(get_first_param_value(parsed_params, max_nb_points_param)))
+
+    @classmethod
+    def from_url_parameters(cls, parameters):
+        """
+        Build context from an URL parameter string
+        :param parameters: The url parameter list
+        """
+        return cls.from_params(urllib.parse.parse_qs(parameters))
+
+    def __repr__(self):
+        return "RequestContext(user={!r}, schema={!r}, queries={!r}, precision={!r})".format(
+            self.user, self.schema, self.queries, self.precision)
+
+
+def get_first_param_value(parsed_params, name):
+    values = parsed_params.get(name)
+    if not values:
+        return None
+    return values[0]
+
+
+def parse_positive_int(value):
+    """
+    :return: value as an int, None if missing or invalid
+    """
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        return None
+    if value <= 0:
+        return None
+    return value
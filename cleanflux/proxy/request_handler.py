@@ -1,24 +1,109 @@
 import os
+import json
 import socket
 import ssl
 import select
 import urllib.parse
 import threading
-import gzip
-import zlib
 import time
 import logging
 import http.client
+from functools import wraps
 from http.server import BaseHTTPRequestHandler
-from io import StringIO
 from subprocess import Popen, PIPE
 
 from cleanflux.proxy.http_request import HTTPRequest
+from cleanflux.proxy.request_context import RequestContext, get_first_param_value, parse_positive_int, \
+    max_nb_points_header
+from cleanflux.proxy.compression import negotiate_encoding, StreamCompressor, decode_content_body
+from cleanflux.proxy.chunked_writer import ChunkedWriter, PlainWriter
+from cleanflux.utils.influx.result_encoding import get_result_encoder
+from cleanflux.utils.influx.shard_routing import merge_query_results
+from cleanflux.utils.influx.query_stats import get_nb_rows
+from cleanflux.utils.tracing import start_trace, end_trace, get_trace, stage, is_forced
+
+
+# ------------------------------------------------------------------------
+# FORM BODY PARSING
+
+def decode_form_pair(pair):
+    """
+    Decode a single `key=value` pair of an application/x-www-form-urlencoded body
+    :param pair: raw pair (bytes)
+    """
+    key, _, value = pair.partition(b'=')
+    key = urllib.parse.unquote_to_bytes(key.replace(b'+', b' ')).decode('utf-8', 'replace')
+    value = urllib.parse.unquote_to_bytes(value.replace(b'+', b' ')).decode('utf-8', 'replace')
+    return key, value
+
+
+def iter_form_params(chunks):
+    """
+    Incrementally decode an application/x-www-form-urlencoded body.
+    Each pair gets decoded exactly once, as soon as its terminating '&' has been received.
+    :param chunks: iterable of raw body chunks (bytes)
+    :return: generator of (key, value) pairs
+    """
+    pending = []
+    for chunk in chunks:
+        start = 0
+        sep = chunk.find(b'&')
+        while sep != -1:
+            pending.append(chunk[start:sep])
+            pair = b''.join(pending)
+            pending = []
+            if pair:
+                yield decode_form_pair(pair)
+            start = sep + 1
+            sep = chunk.find(b'&', start)
+        if start < len(chunk):
+            pending.append(chunk[start:])
+    pair = b''.join(pending)
+    if pair:
+        yield decode_form_pair(pair)
+
+
+# ------------------------------------------------------------------------
+# TRACING
+
+def traced_request(method):
+    """
+    Decorator tracing the stages of a request, when tracing is enabled or forced (e.g. by the profiler)
+    """
+    @wraps(method)
+    def wrapper(self):
+        if not self.tracing and not is_forced():
+            return method(self)
+        start_trace()
+        try:
+            return method(self)
+        finally:
+            trace = end_trace()
+            if self.tracing:
+                self._log_if_slow(trace)
+    return wrapper
 
 
 class ProxyRequestHandler(BaseHTTPRequestHandler):
     cleanflux = None
     backend_address = None
+    read_pool = None
+    write_connection_pool = None
+    write_coalescer = None
+    # routing of schemas / measurements to backends, w/ a write connection pool per backend
+    shard_router = None
+    shard_write_pools = None
+    # top-N query fingerprints, see QueryStats
+    query_stats = None
+    # nb of requests by (method, endpoint, status), see Counters
+    request_counters = None
+    counted_endpoints = ('/query', '/write', '/ping')
+    # capture of /query requests for replay, see QueryCapture
+    query_capture = None
+
+    # Per-request stage timings, sent as a Server-Timing header & logged for slow requests
+    tracing = False
+    slow_request_threshold_ms = None
 
     cakey = 'ca.key'
     cacert = 'ca.crt'
@@ -27,6 +112,27 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
 
     # Request timeout
     timeout = 60
+    # NB: headers & body get written separately, which must not wait for the delayed ACK of the client
+    disable_nagle_algorithm = True
+    # Size of the chunks read from the client when parsing a request body
+    body_chunk_size = 64 * 1024
+    # Size of the chunks relayed on the /write fast path
+    write_chunk_size = 64 * 1024
+    # Size of the chunks read from backend responses
+    response_chunk_size = 64 * 1024
+    # Size from which response body pieces get written to clients, smaller ones being coalesced
+    response_write_size = 64 * 1024
+
+    # Response compression, negotiated w/ clients via Accept-Encoding
+    compression_enabled = True
+    compression_min_size = 1024
+    compression_level = 6
+
+    # http://tools.ietf.org/html/rfc2616#section-13.5.1
+    hop_by_hop_headers = (
+        'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers',
+        'transfer-encoding', 'upgrade'
+    )
     lock = threading.Lock()
 
     def __init__(self, *args, **kwargs):
@@ -46,6 +152,14 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
 
         BaseHTTPRequestHandler.__init__(self, *args, **kwargs)
 
+    def log_request(self, code='-', size='-'):
+        if self.request_counters is not None:
+            endpoint = urllib.parse.urlsplit(self.path).path.rstrip('/')
+            if endpoint not in self.counted_endpoints:
+                endpoint = 'other'
+            self.request_counters.increment((self.command, endpoint, str(int(code))))
+        BaseHTTPRequestHandler.log_request(self, code, size)
+
     def log_error(self, log_format, *args):
         # Suppress "Request timed out: timeout('timed out',)"
         if isinstance(args[0], socket.timeout):
@@ -114,153 +228,564 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
         """
         return self.cleanflux.check(query_string)
 
-    def _get_alt_data(self, user, password, schema, queries, precision):
+    def _get_alt_data(self, context):
         """
         eventually get alternative data for queries
+        :type context: RequestContext
         """
-        return self.cleanflux.get_alt_data(user, password, schema, queries, precision)
+        max_nb_points = parse_positive_int(self.headers.get(max_nb_points_header))
+        if max_nb_points is not None:
+            context.max_nb_points = max_nb_points
+        return self.cleanflux.get_alt_data(context)
+
+    @staticmethod
+    def is_query_endpoint(url):
+        return urllib.parse.urlsplit(url).path.rstrip('/') == '/query'
+
+    @staticmethod
+    def is_write_endpoint(url):
+        return urllib.parse.urlsplit(url).path.rstrip('/') == '/write'
 
     @staticmethod
-    def get_queries(parameters):
+    def is_form_encoded(headers):
+        content_type = headers.get('Content-Type', '')
+        return content_type.split(';')[0].strip().lower() == 'application/x-www-form-urlencoded'
+
+    @staticmethod
+    def _analyze_url(path):
+        url_parts = urllib.parse.urlsplit(path)
+        parameters = url_parts.query if url_parts.query else url_parts.path
+        scheme, netloc, path = url_parts.scheme, url_parts.netloc, (url_parts.path + '?' + parameters)
+        assert scheme in ('http', 'https')
+        return scheme, netloc, path, parameters
+
+    @traced_request
+    def do_GET(self):
+        self.path = self._build_url(self.path, self.headers['Host'])
+        scheme, netloc, path, parameters = self._analyze_url(self.path)
+
+        start = time.monotonic()
+        context = RequestContext.from_url_parameters(parameters)
+        alt_data = self._get_alt_data(context)
+
+        if context.error is not None:
+            self.send_error(http.client.BAD_REQUEST, context.error)
+            return
+        if alt_data is not None:
+            backend_time = time.monotonic() - start
+            nb_bytes = self._send_alt_data(context, alt_data)
+        elif context.fanout_backends is not None:
+            self.filter_headers(self.headers)
+            nb_bytes = self._fan_out_request(scheme, path, self.headers, context.fanout_backends)
+            backend_time = time.monotonic() - start
+        else:
+            # TODO: Is this needed?
+            # self.headers['Host'] = self.backend_netloc
+            self.filter_headers(self.headers)
+            nb_bytes = self._handle_request(scheme, self._get_backend_netloc(context), path, self.headers,
+                                            method=self.command)
+            backend_time = time.monotonic() - start
+        self._record_query_stats(context, alt_data, backend_time, nb_bytes)
+        self._capture_query(context, alt_data, start, nb_bytes)
+
+    def _get_backend_netloc(self, context):
         """
-        Get a list of all queries (q=... parameters) from an URL parameter string
-        :param parameters: The url parameter list
+        :type context: RequestContext
+        :return: netloc of the backend the request got routed to
         """
-        parsed_params = urllib.parse.parse_qs(parameters)
-        if 'q' not in parsed_params:
-            return []
-        queries = parsed_params['q']
+        if context is None or context.backend is None:
+            return self.backend_netloc
+        return "{}:{}".format(*context.backend)
+
+    def _handle_request(self, scheme, netloc, path, headers, body=None, method="GET"):
+        """
+        Run the actual request
+        :return: nb of bytes of body sent back to the client
+        """
+        backend_url = "{}://{}{}".format(scheme, netloc, path)
+        pool = None
+        if method == "GET" and netloc == self.backend_netloc and self.is_query_endpoint(path):
+            pool = self.read_pool
+        try:
+            with stage('backend'):
+                response = self.http_request.request(backend_url, method=method, body=body, headers=dict(headers),
+                                                     pool=pool)
+            return self._return_response(response)
+        except Exception as e:
+            body = "Invalid response from backend: '{}' Server might be busy".format(e)
+            logging.debug(body)
+            self.send_error(http.client.SERVICE_UNAVAILABLE, body)
+            return 0
 
-        # Check if only one query param is given
-        # in this case make it a list
-        if not isinstance(queries, list):
-            queries = [queries]
+    def _fan_out_request(self, scheme, path, headers, backends, body=None, method="GET"):
+        """
+        Send a /query request to several shards and merge their results, statement by statement.
+        Client gets the first error response, if any.
+        :param backends: list of (host, port)
+        :return: nb of bytes of body sent back to the client
+        """
+        # NB: results get decoded to be merged, so are asked for as plain JSON
+        headers = {header_key: header_value for header_key, header_value in headers.items()
+                   if header_key.lower() not in ('accept', 'accept-encoding')}
+        headers['Accept'] = 'application/json'
+
+        responses = []
+        for backend_host, backend_port in backends:
+            backend_url = "{}://{}:{}{}".format(scheme, backend_host, backend_port, path)
+            try:
+                with stage('backend'):
+                    response = self.http_request.request(backend_url, method=method, body=body, headers=headers)
+                    response_body = response.read()
+            except Exception as e:
+                body = "Invalid response from backend: '{}' Server might be busy".format(e)
+                logging.debug(body)
+                self.send_error(http.client.SERVICE_UNAVAILABLE, body)
+                return 0
+            if response.status != http.client.OK:
+                content_type = response.getheader('Content-Type', 'text/plain')
+                return self._send_body(response.status, response.reason, [('content-type', content_type)],
+                                       [response_body])
+            # NB: chunked responses are made of one JSON document per line
+            statement_results = []
+            for line in response_body.splitlines():
+                if line.strip():
+                    statement_results.extend(json.loads(line).get('results', []))
+            responses.append(statement_results)
+
+        with stage('merge'):
+            results = merge_query_results(responses)
+        return self._send_body(http.client.OK, None, [('content-type', 'application/json')],
+                               [(json.dumps({'results': results}) + '\n').encode()])
+
+    def _record_query_stats(self, context, alt_data, backend_time, nb_bytes):
+        """
+        Account for the statements of a query request in the top-N query fingerprints
+        :param alt_data: one pandas result per statement, None if request got relayed as is
+        :param backend_time: in seconds
+        """
+        if self.query_stats is None or context is None:
+            return
+        nb_rows_list = None
+        if alt_data is not None:
+            nb_rows_list = [get_nb_rows(result) for result in alt_data]
+        self.query_stats.record(context.queries, backend_time * 1000, nb_bytes, nb_rows_list)
 
-        # Foreach query param, split them if several queries in it
-        queries_2 = []
-        for q in queries:
-            queries_2 = queries_2 + list(filter(None, q.split(';')))
+    def _capture_query(self, context, alt_data, start, nb_bytes):
+        """
+        Hand a query request over to the capture, if enabled
+        :param alt_data: one pandas result per statement, None if request got relayed as is
+        :param start: monotonic time at which the request got received
+        """
+        if self.query_capture is None or context is None or not self.is_query_endpoint(self.path):
+            return
+        duration = time.monotonic() - start
+        self.query_capture.capture(self.command, '/query', context, time.time() - duration, duration * 1000,
+                                   nb_bytes, alt_data is not None)
 
-        return queries_2
+    def _send_alt_data(self, context, alt_data):
+        """
+        Send back reworked data to the client, encoded according to its Accept header
+        :type context: RequestContext
+        :param alt_data: one pandas result per statement
+        :return: nb of bytes of body sent
+        """
 
-    @staticmethod
-    def get_schema(parameters):
+        # TODO: should also set the following header:
+        # - request-id: 525fd587-b361-11e7-bd56-000000000000
+        # - x-influxdb-version: 1.1.1
+        # - date: Tue, 17 Oct 2017 17:33:43 GMT
+        # - Date: Tue, 17 Oct 2017 17:33:43 GMT
+
+        error_reason = None
+        headers = []
+        if "request-id" in self.headers:
+            headers.append(("request-id", self.headers["request-id"]))
+        if context.downsampled:
+            headers.append(('X-Cleanflux-Downsampled', 'true'))
+        encoder = get_result_encoder(self.headers.get('Accept'))
+        headers.append(('content-type', encoder.content_type))
+        # NB: body is streamed while being encoded, using chunked transfer encoding
+        chunks = encoder.iter_encode(alt_data, context.precision, context.chunked, context.chunk_size)
+        return self._send_body(http.client.OK, error_reason, headers, chunks)
+
+    def _send_body(self, status, reason, headers, chunks, length=None, compress=True):
         """
-        Get teh schema (db=... parameters) from an URL parameter string
-        :param parameters: The url parameter list
+        Send a response whose body is produced as an iterable of chunks (bytes).
+        Body gets compressed on the fly if client accepts it.
+        :param headers: list of (name, value)
+        :param chunks: iterable of bytes
+        :param length: total length of body, if known in advance
+        :param compress: False if body must be relayed as is
+        :return: nb of bytes of body sent, once compressed
         """
-        parsed_params = urllib.parse.parse_qs(parameters)
-        if 'db' not in parsed_params:
-            return None
-        elif isinstance(parsed_params['db'], list):
-            return parsed_params['db'][0]
+        is_bodiless_status = status < 200 or status in (http.client.NO_CONTENT, http.client.NOT_MODIFIED)
+        if self.command == 'HEAD' or is_bodiless_status:
+            # NB: such responses have no body, so neither compression nor chunked framing
+            self.send_response(status, reason)
+            for header_key, header_value in headers:
+                self.send_header(header_key, header_value)
+            if not is_bodiless_status and length is not None:
+                self.send_header('Content-Length', str(length))
+            self.end_headers()
+            return 0
+
+        compressor = None
+        if compress and self.compression_enabled \
+                and (length is None or length >= self.compression_min_size):
+            encoding = negotiate_encoding(self.headers.get('Accept-Encoding'))
+            if encoding is not None:
+                compressor = StreamCompressor(encoding, self.compression_level)
+
+        self.send_response(status, reason)
+        for header_key, header_value in headers:
+            self.send_header(header_key, header_value)
+        trace = get_trace()
+        if trace is not None and self.tracing:
+            # NB: body is yet to be serialized, so only stages done so far are known
+            self.send_header('Server-Timing', trace.get_server_timing())
+        if compressor is not None:
+            self.send_header('Content-Encoding', compressor.encoding)
+            self.send_header('Vary', 'Accept-Encoding')
+            length = None
+        if length is not None:
+            self.send_header('Content-Length', str(length))
+            writer = PlainWriter(self.wfile)
+        elif self.request_version == 'HTTP/1.1':
+            self.send_header('Transfer-Encoding', 'chunked')
+            writer = ChunkedWriter(self.wfile)
         else:
-            return parsed_params['db']
+            # NB: HTTP/1.0 clients only know end of body by connection close
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+            writer = PlainWriter(self.wfile)
+        self.end_headers()
 
-    @staticmethod
-    def get_user(parameters):
+        with stage('serialize'):
+            # NB: encoders yield small pieces (e.g. one per series header), coalesced into blocks
+            #     so that each block costs a single send
+            pending = []
+            pending_size = 0
+            for chunk in chunks:
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+                pending.append(chunk)
+                pending_size += len(chunk)
+                if pending_size >= self.response_write_size:
+                    writer.write(pending[0] if len(pending) == 1 else b''.join(pending))
+                    pending = []
+                    pending_size = 0
+            if compressor is not None:
+                pending.append(compressor.flush())
+            writer.write(b''.join(pending))
+            writer.close()
+        return writer.nb_bytes
+
+    def _log_if_slow(self, trace):
         """
-        Get teh schema (db=... parameters) from an URL parameter string
-        :param parameters: The url parameter list
+        :type trace: Trace
         """
-        parsed_params = urllib.parse.parse_qs(parameters)
-        if 'u' not in parsed_params:
-            return None
-        return parsed_params['u']
+        if self.slow_request_threshold_ms is None:
+            return
+        total_ms = trace.get_total() * 1000
+        if total_ms < self.slow_request_threshold_ms:
+            return
+        path = self.path if len(self.path) <= 512 else self.path[:512] + '...'
+        logging.warning("Slow request ({:.1f}ms): {} {} - {}".format(total_ms, self.command, path, trace))
 
-    @staticmethod
-    def get_password(parameters):
+    def _iter_body_chunks(self, length, raw_chunks):
         """
-        Get teh schema (db=... parameters) from an URL parameter string
-        :param parameters: The url parameter list
+        Read the request body by chunks, keeping a reference to each raw chunk
+        :param length: value of the Content-Length header
+        :param raw_chunks: list to which raw chunks get appended
         """
-        parsed_params = urllib.parse.parse_qs(parameters)
-        if 'p' not in parsed_params:
-            return None
-        return parsed_params['p']
+        remaining = length
+        while remaining > 0:
+            chunk = self.rfile.read(min(self.body_chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            raw_chunks.append(chunk)
+            yield chunk
 
-    @staticmethod
-    def get_precision(parameters):
+    def _get_post_query_params(self, parameters, length):
         """
-        Get teh schema (db=... parameters) from an URL parameter string
-        :param parameters: The url parameter list
+        Merge URL parameters with the ones from a form-encoded POST body
+        :return: raw body (bytes), dict of parameter name -> list of values
         """
         parsed_params = urllib.parse.parse_qs(parameters)
-        if 'epoch' not in parsed_params:
-            return None
+        raw_chunks = []
+        for key, value in iter_form_params(self._iter_body_chunks(length, raw_chunks)):
+            parsed_params.setdefault(key, []).append(value)
+        return b''.join(raw_chunks), parsed_params
 
-        # NB: dunno why, but it gets parsed as a list
-        precision = parsed_params['epoch']
-        if isinstance(precision, list):
-            return precision[0]
-        return precision
+    # --------------------------------------------------------------------
+    # WRITE FAST PATH
 
-    @staticmethod
-    def _analyze_url(path):
-        url_parts = urllib.parse.urlsplit(path)
-        parameters = url_parts.query if url_parts.query else url_parts.path
-        scheme, netloc, path = url_parts.scheme, url_parts.netloc, (url_parts.path + '?' + parameters)
-        assert scheme in ('http', 'https')
-        return scheme, netloc, path, parameters
+    def _relay_write(self, pool=None):
+        """
+        Stream a /write request to the backend and its response back to the client.
+        The payload is relayed by chunks through a reusable buffer, without any query analysis.
+        :param pool: ConnectionPool of the backend to write to, defaults to the main one
+        """
+        if pool is None:
+            pool = self.write_connection_pool
+        conn = pool.acquire()
+        try:
+            conn.putrequest('POST', self.path, skip_host=True, skip_accept_encoding=True)
+            is_chunked = 'chunked' in self.headers.get('Transfer-Encoding', '').lower()
+            for header_key, header_value in self.headers.items():
+                if header_key.lower() not in self.hop_by_hop_headers:
+                    conn.putheader(header_key, header_value)
+            if is_chunked:
+                conn.putheader('Transfer-Encoding', 'chunked')
+            conn.endheaders()
+
+            buf = bytearray(self.write_chunk_size)
+            if is_chunked:
+                self._relay_chunked_body(conn, buf)
+            else:
+                self._relay_body(conn, buf, int(self.headers.get('Content-Length', 0)))
+
+            response = conn.getresponse()
+            self._relay_response(response, buf)
+        except Exception as e:
+            pool.discard(conn)
+            body = "Invalid response from backend: '{}' Server might be busy".format(e)
+            logging.debug(body)
+            self.send_error(http.client.SERVICE_UNAVAILABLE, body)
+            return
 
-    def do_GET(self):
-        self.path = self._build_url(self.path, self.headers['Host'])
-        scheme, netloc, path, parameters = self._analyze_url(self.path)
+        if response.will_close:
+            pool.discard(conn)
+        else:
+            pool.release(conn)
 
-        user = self.get_user(parameters)
-        password = self.get_password(parameters)
-        schema = self.get_schema(parameters)
-        queries = self.get_queries(parameters)
-        precision = self.get_precision(parameters)
+    def _is_coalescable_write(self):
+        if 'Transfer-Encoding' in self.headers or 'Content-Encoding' in self.headers:
+            return False
+        length = self.headers.get('Content-Length')
+        return length is not None and int(length) <= self.write_coalescer.max_request_bytes
 
-        alt_data = self._get_alt_data(user, password, schema, queries, precision)
+    def _coalesce_write(self):
+        """
+        Hand a small /write request to the write coalescer and reply once its batch got written
+        """
+        parameters = urllib.parse.urlsplit(self.path).query
+        key = self.write_coalescer.get_key(parameters, self.headers)
+        payload = self.rfile.read(int(self.headers['Content-Length']))
 
-        if alt_data is not None:
+        status, reason, content_type, body = self.write_coalescer.submit(key, payload)
 
-            # TODO: should also set the following header:
-            # - request-id: 525fd587-b361-11e7-bd56-000000000000
-            # - x-influxdb-version: 1.1.1
-            # - date: Tue, 17 Oct 2017 17:33:43 GMT
-            # - Date: Tue, 17 Oct 2017 17:33:43 GMT
-
-            error_reason = None
-            self.send_response(http.client.OK, error_reason)
-            if "request-id" in self.headers:
-                self.send_header("request-id", self.headers["request-id"])
-            body = alt_data + "\n"
-            self.send_header('content-type', 'application/json')
+        self.send_response(status, reason)
+        if status in (http.client.NO_CONTENT, http.client.NOT_MODIFIED):
+            self.end_headers()
+            return
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _relay_body(self, conn, buf, length):
+        view = memoryview(buf)
+        remaining = length
+        while remaining > 0:
+            n = self.rfile.readinto(view[:min(len(buf), remaining)])
+            if not n:
+                raise IOError("Client closed connection before end of body")
+            conn.send(view[:n])
+            remaining -= n
+
+    def _relay_chunked_body(self, conn, buf):
+        # NB: chunk framing is relayed verbatim, so that backend decodes it for us
+        while True:
+            size_line = self.rfile.readline(65537)
+            conn.send(size_line)
+            chunk_size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if chunk_size == 0:
+                break
+            self._relay_body(conn, buf, chunk_size + 2)  # chunk data + CRLF
+        # trailers, up to the final empty line
+        while True:
+            line = self.rfile.readline(65537)
+            conn.send(line)
+            if line in (b'\r\n', b'\n', b''):
+                break
+
+    def _relay_response(self, response, buf):
+        """
+        :type response: HTTPResponse
+        """
+        self.send_response(response.status, response.reason)
+        for header_key, header_value in response.msg.items():
+            if header_key.lower() not in self.hop_by_hop_headers and header_key.lower() != 'content-length':
+                self.send_header(header_key, header_value)
+
+        if response.status in (http.client.NO_CONTENT, http.client.NOT_MODIFIED):
+            response.read()
+            self.end_headers()
+            return
+
+        if response.length is None:
+            # NB: /write responses without length are small (errors), so no need to stream them
+            body = response.read()
             self.send_header('Content-Length', str(len(body)))
             self.end_headers()
-            self.wfile.write(body.encode())
-            #pass
+            self.wfile.write(body)
+            return
+
+        self.send_header('Content-Length', str(response.length))
+        self.end_headers()
+        view = memoryview(buf)
+        while True:
+            n = response.readinto(view)
+            if not n:
+                break
+            self.wfile.write(view[:n])
+
+    # --------------------------------------------------------------------
+    # WRITE SHARDING
+
+    def _route_write(self):
+        """
+        Send a /write request to the shard(s) holding its measurements.
+        Requests for a schema that is not split by measurement are relayed as is, on the fast path.
+        """
+        parameters = urllib.parse.urlsplit(self.path).query
+        schema = get_first_param_value(urllib.parse.parse_qs(parameters), 'db')
+        backend = self.shard_router.get_schema_backend(schema)
+        if backend is not None:
+            if backend == self.shard_router.default_backend \
+                    and self.write_coalescer is not None and self._is_coalescable_write():
+                self._coalesce_write()
+            else:
+                self._relay_write(self.shard_write_pools[backend])
+            return
+        self._split_write(schema)
+
+    def _split_write(self, schema):
+        """
+        Split the line protocol payload of a /write request by measurement and send each part to its shard.
+        Client gets the first error response, if any.
+        """
+        payload = self._read_write_payload()
+        if payload is None:
+            return
+
+        headers = {header_key: header_value for header_key, header_value in self.headers.items()
+                   if header_key.lower() not in self.hop_by_hop_headers
+                   and header_key.lower() not in ('content-length', 'content-encoding', 'host')}
+
+        result = (http.client.NO_CONTENT, None, None, b'')
+        for backend, backend_payload in self.shard_router.split_write(schema, payload).items():
+            backend_result = self._send_write(self.shard_write_pools[backend], backend_payload, headers)
+            if backend_result[0] >= 300 and result[0] < 300:
+                result = backend_result
+
+        status, reason, content_type, body = result
+        self.send_response(status, reason)
+        if status in (http.client.NO_CONTENT, http.client.NOT_MODIFIED):
+            self.end_headers()
+            return
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_write_payload(self):
+        """
+        :return: decoded body of the /write request, None if an error has been sent back to the client
+        """
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            payload = b''.join(self._iter_chunked_body())
         else:
-            # TODO: Is this needed?
-            # self.headers['Host'] = self.backend_netloc
-            self.filter_headers(self.headers)
-            self._handle_request(scheme, self.backend_netloc, path, self.headers)
+            payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        encoding = self.headers.get('Content-Encoding', 'identity').strip().lower()
+        try:
+            return decode_content_body(payload, encoding)
+        except Exception as e:
+            self.send_error(http.client.BAD_REQUEST, "Could not decode body: {}".format(e))
+            return None
 
-    def _handle_request(self, scheme, netloc, path, headers, body=None, method="GET"):
+    def _iter_chunked_body(self):
+        while True:
+            chunk_size = int(self.rfile.readline(65537).split(b';', 1)[0].strip(), 16)
+            if chunk_size == 0:
+                break
+            yield self.rfile.read(chunk_size)
+            self.rfile.readline(65537)  # CRLF
+        # trailers, up to the final empty line
+        while self.rfile.readline(65537) not in (b'\r\n', b'\n', b''):
+            pass
+
+    def _send_write(self, pool, payload, headers):
         """
-        Run the actual request
+        :return: (status, reason, content-type, body) of the backend response
         """
-        backend_url = "{}://{}{}".format(scheme, netloc, path)
+        conn = pool.acquire()
         try:
-            response = self.http_request.request(backend_url, method=method, body=body, headers=dict(headers))
-            self._return_response(response)
+            conn.request('POST', self.path, body=payload, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
         except Exception as e:
-            body = "Invalid response from backend: '{}' Server might be busy".format(e.message)
-            logging.debug(body)
-            self.send_error(http.client.SERVICE_UNAVAILABLE, body)
+            pool.discard(conn)
+            logging.error("Could not write to shard {}:{}: {}".format(pool.host, pool.port, e))
+            return (http.client.SERVICE_UNAVAILABLE, 'Service Unavailable', 'text/plain',
+                    "Invalid response from backend: '{}' Server might be busy".format(e).encode())
+        if response.will_close:
+            pool.discard(conn)
+        else:
+            pool.release(conn)
+        return response.status, response.reason, response.getheader('Content-Type', 'text/plain'), body
 
+    @traced_request
     def do_POST(self):
+        if self.shard_router is not None and self.is_write_endpoint(self.path):
+            self._route_write()
+            return
+        if self.write_connection_pool is not None and self.is_write_endpoint(self.path):
+            if self.write_coalescer is not None and self._is_coalescable_write():
+                self._coalesce_write()
+            else:
+                self._relay_write()
+            return
+
         self.path = self._build_url(self.path, self.headers['Host'])
         scheme, netloc, path, parameters = self._analyze_url(self.path)
 
         length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(length)
+
+        start = time.monotonic()
+        context = None
+        if self.is_query_endpoint(self.path) and self.is_form_encoded(self.headers):
+            post_data, parsed_params = self._get_post_query_params(parameters, length)
+            context = RequestContext.from_params(parsed_params)
+            alt_data = self._get_alt_data(context)
+            if context.error is not None:
+                self.send_error(http.client.BAD_REQUEST, context.error)
+                return
+            if alt_data is None and context.fanout_backends is not None:
+                self.filter_headers(self.headers)
+                nb_bytes = self._fan_out_request(scheme, path, self.headers, context.fanout_backends,
+                                                 body=post_data, method="POST")
+                self._record_query_stats(context, None, time.monotonic() - start, nb_bytes)
+                self._capture_query(context, None, start, nb_bytes)
+                return
+            if alt_data is not None:
+                backend_time = time.monotonic() - start
+                nb_bytes = self._send_alt_data(context, alt_data)
+                self._record_query_stats(context, alt_data, backend_time, nb_bytes)
+                self._capture_query(context, alt_data, start, nb_bytes)
+                return
+        else:
+            post_data = self.rfile.read(length)
 
         self.filter_headers(self.headers)
-        self._handle_request(scheme, self.backend_netloc, path, self.headers, body=post_data, method="POST")
+        nb_bytes = self._handle_request(scheme, self._get_backend_netloc(context), path, self.headers,
+                                        body=post_data, method="POST")
+        self._record_query_stats(context, None, time.monotonic() - start, nb_bytes)
+        self._capture_query(context, None, start, nb_bytes)
 
     def send_error(self, code, message=None):
         """
@@ -268,71 +793,51 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
         :param code:
         :param message:
         """
-        message = message.strip()
+        message = message.strip() if message else ''
         self.log_error("code %d, message %s", code, message)
         self.send_response(code)
         self.send_header("Content-Type", "text/plain")
         self.send_header('Connection', 'close')
         self.end_headers()
         if message:
-            self.wfile.write(message)
+            self.wfile.write(message.encode())
 
     def _return_response(self, response):
         """
         :type response: HTTPResponse
         """
         self.filter_headers(response.msg)
-        if "content-length" in response.msg:
-            del response.msg["content-length"]
-
-        self.send_response(response.status, response.reason)
-        for header_key, header_value in response.msg.items():
-            self.send_header(header_key, header_value)
-        body = response.read()
-        self.send_header('Content-Length', str(len(body)))
-        self.end_headers()
-        self.wfile.write(body)
+        headers = [(header_key, header_value) for header_key, header_value in response.msg.items()
+                   if header_key.lower() != 'content-length']
+
+        # NB: body already encoded by backend (as accepted by client) is relayed as is
+        is_encoded = response.getheader('Content-Encoding', 'identity').lower() != 'identity'
+
+        length = response.length
+        if self.command == 'HEAD' and response.getheader('Content-Length') is not None:
+            # NB: length of the body a GET would get
+            length = int(response.getheader('Content-Length'))
+        if response.length == 0:
+            # NB: e.g. a 204 or the response to a HEAD, never iterated over by _send_body() but to be read,
+            #     for its connection to be reused
+            response.read()
+        chunks = iter(lambda: response.read(self.response_chunk_size), b'')
+        try:
+            return self._send_body(response.status, response.reason, headers, chunks, length,
+                                   compress=not is_encoded)
+        finally:
+            # NB: connection of a pooled read is only reused if its response got read to the end
+            self.http_request.release(response)
 
     do_HEAD = do_GET
     do_OPTIONS = do_GET
 
-    @staticmethod
-    def filter_headers(headers):
-        # http://tools.ietf.org/html/rfc2616#section-13.5.1
-        hop_by_hop = (
-            'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers',
-            'transfer-encoding', 'upgrade'
-        )
-        for k in hop_by_hop:
+    @classmethod
+    def filter_headers(cls, headers):
+        for k in cls.hop_by_hop_headers:
             if k in headers:
                 del headers[k]
 
-    @staticmethod
-    def encode_content_body(text, encoding):
-        if encoding == 'identity':
-            return text
-        if encoding in ('gzip', 'x-gzip'):
-            io = StringIO()
-            with gzip.GzipFile(fileobj=io, mode='wb') as f:
-                f.write(text)
-            return io.getvalue()
-        if encoding == 'deflate':
-            return zlib.compress(text)
-        raise Exception("Unknown Content-Encoding: %s" % encoding)
-
-    @staticmethod
-    def decode_content_body(data, encoding):
-        if encoding == 'identity':
-            return data
-        if encoding in ('gzip', 'x-gzip'):
-            io = StringIO(data)
-            with gzip.GzipFile(fileobj=io) as f:
-                return f.read()
-        if encoding == 'deflate':
-            return zlib.decompress(data)
-
-        raise Exception("Unknown Content-Encoding: %s" % encoding)
-
     def send_cacert(self):
         with open(self.cacert, 'rb') as f:
             data = f.read()
@@ -0,0 +1,217 @@
+import logging
+import threading
+import time
+import urllib.parse
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from datadog import statsd
+
+
+class WriteBatch(object):
+    """
+    Line protocol payloads waiting to be written together
+    """
+
+    __slots__ = ('key', 'payloads', 'size', 'created', 'deadline', 'done', 'results')
+
+    def __init__(self, key, created, deadline):
+        self.key = key
+        self.payloads = []
+        self.size = 0
+        self.created = created
+        self.deadline = deadline
+        self.done = threading.Event()
+        # (status, reason, content-type, body) for each payload
+        self.results = None
+
+
+class WriteCoalescer(object):
+    """
+    Buffers small /write requests sharing the same target (db, rp, precision, consistency & credentials)
+    and sends them to the backend as a single write.
+
+    Clients get acknowledged with the backend response once the batch they belong to has been flushed.
+    A batch rejected as a bad request (e.g. a malformed line or a field type conflict) gets its payloads re-sent
+    one by one, so that each client gets the status of its own lines.
+    """
+
+    # URL parameters & headers identifying the target of a write
+    key_params = ('db', 'rp', 'precision', 'consistency', 'u', 'p')
+    key_headers = ('Authorization',)
+
+    def __init__(self, connection_pool, max_request_bytes, max_bytes, max_delay_ms, max_pending_bytes,
+                 nb_flush_workers=4, timeout=45):
+        self.connection_pool = connection_pool
+        self.max_request_bytes = max_request_bytes
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay_ms / 1000.0
+        self.max_pending_bytes = max_pending_bytes
+        self.timeout = timeout
+
+        self.cond = threading.Condition()
+        self.batches = {}
+        self.pending_bytes = 0
+        self.nb_flushes = 0
+        self.nb_rejected = 0
+        self.nb_isolated = 0
+
+        self.executor = ThreadPoolExecutor(max_workers=nb_flush_workers)
+        self.flusher = threading.Thread(target=self._run_flusher, name='write-coalescer')
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    # --------------------------------------------------------------------
+    # PUBLIC
+
+    @classmethod
+    def get_key(cls, parameters, headers):
+        parsed_params = urllib.parse.parse_qs(parameters)
+        key = tuple(parsed_params.get(param, [None])[0] for param in cls.key_params)
+        return key + tuple(headers.get(header) for header in cls.key_headers)
+
+    def submit(self, key, payload):
+        """
+        Add payload to the batch for key and wait for that batch to be written
+        :param key: as returned by get_key()
+        :param payload: line protocol (bytes)
+        :return: (status, reason, content-type, body) of the backend response
+        """
+        if not payload.endswith(b'\n'):
+            payload += b'\n'
+        size = len(payload)
+
+        with self.cond:
+            # backpressure: wait for in-flight batches to be flushed
+            deadline = time.monotonic() + self.timeout
+            while self.pending_bytes + size > self.max_pending_bytes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.nb_rejected += 1
+                    statsd.increment('write_coalescer_rejected')
+                    return (http.client.SERVICE_UNAVAILABLE, 'Service Unavailable', 'text/plain',
+                            b'Write buffer is full, retry later')
+                self.cond.wait(remaining)
+
+            batch = self.batches.get(key)
+            if batch is None:
+                now = time.monotonic()
+                batch = WriteBatch(key, now, now + self.max_delay)
+                self.batches[key] = batch
+            index = len(batch.payloads)
+            batch.payloads.append(payload)
+            batch.size += size
+            self.pending_bytes += size
+            if batch.size >= self.max_bytes:
+                self._detach(batch)
+            self.cond.notify_all()
+
+        if not batch.done.wait(self.timeout + self.max_delay):
+            return (http.client.GATEWAY_TIMEOUT, 'Gateway Timeout', 'text/plain',
+                    b'Timed out waiting for buffered write to be flushed')
+        if batch.results is None:
+            # NB: flush died before giving its results
+            return (http.client.SERVICE_UNAVAILABLE, 'Service Unavailable', 'text/plain',
+                    b'Buffered write could not be flushed')
+        return batch.results[index]
+
+    def get_state(self):
+        with self.cond:
+            return {
+                'nb_batches': len(self.batches),
+                'pending_bytes': self.pending_bytes,
+                'nb_flushes': self.nb_flushes,
+                'nb_rejected': self.nb_rejected,
+                'nb_isolated': self.nb_isolated,
+            }
+
+    # --------------------------------------------------------------------
+    # PRIVATE
+
+    def _detach(self, batch):
+        # NB: must be called with self.cond held
+        del self.batches[batch.key]
+        self.executor.submit(self._flush, batch)
+
+    def _run_flusher(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                next_deadline = None
+                for batch in list(self.batches.values()):
+                    if batch.deadline <= now:
+                        self._detach(batch)
+                    elif next_deadline is None or batch.deadline < next_deadline:
+                        next_deadline = batch.deadline
+                if next_deadline is None:
+                    self.cond.wait()
+                else:
+                    self.cond.wait(next_deadline - now)
+
+    def _get_write_path(self, key):
+        params = [(param, value) for param, value in zip(self.key_params, key) if value is not None]
+        return '/write?' + urllib.parse.urlencode(params)
+
+    def _send(self, path, payload, headers):
+        """
+        :return: (status, reason, content-type, body) of the backend response
+        """
+        conn = self.connection_pool.acquire()
+        # NB: payload being buffered, a write failing on a reused connection (e.g. closed by the backend
+        #     in the meantime) is retried once on a fresh one. Points being identified by their timestamp,
+        #     writing them twice is harmless.
+        for is_retry in (False, True):
+            is_reused = conn.sock is not None
+            try:
+                conn.request('POST', path, body=payload, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except Exception as e:
+                self.connection_pool.discard(conn)
+                if is_reused and not is_retry:
+                    logging.info("Retrying buffered writes on a fresh connection: {}".format(e))
+                    conn = self.connection_pool.acquire(fresh=True)
+                    continue
+                logging.error("Could not flush buffered writes: {}".format(e))
+                return (http.client.SERVICE_UNAVAILABLE, 'Service Unavailable', 'text/plain',
+                        "Invalid response from backend: '{}' Server might be busy".format(e).encode())
+            if response.will_close:
+                self.connection_pool.discard(conn)
+            else:
+                self.connection_pool.release(conn)
+            return response.status, response.reason, response.getheader('Content-Type', 'text/plain'), body
+
+    def _flush(self, batch):
+        start = time.monotonic()
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        for header, value in zip(self.key_headers, batch.key[len(self.key_params):]):
+            if value is not None:
+                headers[header] = value
+
+        path = self._get_write_path(batch.key)
+        try:
+            result = self._send(path, b''.join(batch.payloads), headers)
+            # NB: other client errors (authentication, unknown database...) concern the target, shared by all
+            #     payloads. Valid lines of a partial write got written already, writing them again is harmless.
+            if result[0] == http.client.BAD_REQUEST and len(batch.payloads) > 1:
+                with self.cond:
+                    self.nb_isolated += 1
+                statsd.increment('write_coalescer_isolated_batches')
+                batch.results = [self._send(path, payload, headers) for payload in batch.payloads]
+            else:
+                batch.results = [result] * len(batch.payloads)
+        except Exception as e:
+            logging.error("Could not flush buffered writes: {}".format(e))
+            batch.results = [(http.client.SERVICE_UNAVAILABLE, 'Service Unavailable', 'text/plain',
+                              "Could not flush buffered writes: '{}'".format(e).encode())] * len(batch.payloads)
+        finally:
+            with self.cond:
+                self.pending_bytes -= batch.size
+                self.nb_flushes += 1
+                self.cond.notify_all()
+            batch.done.set()
+
+        end = time.monotonic()
+        statsd.timing('timer_write_coalescer_flush', (end - start) * 1000)
+        statsd.timing('timer_write_coalescer_ack', (end - batch.created) * 1000)
+        statsd.histogram('write_coalescer_batch_bytes', batch.size)
+        statsd.histogram('write_coalescer_batch_requests', len(batch.payloads))
@@ -0,0 +1,288 @@
+"""
+Replay of captured /query requests (see QueryCapture) against a cleanflux instance, e.g. to size proxies or test rewrites
+
+Requests are re-issued w/ their original pacing (possibly accelerated), by a pool of concurrent clients.
+Latency distributions get reported and, if a direct backend is given, each response of the proxy is compared
+to the one of the backend for the same request.
+
+Usage:
+    python -m cleanflux.replay /var/lib/cleanflux/capture --target localhost:8888 [--direct localhost:8086]
+                               [--speed 1] [--concurrency 8] [--limit 10000]
+"""
+import argparse
+import http.client
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+import urllib.parse
+
+from cleanflux.proxy.query_capture import iter_capture_records
+
+
+# ------------------------------------------------------------------------
+# GLOBALS
+
+max_nb_mismatch_examples = 10
+
+
+# ------------------------------------------------------------------------
+# REQUESTS
+
+def parse_netloc(netloc, default_port=8086):
+    host, _, port = netloc.partition(':')
+    return host, int(port) if port else default_port
+
+
+def build_request(record, user=None, password=None):
+    """
+    :param record: captured request
+    :return: (method, path, body, headers)
+    """
+    params = [(name, record.get(name)) for name in ('db', 'rp', 'epoch', 'q')]
+    params.extend([('u', user), ('p', password)])
+    params = urllib.parse.urlencode([(name, value) for name, value in params if value is not None])
+    if record.get('method') == 'POST':
+        return 'POST', record.get('path', '/query'), params.encode(), \
+               {'Content-Type': 'application/x-www-form-urlencoded'}
+    return 'GET', record.get('path', '/query') + '?' + params, None, {}
+
+
+def compare_responses(response, direct_response):
+    """
+    :param response: (status, body) of the proxy
+    :param direct_response: (status, body) of the backend
+    :return: reason of the mismatch, None if responses match
+    NB: JSON bodies are compared once decoded, so that formatting & key order do not matter
+    """
+    status, body = response
+    direct_status, direct_body = direct_response
+    if status != direct_status:
+        return 'status'
+    if body == direct_body:
+        return None
+    try:
+        if json.loads(body) == json.loads(direct_body):
+            return None
+    except ValueError:
+        pass
+    return 'body'
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def get_latency_distribution(latencies):
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else float('nan'),
+    }
+
+
+# ------------------------------------------------------------------------
+# REPLAY
+
+class Replayer(object):
+    """
+    Re-issue captured requests against a target, and optionally a direct backend to compare responses with
+    """
+
+    def __init__(self, target, direct=None, concurrency=8, speed=1.0, timeout=60, user=None, password=None):
+        """
+        :param target: (host, port) of the cleanflux instance
+        :param direct: (host, port) of the backend, None not to compare responses
+        :param speed: replay speed vs the original one, e.g. 2 for twice as fast, 0 for as fast as possible
+        """
+        self.target = target
+        self.direct = direct
+        self.concurrency = concurrency
+        self.speed = speed
+        self.timeout = timeout
+        self.user = user
+        self.password = password
+
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.direct_latencies = []
+        self.statuses = {}
+        self.errors = {}
+        self.mismatches = {}
+        self.mismatch_examples = []
+        self.max_lag = 0.0
+        self.nb_requests = 0
+
+    def run(self, records):
+        """
+        :param records: iterable of captured requests, in the order they got captured
+        :return: report, see get_report()
+        """
+        # NB: bounded, so that the lag of clients behind the original pacing shows up
+        pending = queue.Queue(self.concurrency * 2)
+        workers = []
+        for i in range(self.concurrency):
+            worker = threading.Thread(target=self._run_worker, args=(pending,), name='replay-{}'.format(i))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        start = time.monotonic()
+        first_ts = None
+        for record in records:
+            if record.get('ts') is None or not record.get('q'):
+                continue
+            if first_ts is None:
+                first_ts = record['ts']
+            if self.speed > 0:
+                due = start + (record['ts'] - first_ts) / self.speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    self.max_lag = max(self.max_lag, -delay)
+            pending.put(record)
+            self.nb_requests += 1
+        for _ in workers:
+            pending.put(None)
+        for worker in workers:
+            worker.join()
+        return self.get_report(time.monotonic() - start)
+
+    def get_report(self, duration):
+        with self.lock:
+            return {
+                'duration_s': duration,
+                'nb_requests': self.nb_requests,
+                'throughput': self.nb_requests / duration if duration else float('nan'),
+                'max_lag_s': self.max_lag,
+                'statuses': dict(self.statuses),
+                'errors': dict(self.errors),
+                'latency': get_latency_distribution(self.latencies),
+                'direct_latency': get_latency_distribution(self.direct_latencies) if self.direct else None,
+                'mismatches': dict(self.mismatches),
+                'mismatch_examples': list(self.mismatch_examples),
+            }
+
+    def _run_worker(self, pending):
+        connections = {}
+        while True:
+            record = pending.get()
+            if record is None:
+                break
+            method, path, body, headers = build_request(record, self.user, self.password)
+            response = self._send(connections, self.target, method, path, body, headers, self.latencies)
+            if response is None:
+                continue
+            with self.lock:
+                self.statuses[response[0]] = self.statuses.get(response[0], 0) + 1
+            if self.direct is None:
+                continue
+            direct_response = self._send(connections, self.direct, method, path, body, headers,
+                                         self.direct_latencies)
+            if direct_response is None:
+                continue
+            reason = compare_responses(response, direct_response)
+            if reason is not None:
+                with self.lock:
+                    self.mismatches[reason] = self.mismatches.get(reason, 0) + 1
+                    if len(self.mismatch_examples) < max_nb_mismatch_examples:
+                        self.mismatch_examples.append({'reason': reason, 'db': record.get('db'), 'q': record['q'],
+                                                       'status': response[0], 'direct_status': direct_response[0],
+                                                       'reworked': record.get('reworked')})
+        for conn in connections.values():
+            conn.close()
+
+    def _send(self, connections, address, method, path, body, headers, latencies):
+        """
+        :return: (status, body), None on error
+        """
+        conn = connections.get(address)
+        if conn is None:
+            conn = connections[address] = http.client.HTTPConnection(address[0], address[1], timeout=self.timeout)
+        start = time.monotonic()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response_body = response.read()
+        except Exception as e:
+            conn.close()
+            del connections[address]
+            with self.lock:
+                name = type(e).__name__
+                if address == self.direct:
+                    name = 'direct ' + name
+                self.errors[name] = self.errors.get(name, 0) + 1
+            return None
+        latency = time.monotonic() - start
+        with self.lock:
+            latencies.append(latency)
+        return response.status, response_body
+
+
+# ------------------------------------------------------------------------
+# MAIN
+
+def print_report(report):
+    print('{} requests in {:.1f}s ({:.1f} req/s), max lag behind original pacing: {:.2f}s'.format(
+        report['nb_requests'], report['duration_s'], report['throughput'], report['max_lag_s']))
+    print('statuses: {}'.format(', '.join('{}: {}'.format(status, count)
+                                          for status, count in sorted(report['statuses'].items())) or '-'))
+    if report['errors']:
+        print('errors: {}'.format(', '.join('{}: {}'.format(name, count)
+                                            for name, count in sorted(report['errors'].items()))))
+    print('{:<10}{:>10}{:>10}{:>10}{:>10}{:>10}'.format('', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for name, latency in [('proxied', report['latency']), ('direct', report['direct_latency'])]:
+        if latency is not None:
+            print('{:<10}{:>10}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+                name, latency['count'], latency['p50_ms'], latency['p90_ms'], latency['p99_ms'], latency['max_ms']))
+    if report['direct_latency'] is not None:
+        print('mismatches: {}'.format(', '.join('{}: {}'.format(reason, count)
+                                                for reason, count in sorted(report['mismatches'].items())) or '-'))
+        for example in report['mismatch_examples']:
+            print('  [{}] {} vs {}{} db={} {}'.format(example['reason'], example['status'], example['direct_status'],
+                                                      ' (reworked when captured)' if example['reworked'] else '',
+                                                      example['db'], example['q']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured queries against a cleanflux instance')
+    parser.add_argument('captures', nargs='+', help='capture files and / or directories of capture files')
+    parser.add_argument('--target', default='localhost:8888', help='host:port of the cleanflux instance')
+    parser.add_argument('--direct', help='host:port of the backend, to compare responses with')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed vs the original one, e.g. 2 for twice as fast, 0 for as fast as possible')
+    parser.add_argument('--concurrency', type=int, default=8, help='nb of concurrent clients')
+    parser.add_argument('--limit', type=int, help='max nb of requests replayed')
+    parser.add_argument('--timeout', type=float, default=60, help='in seconds, per request')
+    parser.add_argument('--user', help='credentials, not part of captures')
+    parser.add_argument('--password')
+    parser.add_argument('--json', action='store_true', help='print report as JSON')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.WARNING)
+
+    records = iter_capture_records(args.captures)
+    if args.limit is not None:
+        records = (record for i, record in zip(range(args.limit), records))
+
+    replayer = Replayer(parse_netloc(args.target, 8888), parse_netloc(args.direct) if args.direct else None,
+                        args.concurrency, args.speed, args.timeout, args.user, args.password)
+    report = replayer.run(records)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    if report['errors']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
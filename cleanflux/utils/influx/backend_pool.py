@@ -0,0 +1,262 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from http.client import HTTPConnection
+from datadog import statsd
+
+
+# ------------------------------------------------------------------------
+# GLOBALS
+
+# read pools, by (host, port) of the backend they stand for
+read_pools = {}
+# result of a hedged request that lost the race, see BackendPool._execute_one()
+lost_race = object()
+
+
+def register_read_pool(host, port, pool):
+    read_pools[(host, port)] = pool
+
+
+def get_read_pool(host, port):
+    return read_pools.get((host, port))
+
+
+# ------------------------------------------------------------------------
+# BACKENDS
+
+class Backend(object):
+    """
+    An InfluxDB instance of a pool
+    """
+
+    __slots__ = ('host', 'port', 'netloc', 'outstanding', 'healthy', 'nb_failures')
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.netloc = "{}:{}".format(host, port)
+        self.outstanding = 0
+        self.healthy = True
+        self.nb_failures = 0
+
+    def __repr__(self):
+        return "Backend({})".format(self.netloc)
+
+
+class BackendPool(object):
+    """
+    Identical InfluxDB replicas serving reads.
+
+    Requests go to the healthy backend w/ the least outstanding requests and fail over to the other ones.
+    Optionally, a request still unanswered after a delay (a percentile of observed latencies) gets hedged:
+    a duplicate is sent to a second backend and the first answer wins.
+    """
+
+    def __init__(self, backends, health_check_interval=5, failure_threshold=2,
+                 hedging=False, hedging_percentile=95, hedging_min_delay_ms=10, nb_hedging_workers=16):
+        """
+        :param backends: list of (host, port)
+        :param health_check_interval: in seconds, 0 to disable
+        :param failure_threshold: nb of consecutive failures after which a backend is considered down
+        """
+        self.backends = [Backend(host, port) for host, port in backends]
+        self.health_check_interval = health_check_interval
+        self.failure_threshold = failure_threshold
+        self.hedging = hedging
+        self.hedging_percentile = hedging_percentile
+        self.hedging_min_delay = hedging_min_delay_ms / 1000.0
+
+        self.lock = threading.Lock()
+        self.nb_acquired = 0
+        self.latencies = deque(maxlen=1000)
+        self.nb_latencies_since_update = 0
+        self.hedging_delay = None
+        self.nb_hedged = 0
+        self.nb_hedges_won = 0
+        self.nb_failovers = 0
+
+        self.executor = None
+        if hedging and len(self.backends) > 1:
+            self.executor = ThreadPoolExecutor(max_workers=nb_hedging_workers)
+
+        if health_check_interval and len(self.backends) > 1:
+            checker = threading.Thread(target=self._run_health_checks, name='backend-health-checks')
+            checker.daemon = True
+            checker.start()
+
+    # --------------------------------------------------------------------
+    # PUBLIC
+
+    def execute(self, fn, discard=None):
+        """
+        Run a request against the pool, w/ failover and hedging
+        :param fn: function taking a Backend and doing the request, raising an exception on failure
+        :param discard: function taking a Backend and the result of fn for it, when it lost a hedging race,
+                        e.g. to close a response, called in the thread fn ran in
+        :return: result of fn
+        """
+        tried = []
+        last_exception = None
+        while True:
+            backend = self._acquire(tried)
+            if backend is None:
+                break
+            tried.append(backend)
+            try:
+                if self.executor is not None:
+                    return self._execute_hedged(fn, backend, tried, discard)
+                return self._execute_one(fn, backend)
+            except Exception as e:
+                last_exception = e
+                logging.warning("Request to backend {} failed: {}".format(backend.netloc, e))
+                with self.lock:
+                    self.nb_failovers += 1
+        if last_exception is None:
+            raise Exception("No backend available")
+        raise last_exception
+
+    def get_state(self):
+        with self.lock:
+            return {
+                'backends': [{'netloc': b.netloc, 'healthy': b.healthy, 'outstanding': b.outstanding,
+                              'nb_failures': b.nb_failures} for b in self.backends],
+                'hedging_delay_ms': self.hedging_delay * 1000 if self.hedging_delay is not None else None,
+                'nb_hedged': self.nb_hedged,
+                'nb_hedges_won': self.nb_hedges_won,
+                'nb_failovers': self.nb_failovers,
+            }
+
+    # --------------------------------------------------------------------
+    # PRIVATE: SELECTION
+
+    def _acquire(self, exclude):
+        with self.lock:
+            candidates = [b for b in self.backends if b not in exclude]
+            healthy = [b for b in candidates if b.healthy]
+            if healthy:
+                candidates = healthy
+            if not candidates:
+                return None
+            # NB: rotate candidates, so that ties get spread in a round-robin fashion
+            self.nb_acquired += 1
+            offset = self.nb_acquired % len(candidates)
+            candidates = candidates[offset:] + candidates[:offset]
+            backend = min(candidates, key=lambda b: b.outstanding)
+            backend.outstanding += 1
+            return backend
+
+    def _release(self, backend, latency=None):
+        with self.lock:
+            backend.outstanding -= 1
+            if latency is None:
+                backend.nb_failures += 1
+                if backend.nb_failures >= self.failure_threshold and backend.healthy:
+                    logging.warning("Backend {} marked as down".format(backend.netloc))
+                    backend.healthy = False
+                return
+            backend.nb_failures = 0
+            backend.healthy = True
+            self.latencies.append(latency)
+            self.nb_latencies_since_update += 1
+            if self.hedging_delay is None or self.nb_latencies_since_update >= 100:
+                self._update_hedging_delay()
+
+    def _update_hedging_delay(self):
+        # NB: must be called with self.lock held
+        self.nb_latencies_since_update = 0
+        sorted_latencies = sorted(self.latencies)
+        i = min(len(sorted_latencies) - 1, int(len(sorted_latencies) * self.hedging_percentile / 100))
+        self.hedging_delay = max(self.hedging_min_delay, sorted_latencies[i])
+
+    # --------------------------------------------------------------------
+    # PRIVATE: EXECUTION
+
+    def _execute_one(self, fn, backend, race=None, discard=None):
+        """
+        :param race: lock shared by the requests of a hedging race, the 1rst one to succeed acquiring it
+        :return: result of fn, lost_race if another request of the race succeeded first
+        """
+        # NB: backend has already been acquired
+        start = time.monotonic()
+        try:
+            result = fn(backend)
+        except Exception:
+            self._release(backend)
+            raise
+        self._release(backend, time.monotonic() - start)
+        if race is not None and not race.acquire(False):
+            # NB: dropped right away, in the thread that owns its connection, before it runs anything else
+            if discard is not None:
+                try:
+                    discard(backend, result)
+                except Exception as e:
+                    logging.debug("Could not discard response of backend {}: {}".format(backend.netloc, e))
+            return lost_race
+        return result
+
+    def _execute_hedged(self, fn, backend, tried, discard=None):
+        race = threading.Lock()
+        primary = self.executor.submit(self._execute_one, fn, backend, race, discard)
+        done, _ = wait([primary], timeout=self.hedging_delay)
+        if done:
+            return primary.result()
+
+        hedge_backend = self._acquire(tried)
+        if hedge_backend is None:
+            return primary.result()
+        tried.append(hedge_backend)
+        with self.lock:
+            self.nb_hedged += 1
+        statsd.increment('backend_pool_hedged')
+        hedge = self.executor.submit(self._execute_one, fn, hedge_backend, race, discard)
+
+        pending = {primary, hedge}
+        last_exception = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future.result() is lost_race:
+                        continue
+                    if future is hedge:
+                        with self.lock:
+                            self.nb_hedges_won += 1
+                    return future.result()
+                last_exception = future.exception()
+        raise last_exception
+
+    # --------------------------------------------------------------------
+    # PRIVATE: HEALTH CHECKS
+
+    @staticmethod
+    def _ping(backend):
+        conn = HTTPConnection(backend.host, backend.port, timeout=2)
+        try:
+            conn.request('GET', '/ping')
+            response = conn.getresponse()
+            response.read()
+            return response.status == 204
+        except Exception:
+            return False
+        finally:
+            conn.close()
+
+    def _run_health_checks(self):
+        while True:
+            time.sleep(self.health_check_interval)
+            for backend in self.backends:
+                is_up = self._ping(backend)
+                with self.lock:
+                    if is_up:
+                        if not backend.healthy:
+                            logging.info("Backend {} is back up".format(backend.netloc))
+                        backend.healthy = True
+                        backend.nb_failures = 0
+                    else:
+                        backend.nb_failures += 1
+                        if backend.nb_failures >= self.failure_threshold and backend.healthy:
+                            logging.warning("Backend {} marked as down".format(backend.netloc))
+                            backend.healthy = False
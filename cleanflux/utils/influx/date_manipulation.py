@@ -1,8 +1,27 @@
 # coding=utf-8
 import re
-import math
-import logging
 from datetime import datetime, timedelta
+from functools import lru_cache
+
+
+# ------------------------------------------------------------------------
+# GLOBALS
+
+influx_unit_ns_factors = {
+    'ns': 1,
+    'u': 1000,
+    'µ': 1000,
+    'ms': 1000 * 1000,
+    's': 1000 * 1000 * 1000,
+    'm': 1000 * 1000 * 1000 * 60,
+    'h': 1000 * 1000 * 1000 * 60 * 60,
+    'd': 1000 * 1000 * 1000 * 60 * 60 * 24,
+    'w': 1000 * 1000 * 1000 * 60 * 60 * 24 * 7,
+}
+
+# NB: 'ms' before 'm' & 's', 'ns' before 's'
+influx_duration_part_re = re.compile(r'(\d+)(ns|u|µ|ms|s|m|h|d|w)')
+influx_duration_re = re.compile(r'(?:\d+(?:ns|u|µ|ms|s|m|h|d|w))+')
 
 
 # ------------------------------------------------------------------------
@@ -22,7 +41,9 @@ def apply_timedelta_on_now(my_timedelta):
 
 
 def timedelta_to_ns(my_timedelta):
-    return int(my_timedelta.total_seconds() * influx_unit_to_ns_factor('s'))
+    # NB: integer arithmetic, total_seconds() being a float
+    return (my_timedelta.days * 86400 + my_timedelta.seconds) * influx_unit_ns_factors['s'] \
+           + my_timedelta.microseconds * influx_unit_ns_factors['u']
 
 
 # ------------------------------------------------------------------------
@@ -30,15 +51,23 @@ def timedelta_to_ns(my_timedelta):
 
 
 def pd_timestamp_to_timestamp(pd_timestamp, precision):
-    return {
-        'ns': pd_timestamp.value,
-        'u': int(math.floor(pd_timestamp.value / 1000)),
-        'µ': int(math.floor(pd_timestamp.value / 1000)),
-        'ms': int(math.floor(pd_timestamp.value / (1000 * 1000))),
-        's': int(math.floor(pd_timestamp.value / (1000 * 1000 * 1000))),
-        'm': int(math.floor(pd_timestamp.value / (1000 * 1000 * 1000 * 60))),
-        'h': int(math.floor(pd_timestamp.value / (1000 * 1000 * 1000 * 60 * 60))),
-    }.get(precision, pd_timestamp.value)
+    return timestamp_ns_to_influx_unit(pd_timestamp.value, precision)
+
+
+def pd_index_to_timestamps(index, precision):
+    """
+    Vectorized pd_timestamp_to_timestamp(), for a whole DatetimeIndex at once
+    :return: list of int
+    """
+    if not hasattr(index, 'as_unit'):
+        return [pd_timestamp_to_timestamp(pd_timestamp, precision) for pd_timestamp in index]
+    # NB: resolution of an index is not necessarily ns
+    timestamps_ns = index.as_unit('ns').asi8
+    factor = get_precision_ns_factor(precision)
+    if factor != 1:
+        # NB: floor division, as for timestamps before epoch
+        timestamps_ns = timestamps_ns // factor
+    return timestamps_ns.tolist()
 
 
 # ------------------------------------------------------------------------
@@ -47,9 +76,12 @@ def pd_timestamp_to_timestamp(pd_timestamp, precision):
 
 def split_influx_time(interval):
     # timestamps in influx format can be suffixed by a precision
-    number = int(re.findall(r'\d+', interval)[0])
-    unit = interval.replace(str(number), '')
-    return {'number': number, 'unit': unit}
+    duration = parse_influx_duration(interval)
+    if duration is None:
+        number = int(re.findall(r'\d+', interval)[0])
+        unit = interval.replace(str(number), '')
+        return {'number': number, 'unit': unit}
+    return {'number': duration.number, 'unit': duration.unit}
 
 
 # ------------------------------------------------------------------------
@@ -57,12 +89,11 @@ def split_influx_time(interval):
 
 
 def influx_rp_duration_to_timedelta(rp_duration):
-    match = re.match(r'(?P<hours>.+?)h(?P<minutes>.+?)m(?P<seconds>.+?)s', rp_duration)
-    if not match:
+    # NB: RP durations are returned by InfluxDB as e.g. 168h0m0s, or 0s for an infinite retention
+    duration = parse_influx_duration(rp_duration)
+    if duration is None or 'h' not in rp_duration:
         return None
-    return influx_interval_to_timedelta(match.groupdict()['hours'] + 'h') \
-           + influx_interval_to_timedelta(match.groupdict()['minutes'] + 'm') \
-           + influx_interval_to_timedelta(match.groupdict()['seconds'] + 's')
+    return duration.to_timedelta()
 
 
 def datetime_max_for_influx_rp(rp_duration):
@@ -73,16 +104,60 @@ def datetime_max_for_influx_rp(rp_duration):
 # ------------------------------------------------------------------------
 # INFLUX INTERVALS
 
+class InfluxDuration(object):
+    """
+    Duration literal of InfluxQL (e.g. 10s, 1h30m, or RP durations like 168h0m0s), parsed once into nanoseconds.
+    Instances are shared between callers (see parse_influx_duration()), hence immutable.
+    """
+
+    __slots__ = ('literal', 'ns', 'number', 'unit')
+
+    def __init__(self, literal, ns, number, unit):
+        self.literal = literal
+        self.ns = ns
+        # same duration, in the finest unit of the literal, e.g. 90 & m for 1h30m (10 & s for 10s)
+        self.number = number
+        self.unit = unit
+
+    def to_timedelta(self):
+        # NB: timedelta does not support nanoseconds
+        return timedelta(microseconds=self.ns // influx_unit_ns_factors['u'])
+
+    def __repr__(self):
+        return "InfluxDuration({!r}, ns={})".format(self.literal, self.ns)
+
+
+@lru_cache(maxsize=1024)
+def parse_influx_duration(literal):
+    """
+    :param literal: e.g. 10s, 1h30m, or a bare number of nanoseconds
+    :return: InfluxDuration, None if not a valid duration
+    """
+    if literal.isascii() and literal.isdigit():
+        return InfluxDuration(literal, int(literal), int(literal), '')
+    if not influx_duration_re.fullmatch(literal):
+        return None
+    ns = 0
+    unit = None
+    for number, part_unit in influx_duration_part_re.findall(literal):
+        ns += int(number) * influx_unit_ns_factors[part_unit]
+        if unit is None or influx_unit_ns_factors[part_unit] < influx_unit_ns_factors[unit]:
+            unit = part_unit
+    return InfluxDuration(literal, ns, ns // influx_unit_ns_factors[unit], unit)
+
+
 def influx_interval_to_nanoseconds(influx_interval):
-    number = int(re.findall(r'\d+', influx_interval)[0])
-    unit = influx_interval.replace(str(number), '')
-    return number * influx_unit_to_ns_factor(unit)
+    duration = parse_influx_duration(influx_interval)
+    if duration is None or not duration.unit:
+        return None
+    return duration.ns
 
 
 def influx_interval_to_timedelta(influx_interval):
-    number = int(re.findall(r'\d+', influx_interval)[0])
-    unit = influx_interval.replace(str(number), '')
-    return influx_interval_to_timedelta_helper(number, unit)
+    duration = parse_influx_duration(influx_interval)
+    if duration is None or not duration.unit:
+        return timedelta(days=0)
+    return duration.to_timedelta()
 
 
 def influx_interval_to_timedelta_helper(number, unit):
@@ -99,6 +174,16 @@ def influx_interval_to_timedelta_helper(number, unit):
     }.get(unit, timedelta(days=0))
 
 
+def nanoseconds_to_influx_interval(ns):
+    """
+    :return: influx interval in the coarsest unit ns is a multiple of, e.g. 90m for 5400000000000
+    """
+    for unit in ('w', 'd', 'h', 'm', 's', 'ms', 'u'):
+        if ns % influx_unit_ns_factors[unit] == 0:
+            return str(ns // influx_unit_ns_factors[unit]) + unit
+    return str(ns) + 'ns'
+
+
 # ------------------------------------------------------------------------
 # INFLUX TIMESTAMPS
 
@@ -118,26 +203,19 @@ def influx_timestamp_to_datetime(timestamp):
 
 
 def influx_unit_to_ns_factor(unit):
-    return {
-        'ns': 1,
-        'u': 1000,
-        'µ': 1000,
-        'ms': 1000 * 1000,
-        's': 1000 * 1000 * 1000,
-        'm': 1000 * 1000 * 1000 * 60,
-        'h': 1000 * 1000 * 1000 * 60 * 60,
-        'd': 1000 * 1000 * 1000 * 60 * 60 * 24,
-        'w': 1000 * 1000 * 1000 * 60 * 60 * 24 * 4,
-    }.get(unit)
+    return influx_unit_ns_factors.get(unit)
+
+
+def get_precision_ns_factor(precision):
+    """
+    :param precision: value of the epoch URL param
+    :return: factor of timestamps in that precision to ns, 1 for ns & unknown precisions
+    """
+    if precision in ('d', 'w'):
+        return 1
+    return influx_unit_ns_factors.get(precision, 1)
 
 
 def timestamp_ns_to_influx_unit(number, unit):
-    return {
-        'ns': number,
-        'u': int(math.floor(number / 1000)),
-        'µ': int(math.floor(number / 1000)),
-        'ms': int(math.floor(number / (1000 * 1000))),
-        's': int(math.floor(number / (1000 * 1000 * 1000))),
-        'm': int(math.floor(number / (1000 * 1000 * 1000 * 60))),
-        'h': int(math.floor(number / (1000 * 1000 * 1000 * 60 * 60))),
-    }.get(unit, number)
+    # NB: integer floor division, float division losing precision on ns timestamps
+    return number // get_precision_ns_factor(unit)
@@ -0,0 +1,92 @@
+import logging
+import re
+import threading
+import time
+from functools import lru_cache
+
+from cleanflux.utils.influx.querying import get_measurement_list
+
+
+# ------------------------------------------------------------------------
+# MEASUREMENTS
+
+class MeasurementCatalog(object):
+    """
+    Measurements of each schema, listed from the backend holding it and kept for ttl seconds,
+    so that regexes of FROM clauses (e.g. FROM /^cpu.*/) can be resolved w/o a round-trip per query
+    """
+
+    def __init__(self, backend_user=None, backend_password=None, ttl=300):
+        """
+        :param ttl: in seconds, time after which the list of measurements of a schema gets refreshed
+        """
+        self.backend_user = backend_user
+        self.backend_password = backend_password
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (backend host, backend port, schema) -> (time of listing, list of measurements, None if listing failed)
+        self.measurements = {}
+
+    def get_measurements(self, backend_host, backend_port, schema):
+        """
+        :return: list of measurements of schema, None if they could not be listed
+        """
+        key = (backend_host, backend_port, schema)
+        with self.lock:
+            listed_at, measurements = self.measurements.get(key, (None, None))
+        if listed_at is not None and time.monotonic() - listed_at < self.ttl:
+            return measurements
+
+        # NB: listed outside of the lock, concurrent requests for the same schema possibly listing it each
+        try:
+            measurements = get_measurement_list(backend_host, backend_port,
+                                                self.backend_user, self.backend_password, schema)
+        except Exception as e:
+            # NB: failures get cached too, not to hammer an unavailable backend
+            logging.warning("Could not list measurements of {}: {}".format(schema, e))
+            measurements = None
+        with self.lock:
+            self.measurements[key] = (time.monotonic(), measurements)
+        return measurements
+
+    def resolve(self, backend_host, backend_port, schema, regexp):
+        """
+        :param regexp: InfluxQL regex, e.g. /^cpu.*/
+        :return: sorted list of measurements of schema matching regexp, None if unknown
+        """
+        pattern = compile_influx_regexp(regexp)
+        if pattern is None:
+            return None
+        measurements = self.get_measurements(backend_host, backend_port, schema)
+        if measurements is None:
+            return None
+        return sorted(measurement for measurement in measurements if pattern.search(measurement))
+
+    def get_state(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                '{}:{}/{}'.format(*key): {
+                    'nb_measurements': len(measurements) if measurements is not None else None,
+                    'age_s': round(now - listed_at, 1),
+                }
+                for key, (listed_at, measurements) in self.measurements.items()
+            }
+
+
+# ------------------------------------------------------------------------
+# HELPERS
+
+@lru_cache(maxsize=256)
+def compile_influx_regexp(regexp):
+    """
+    :param regexp: InfluxQL regex, e.g. /^cpu\/.*/
+    :return: compiled regex, None if not valid
+    NB: InfluxQL regexes are RE2 ones, which are a subset of python ones but for a few character classes
+    """
+    if len(regexp) < 2 or regexp[0] != '/' or regexp[-1] != '/':
+        return None
+    try:
+        return re.compile(regexp[1:-1].replace('\\/', '/'))
+    except re.error:
+        return None
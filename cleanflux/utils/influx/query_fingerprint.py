@@ -0,0 +1,49 @@
+import re
+import zlib
+from functools import lru_cache
+
+
+# ------------------------------------------------------------------------
+# GLOBALS
+
+# NB: identifiers & regexps are kept, literals (strings, numbers, durations, timestamps) get replaced by '?'
+fingerprint_token_re = re.compile(r'''
+    (?P<identifier>"(?:[^"\\]|\\.)*")
+  | (?P<regexp>/(?!\s)(?:[^/\\]|\\.)+/)
+  | (?P<string>'(?:[^'\\]|\\.)*')
+  | (?P<number>(?<![\w.])[-+]?\d+(?:\.\d+)?(?:e[-+]?\d+)?(?:(?:ns|u|µ|ms|s|m|h|d|w)\d*)*(?![\w.]))
+  | (?P<space>\s+)
+''', re.VERBOSE | re.IGNORECASE)
+
+# several literals in a row, e.g. compound durations or lists
+literal_list_re = re.compile(r'\?(?:\s*[-+,]?\s*\?)+')
+
+
+# ------------------------------------------------------------------------
+# FINGERPRINTS
+
+@lru_cache(maxsize=4096)
+def get_query_fingerprint(query):
+    """
+    Normalize a statement so that queries differing only by their literals (time bounds, thresholds, intervals...)
+    share a same fingerprint. Measurements & fields are kept.
+    :param query: a single statement
+    :return: normalized statement
+    """
+    def replace(match):
+        kind = match.lastgroup
+        if kind == 'space':
+            return ' '
+        if kind in ('string', 'number'):
+            return '?'
+        return match.group(0)
+
+    fingerprint = fingerprint_token_re.sub(replace, query.strip())
+    return literal_list_re.sub('?', fingerprint)
+
+
+def get_fingerprint_id(fingerprint):
+    """
+    :return: short id of a fingerprint, e.g. for tagging metrics
+    """
+    return '%08x' % zlib.crc32(fingerprint.encode())
@@ -4,6 +4,7 @@ from pprint import pprint
 
 import cleanflux.utils.influx.query_sqlparsing as influx_query_parsing
 import cleanflux.utils.influx.date_manipulation as influx_date_manipulation
+import cleanflux.utils.influx.query_time_bounds as influx_query_time_bounds
 import cleanflux.utils.influx.query_sqlparsing as query_sqlparsing
 
 
@@ -14,7 +15,9 @@ change_rp_re = re.compile(r'SELECT.*FROM (?P<measurement>.+?) .*WHERE.*')
 group_by_time_re = re.compile(r'^time\((?P<interval>.+?)\)')
 change_sum_group_by_time_factor_re = re.compile(r'^(sum|SUM)\(.*?\)(?P<factor>.*?)(( AS | as ).*)?$')
 change_sum_group_by_time_factor_with_trans_func_re = re.compile(r'^.*\((\s*)?(sum|SUM)\(.*?\),(.*)\)(?P<factor>.*?)(( AS | as ).*)?$')
-lower_time_bound_re = re.compile(r'.*WHERE.* time >=? (?P<lower_time_bound>.+?) (and|AND|GROUP)')
+raw_column_re = re.compile(r'^(?P<field>"(?:[^"\\]|\\.)+"|\w+)(\s+(as|AS)\s+(?P<alias>"(?:[^"\\]|\\.)+"|\w+))?$')
+trailing_clauses_re = re.compile(r'\s+(GROUP\s+BY|ORDER\s+BY|LIMIT|SLIMIT|OFFSET|SOFFSET|tz\()', re.IGNORECASE)
+group_by_re = re.compile(r'\sGROUP\s+BY\s+', re.IGNORECASE)
 nnd_re = re.compile(r'^(non_negative_derivative|NON_NEGATIVE_DERIVATIVE)\((?P<content>.*?)\)\s*(?P<math_n_alias>.*?)$')
 nnd_no_interval_re = re.compile(r'^(non_negative_derivative|NON_NEGATIVE_DERIVATIVE)\((?P<content>.*?),\s*(?P<interval>.+?)\s*\)\s*(?P<math_n_alias>.*?)$')
 
@@ -73,18 +76,67 @@ def change_sum_group_by_time_factor(parsed_query, factor):
     return parsed_query
 
 
+def aggregate_raw_columns(parsed_query, func):
+    """
+    Wrap each raw field of a SELECT in an aggregate function, keeping column names
+    :return: parsed_query, None if a column is not a raw field
+    """
+    columns = influx_query_parsing.extract_all_columns_in_select(parsed_query)
+    columns_token_id = influx_query_parsing.get_token_index_columns_in_select(parsed_query)
+    if not columns or columns_token_id is None:
+        return None
+
+    new_columns = []
+    for column in columns:
+        match = raw_column_re.match(column)
+        if match is None or match.group('field').strip('"').lower() == 'time':
+            return None
+        alias = match.group('alias') or '"' + match.group('field').strip('"') + '"'
+        new_columns.append(func + '(' + match.group('field') + ') AS ' + alias)
+
+    parsed_query.tokens[columns_token_id] = ', '.join(new_columns)
+    return parsed_query
+
+
+def change_from_clause(parsed_query, from_clause):
+    """
+    :param from_clause: measurement(s) to select from instead, e.g. "my_app"."1_year"./^cpu.*/
+    """
+    start, end = influx_query_parsing.get_token_range_from_clause(parsed_query)
+    parsed_query.tokens[start] = from_clause
+    for i in range(start + 1, end):
+        # NB: emptied rather than removed, so that indexes of the following tokens stay valid
+        parsed_query.tokens[i] = ''
+    return parsed_query
+
+
+def add_group_by_time(query, interval):
+    """
+    Add a GROUP BY time(interval) to a query w/o one, skipping empty intervals as a raw query would
+    """
+    group_by_time = 'time(' + interval + ')'
+    match = group_by_re.search(query)
+    if match is not None:
+        # NB: query already grouped by tags
+        query = query[:match.end()] + group_by_time + ', ' + query[match.end():]
+        match = trailing_clauses_re.search(query, match.end())
+        end = match.start() if match is not None else len(query.rstrip())
+        return query[:end] + ' fill(none)' + query[end:]
+
+    match = trailing_clauses_re.search(query)
+    end = match.start() if match is not None else len(query.rstrip())
+    return query[:end] + ' GROUP BY ' + group_by_time + ' fill(none)' + query[end:]
+
+
 def add_limit(query, limit):
     return query + ' LIMIT ' + str(limit)
 
 
 def extend_lower_time_bound(query, interval_str):
-    match = lower_time_bound_re.match(query)
-    lower_time_bound = match.groupdict()['lower_time_bound']
-    lower_time_bound = lower_time_bound + " - " + interval_str
-    lower_time_bound_start = match.start('lower_time_bound')
-    lower_time_bound_end = match.end('lower_time_bound')
-    query = query[:lower_time_bound_start] + lower_time_bound + query[lower_time_bound_end:]
-    return query
+    predicate = influx_query_time_bounds.get_time_interval(query).lower_predicate
+    if predicate is None:
+        raise ValueError("No lower time bound in query: " + query)
+    return query[:predicate.end] + " - " + interval_str + query[predicate.end:]
 
 
 def remove_non_negative_derivative(parsed, index_list=None, forced_column_name_map=None):
@@ -6,6 +6,8 @@ from datadog import statsd
 
 
 import cleanflux.utils.influx.date_manipulation as influx_date_manipulation
+import cleanflux.utils.influx.query_time_bounds as influx_query_time_bounds
+from cleanflux.utils.tracing import traced
 
 
 # https://github.com/andialbrecht/sqlparse/blob/master/examples/extract_table_names.py
@@ -18,18 +20,24 @@ import cleanflux.utils.influx.date_manipulation as influx_date_manipulation
 nnd_interval_re = re.compile(r'.*(non_negative_derivative|NON_NEGATIVE_DERIVATIVE)\(.*,\s*(?P<interval>.+?)\)\s?')
 nnd_column_name_re = re.compile(r'.*(non_negative_derivative|NON_NEGATIVE_DERIVATIVE)\((?P<aggreg_func>.*?)\((?P<content>.*?)\).*?\s*(as|AS)\s*(?P<as>.+?)$')
 lower_time_bound_re = re.compile(r'.*WHERE.* time >=? (?P<lower_time_bound>.+?) (and|AND|GROUP)')
-lower_time_bound_absolute_re = re.compile(r'SELECT.*WHERE.*time >=? (?P<from>.+?) .*')
-lower_time_bound_relative_re = re.compile(r'SELECT.*WHERE.*time >=? now\(\) - (?P<from>.+?) .*')
-
-upper_time_bound_absolute_re = re.compile(r'SELECT.*WHERE.*time <=? (?P<to>.+?) .*')
-upper_time_bound_relative_re = re.compile(r'SELECT.*WHERE.*time <=? now\(\) - (?P<to>.+?) .*')
-upper_time_bound_is_now_re = re.compile(r'SELECT.*WHERE.*time <=? now\(\) .*')
+# call of a function, e.g. sum( in SUM("value") * 2
+function_call_re = re.compile(r'([a-zA-Z_]\w*)\s*\(')
+# measurement path of a FROM clause, e.g. "my_app"."1_year"./^cpu.*/, made of quoted / unquoted identifiers & regexes
+measurement_path_re = re.compile(r'(?:"(?:[^"\\]|\\.)*"|/(?:[^/\\]|\\.)*/|[^\s,"/]+)+')
+# SHOW statement listing the measurements, series, tags or fields of a schema (but not their cardinality)
+show_listing_re = re.compile(r'^\s*SHOW\s+(?:MEASUREMENTS|SERIES|TAG\s+KEYS|TAG\s+VALUES|FIELD\s+KEYS)\b'
+                             r'(?!\s+(?:EXACT\s+)?CARDINALITY)(?P<clauses>.*)$', re.IGNORECASE | re.DOTALL)
+show_clauses_end_re = re.compile(r'\s(?:WHERE|WITH|LIMIT|OFFSET)\s', re.IGNORECASE)
+show_on_re = re.compile(r'\sON\s+(?P<schema>"(?:[^"\\]|\\.)*"|[^\s"]+)', re.IGNORECASE)
+show_from_re = re.compile(r'\sFROM\s+(?P<from>(?:"(?:[^"\\]|\\.)*"|/(?:[^/\\]|\\.)*/|[^\s,"/;]+|\s*,\s*)+)',
+                          re.IGNORECASE)
 
 
 # ------------------------------------------------------------------------
 # INITIAL PARSING
 
 @statsd.timed('timer_sqlparse_query', use_ms=True)
+@traced('parse')
 def sqlparse_query(query):
     # type: (str) -> sqlparse.sql.Statement
     parsed = sqlparse.parse(query)
@@ -136,6 +144,37 @@ def parse_function_args(func_args):
     return []
 
 
+def split_statements(query_string):
+    """
+    Split a query string on ';', ignoring the ones inside quoted strings, identifiers and regex literals
+    :param query_string: one or several statements
+    :return: list of non-empty statements
+    """
+    statements = []
+    start = 0
+    current_str_quote = None
+    escaped = False
+    for i, c in enumerate(query_string):
+        if escaped:
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif current_str_quote:
+            if c == current_str_quote:
+                current_str_quote = None
+        elif c in ['"', '\'']:
+            current_str_quote = c
+        elif c == '/' and query_string[:i].rstrip()[-2:] in ('=~', '!~'):
+            # NB: regex literals only follow =~ or !~, see query_time_bounds
+            current_str_quote = c
+        elif c == ';':
+            statements.append(query_string[start:i])
+            start = i + 1
+    statements.append(query_string[start:])
+    statements = [statement.strip() for statement in statements]
+    return [statement for statement in statements if statement]
+
+
 def parse_function_call(func_call):
     parsed = {}
     current_keyword = ''
@@ -185,6 +224,14 @@ def extract_all_columns_in_select(parsed):
             return columns
 
 
+def extract_function_names_in_select(parsed):
+    """
+    :return: names (lower case) of the functions called in SELECT, wrapped ones included, e.g. {'sum', 'derivative'}
+    """
+    columns = extract_all_columns_in_select(parsed) or []
+    return frozenset(name.lower() for column in columns for name in function_call_re.findall(column))
+
+
 def get_token_index_columns_in_select(parsed):
     for i, token in enumerate(parsed.tokens):
         if isinstance(token, sqlparse.sql.Function) \
@@ -284,9 +331,10 @@ def parse_measurement_path(schema, measurement_path):
     prev_part = None
     prev_part_delimiter = ''
     for part in parts:
-        if part[0] == '"' and part[len(part) - 1] == '"':
+        # NB: a lone delimiter opens a quoted identifier / regex, e.g. the 1rst part of /.*/
+        if len(part) > 1 and part[0] == '"' and part[len(part) - 1] == '"':
             new_parts.append(part)
-        elif part[0] == '/' and part[len(part) - 1] == '/':
+        elif len(part) > 1 and part[0] == '/' and part[len(part) - 1] == '/':
             new_parts.append(part)
         else:
             if part[0] in ['/', '"']:
@@ -314,11 +362,129 @@ def parse_measurement_path(schema, measurement_path):
         return {'schema': schema, 'rp': None, 'measurement': parts[0].replace('"', '')}
 
 
+def is_regexp_measurement(measurement):
+    return measurement is not None and len(measurement) > 1 and measurement[0] == '/' and measurement[-1] == '/'
+
+
+def get_token_range_from_clause(parsed):
+    """
+    :return: (index of the 1rst token, index following the last token) of the FROM clause, None if no FROM
+    NB: sqlparse splits regexes, e.g. /^cpu.*/, over several tokens
+    """
+    start = extract_from_helper(parsed, "index")
+    if start is None:
+        return None
+    end = start + 1
+    while end < len(parsed.tokens):
+        token = parsed.tokens[end]
+        if not isinstance(token, bytes) and not isinstance(token, str):
+            if isinstance(token, sqlparse.sql.Where):
+                break
+            # NB: keywords in a regex are not preceded by a whitespace, e.g. /^group_.*/
+            previous_token = parsed.tokens[end - 1]
+            if token.ttype in sqlparse.tokens.Keyword and hasattr(previous_token, 'ttype') \
+                    and previous_token.ttype in sqlparse.tokens.Whitespace:
+                break
+        end += 1
+    while end > start + 1 and getattr(parsed.tokens[end - 1], 'ttype', None) in sqlparse.tokens.Whitespace:
+        end -= 1
+    return start, end
+
+
+def extract_from_clause(parsed):
+    """
+    :return: measurement(s) the query selects from, e.g. "cpu", /^disk.*/, None if no FROM
+    """
+    token_range = get_token_range_from_clause(parsed)
+    if token_range is None:
+        return None
+    return ''.join(str(token) for token in parsed.tokens[token_range[0]:token_range[1]])
+
+
+def split_measurement_paths(from_clause):
+    """
+    :return: list of measurement paths of a FROM clause, e.g. ['"cpu"', '"my_app"./^disk.*/']
+    """
+    return measurement_path_re.findall(from_clause)
+
+
+def extract_measurements_from_query(schema, parsed):
+    """
+    :return: list of from_parts (see parse_measurement_path()), one per measurement path of the FROM clause,
+             None if no FROM or FROM a subquery
+    """
+    from_clause = extract_from_clause(parsed)
+    if not from_clause or from_clause.startswith('('):
+        # NB: subquery, see extract_subquery()
+        return None
+    from_parts_list = []
+    for measurement_path in split_measurement_paths(from_clause):
+        from_parts = parse_measurement_path(schema, measurement_path)
+        if from_parts is None:
+            return None
+        from_parts_list.append(from_parts)
+    return from_parts_list or None
+
+
 def extract_measurement_from_query(schema, parsed):
-    measurement_path = extract_from_helper(parsed, "value")
-    if not measurement_path:
+    """
+    :return: from_parts (see parse_measurement_path()), None if the query does not select from a single measurement
+             path, see extract_measurements_from_query()
+    """
+    from_parts_list = extract_measurements_from_query(schema, parsed)
+    if from_parts_list is None or len(from_parts_list) != 1:
+        return None
+    return from_parts_list[0]
+
+
+def is_multi_measurement_query(from_parts_list):
+    """
+    :param from_parts_list: as returned by extract_measurements_from_query()
+    :return: whether the query selects from several measurements, or from measurements matching regexes
+    """
+    return len(from_parts_list) > 1 or is_regexp_measurement(from_parts_list[0]['measurement'])
+
+
+def extract_subquery(parsed):
+    """
+    :return: statement the query selects from, w/o its parentheses, None if it selects from a measurement
+    """
+    from_id = extract_from_helper(parsed, "index")
+    if from_id is None:
         return None
-    return parse_measurement_path(schema, measurement_path)
+    token = parsed.tokens[from_id]
+    if isinstance(token, bytes) or isinstance(token, str) or not is_subselect(token):
+        return None
+    return token.value[1:-1].strip()
+
+
+# ------------------------------------------------------------------------
+# SHOW
+
+def extract_measurements_from_show(schema, query):
+    """
+    :param schema: schema of the request, overridden by the ON clause, if any
+    :return: (schema, list of from_parts of the FROM clause, None if no FROM) of a SHOW statement listing
+             measurements, series, tags or fields, None if query is not such a statement
+    """
+    match = show_listing_re.match(query)
+    if match is None:
+        return None
+    # NB: WHERE & WITH clauses may hold anything, e.g. a string w/ FROM in it
+    clauses = show_clauses_end_re.split(match.group('clauses'), 1)[0]
+    on_match = show_on_re.search(clauses)
+    if on_match is not None:
+        schema = on_match.group('schema').replace('"', '')
+    from_match = show_from_re.search(clauses)
+    if from_match is None:
+        return schema, None
+    from_parts_list = []
+    for measurement_path in split_measurement_paths(from_match.group('from')):
+        from_parts = parse_measurement_path(schema, measurement_path)
+        if from_parts is None:
+            return schema, None
+        from_parts_list.append(from_parts)
+    return schema, from_parts_list or None
 
 
 # ------------------------------------------------------------------------
@@ -406,6 +572,8 @@ def is_grouped_by_time(parsed):
 
 def extract_time_interval_group_by(parsed):
     group_by_list = extract_group_by(parsed)
+    if not group_by_list:
+        return None
     group_by_time = [group_cond for group_cond in group_by_list if group_cond.startswith('time(')]
     if not group_by_time:
         return None
@@ -504,11 +672,9 @@ def has_transformation_func_around_sum(parsed):
 # TIME BOUNDS
 
 def is_lower_time_bound_parsable(query):
-    match = lower_time_bound_re.match(query)
-    if match:
-        return True
-    else:
-        return False
+    # NB: query string or sqlparsed query
+    interval = influx_query_time_bounds.get_time_interval(str(query))
+    return interval.lower_predicate is not None
 
 
 def extract_lower_time_bound_old(query):
@@ -518,41 +684,25 @@ def extract_lower_time_bound_old(query):
 
 
 def extract_lower_time_bound(query):
-    from_time = None
-    match_from_interval = lower_time_bound_relative_re.match(query)
-    if match_from_interval:
-        from_time_interval = match_from_interval.groupdict()['from']
-        from_timedelta = influx_date_manipulation.influx_interval_to_timedelta(from_time_interval)
-        from_time = influx_date_manipulation.apply_timedelta_on_now(-1 * from_timedelta)
-    else:
-        match_from = lower_time_bound_absolute_re.match(query)
-        if match_from:
-            from_time = match_from.groupdict()['from']
-            from_time = influx_date_manipulation.influx_timestamp_to_datetime(from_time)
-    return from_time
+    return extract_time_window_bounds(query)['from']
 
 
 def extract_upper_time_bound(query):
-    to_time = None
-    match_to_interval = upper_time_bound_relative_re.match(query)
-    match_to_interval_2 = upper_time_bound_is_now_re.match(query)
-    if match_to_interval:
-        to_time_interval = match_to_interval.groupdict()['to']
-        to_timedelta = influx_date_manipulation.influx_interval_to_timedelta(to_time_interval)
-        to_time = influx_date_manipulation.apply_timedelta_on_now(-1 * to_timedelta)
-    elif match_to_interval_2:
-        return None
-    else:
-        match_to = upper_time_bound_absolute_re.match(query)
-        if match_to:
-            to_time = match_to.groupdict()['to']
-            to_time = influx_date_manipulation.influx_timestamp_to_datetime(to_time)
-    return to_time
+    return extract_time_window_bounds(query)['to']
 
 
 def extract_time_window_bounds(query):
-    from_time = extract_lower_time_bound(query)
-    to_time = extract_upper_time_bound(query)
+    """
+    :return: dict w/ from & to datetimes, None if unbounded (or bounded by now() for to)
+    """
+    interval = influx_query_time_bounds.get_time_interval(query)
+    from_time = None
+    if interval.lower_ns is not None:
+        from_time = influx_query_time_bounds.ns_to_datetime(interval.lower_ns)
+    to_time = None
+    if interval.upper_ns is not None \
+            and not (interval.upper_predicate.is_relative and interval.upper_predicate.ns == 0):
+        to_time = influx_query_time_bounds.ns_to_datetime(interval.upper_ns)
     return {'from': from_time, 'to': to_time}
 
 
@@ -0,0 +1,172 @@
+import logging
+import threading
+import time
+from datadog import statsd
+
+from cleanflux.utils.influx.query_fingerprint import get_query_fingerprint, get_fingerprint_id
+
+
+# ------------------------------------------------------------------------
+# ENTRIES
+
+class QueryStatsEntry(object):
+    """
+    Cumulated cost of the statements sharing a fingerprint
+    """
+
+    __slots__ = ('fingerprint', 'id', 'count', 'error', 'backend_ms', 'nb_rows', 'nb_bytes',
+                 'flushed_count', 'flushed_backend_ms', 'flushed_nb_rows', 'flushed_nb_bytes')
+
+    def __init__(self, fingerprint, count=0, error=0):
+        self.fingerprint = fingerprint
+        self.id = get_fingerprint_id(fingerprint)
+        # NB: count is an upper bound, the actual count being at least count - error
+        self.count = count
+        self.error = error
+        self.backend_ms = 0.0
+        self.nb_rows = 0
+        self.nb_bytes = 0
+        # values at last flush to statsd
+        self.flushed_count = count
+        self.flushed_backend_ms = 0.0
+        self.flushed_nb_rows = 0
+        self.flushed_nb_bytes = 0
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'fingerprint': self.fingerprint,
+            'count': self.count,
+            'count_error': self.error,
+            'backend_ms': round(self.backend_ms, 3),
+            'nb_rows': self.nb_rows,
+            'nb_bytes': self.nb_bytes,
+        }
+
+
+# ------------------------------------------------------------------------
+# TOP-N
+
+class QueryStats(object):
+    """
+    Top-N query fingerprints, tracked w/ the space-saving algorithm: at most capacity fingerprints are kept,
+    a new one replacing the least frequent and inheriting its count.
+    """
+
+    sort_keys = ('count', 'backend_ms', 'nb_rows', 'nb_bytes')
+
+    def __init__(self, capacity=200, flush_interval=60, flush_top_n=20):
+        """
+        :param flush_interval: in seconds, interval at which top fingerprints get sent to statsd, 0 to disable
+        :param flush_top_n: nb of fingerprints (most expensive in backend time) sent to statsd
+        """
+        self.capacity = capacity
+        self.flush_top_n = flush_top_n
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.nb_evictions = 0
+
+        if flush_interval:
+            flusher = threading.Thread(target=self._run_flusher, name='query-stats')
+            flusher.daemon = True
+            flusher.start()
+
+    # --------------------------------------------------------------------
+    # PUBLIC
+
+    def record(self, queries, backend_ms, nb_bytes, nb_rows_list=None):
+        """
+        Account for the statements of a request. Backend time & bytes are spread evenly over statements.
+        :param queries: statements of the request
+        :param nb_rows_list: nb of rows returned by each statement, if known
+        """
+        if not queries:
+            return
+        fingerprints = [get_query_fingerprint(query) for query in queries]
+        share = 1.0 / len(fingerprints)
+        with self.lock:
+            for i, fingerprint in enumerate(fingerprints):
+                entry = self._get_entry(fingerprint)
+                entry.count += 1
+                entry.backend_ms += backend_ms * share
+                entry.nb_bytes += int(nb_bytes * share)
+                if nb_rows_list is not None and i < len(nb_rows_list):
+                    entry.nb_rows += nb_rows_list[i]
+
+    def get_top(self, n=None, sort_key='count'):
+        """
+        :return: list of entries as dicts, most expensive first
+        """
+        if sort_key not in self.sort_keys:
+            sort_key = 'count'
+        with self.lock:
+            entries = sorted(self.entries.values(), key=lambda e: getattr(e, sort_key), reverse=True)
+            return [entry.to_dict() for entry in entries[:n]]
+
+    def get_state(self):
+        with self.lock:
+            return {'nb_fingerprints': len(self.entries), 'capacity': self.capacity,
+                    'nb_evictions': self.nb_evictions}
+
+    # --------------------------------------------------------------------
+    # PRIVATE
+
+    def _get_entry(self, fingerprint):
+        # NB: must be called with self.lock held
+        entry = self.entries.get(fingerprint)
+        if entry is not None:
+            return entry
+        if len(self.entries) < self.capacity:
+            entry = self.entries[fingerprint] = QueryStatsEntry(fingerprint)
+            return entry
+        evicted = min(self.entries.values(), key=lambda e: e.count)
+        del self.entries[evicted.fingerprint]
+        self.nb_evictions += 1
+        entry = self.entries[fingerprint] = QueryStatsEntry(fingerprint, evicted.count, evicted.count)
+        return entry
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error("Could not flush query stats: {}".format(e))
+
+    def flush(self):
+        """
+        Send what top fingerprints cost since last flush to statsd
+        """
+        with self.lock:
+            entries = sorted(self.entries.values(), key=lambda e: e.backend_ms - e.flushed_backend_ms, reverse=True)
+            deltas = []
+            for entry in entries[:self.flush_top_n]:
+                deltas.append((entry.id, entry.count - entry.flushed_count, entry.backend_ms - entry.flushed_backend_ms,
+                               entry.nb_rows - entry.flushed_nb_rows, entry.nb_bytes - entry.flushed_nb_bytes))
+                entry.flushed_count = entry.count
+                entry.flushed_backend_ms = entry.backend_ms
+                entry.flushed_nb_rows = entry.nb_rows
+                entry.flushed_nb_bytes = entry.nb_bytes
+
+        for fingerprint_id, count, backend_ms, nb_rows, nb_bytes in deltas:
+            if not count:
+                continue
+            tags = ['fingerprint:' + fingerprint_id]
+            statsd.increment('query_fingerprint_count', count, tags=tags)
+            statsd.increment('query_fingerprint_backend_ms', int(backend_ms), tags=tags)
+            statsd.increment('query_fingerprint_rows', nb_rows, tags=tags)
+            statsd.increment('query_fingerprint_bytes', nb_bytes, tags=tags)
+
+
+# ------------------------------------------------------------------------
+# HELPERS
+
+def get_nb_rows(result):
+    """
+    :param result: pandas result of a statement, i.e. dict of series -> DataFrame
+    :return: nb of rows returned, 0 if unknown
+    """
+    if not isinstance(result, dict):
+        return 0
+    return sum(len(df) for df in result.values())
@@ -0,0 +1,337 @@
+import re
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from cleanflux.utils.influx.date_manipulation import parse_influx_duration
+
+
+# ------------------------------------------------------------------------
+# GLOBALS
+
+# NB: alternatives tried in order at each position, none of them backtracking over more than a token.
+#     Regex literals only follow =~ or !~ in a WHERE clause, hence a single token w/ their operator
+token_re = re.compile(r'''\s*(?:
+    (?P<string>'[^'\\]*(?:\\.[^'\\]*)*')
+  | (?P<ident>"[^"\\]*(?:\\.[^"\\]*)*")
+  | (?P<duration>(?:\d+(?:ns|u|µ|ms|s|m|h|d|w))+(?![\w.]))
+  | (?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?)
+  | (?P<word>[A-Za-z_][\w.]*)
+  | (?P<regex>[=!]~\s*/[^/\\]*(?:\\.[^/\\]*)*/)
+  | (?P<op>>=|<=|!=|<>|=~|!~|=|<|>)
+  | (?P<char>\S)
+)''', re.VERBOSE)
+
+# NB: everything up to the WHERE keyword of the outer statement, matched in a single pass: quoted strings & identifiers
+#     may hide a WHERE keyword, parentheses (subqueries, regexes, function calls) nest them, up to max_paren_depth.
+#     Alternatives start w/ distinct characters, so that the match never backtracks, whatever the length of the query
+max_paren_depth = 4
+quoted_pattern = r'''"[^"\\]*(?:\\.[^"\\]*)*"|'[^'\\]*(?:\\.[^'\\]*)*\''''
+
+
+def get_paren_pattern(depth):
+    pattern = r'''\((?:[^'"()]|{})*\)'''.format(quoted_pattern)
+    for _ in range(depth - 1):
+        pattern = r'''\((?:[^'"()]|{}|{})*\)'''.format(quoted_pattern, pattern)
+    return pattern
+
+
+before_where_re = re.compile(r'''(?:[^'"()Ww]+|{}|{}|\B[Ww]|[Ww](?!(?i:HERE)\b))*'''.format(
+    quoted_pattern, get_paren_pattern(max_paren_depth)))
+
+# clauses ending the WHERE clause
+where_end_keywords = ('GROUP', 'ORDER', 'LIMIT', 'SLIMIT', 'OFFSET', 'SOFFSET', 'FILL', 'TZ', 'INTO')
+comparison_ops = ('>', '>=', '<', '<=', '=')
+reversed_ops = {'>': '<', '>=': '<=', '<': '>', '<=': '>=', '=': '='}
+
+rfc3339_re = re.compile(r'(?P<date>\d{4}-\d{2}-\d{2})(?:[T ](?P<time>\d{2}:\d{2}(?::\d{2})?)(?:\.(?P<fraction>\d+))?)?'
+                        r'(?P<tz>Z|[+-]\d{2}:\d{2})?$')
+
+
+# ------------------------------------------------------------------------
+# TIME PREDICATES & INTERVAL
+
+class TimePredicate(object):
+    """
+    Comparison of time against an epoch / RFC3339 literal or now(), plus or minus durations, e.g. time >= now() - 1h
+    """
+
+    __slots__ = ('op', 'is_relative', 'ns', 'start', 'end')
+
+    def __init__(self, op, is_relative, ns, start, end):
+        """
+        :param op: comparison operator, w/ time on its left side
+        :param is_relative: True if relative to now()
+        :param ns: value in ns, since epoch or relative to now()
+        :param start: position of the compared expression in the query
+        :param end: position of the end of the compared expression in the query
+        """
+        self.op = op
+        self.is_relative = is_relative
+        self.ns = ns
+        self.start = start
+        self.end = end
+
+    def resolve(self, now_ns):
+        return now_ns + self.ns if self.is_relative else self.ns
+
+    def is_lower_bound(self):
+        return self.op in ('>', '>=', '=')
+
+    def is_upper_bound(self):
+        return self.op in ('<', '<=', '=')
+
+    def __repr__(self):
+        return "TimePredicate(time {} {}{})".format(self.op, 'now() + ' if self.is_relative else '', self.ns)
+
+
+class TimeInterval(object):
+    """
+    Time interval a query is restricted to, bounds in ns since epoch, None if unbounded
+    """
+
+    __slots__ = ('lower_ns', 'lower_inclusive', 'upper_ns', 'upper_inclusive', 'lower_predicate', 'upper_predicate')
+
+    def __init__(self, predicates, now_ns):
+        """
+        :param predicates: list of TimePredicate, ANDed
+        """
+        self.lower_ns = None
+        self.lower_inclusive = True
+        self.upper_ns = None
+        self.upper_inclusive = True
+        # predicates the bounds come from
+        self.lower_predicate = None
+        self.upper_predicate = None
+        for predicate in predicates:
+            ns = predicate.resolve(now_ns)
+            if predicate.is_lower_bound() and (self.lower_ns is None or ns > self.lower_ns):
+                self.lower_ns = ns
+                self.lower_inclusive = predicate.op != '>'
+                self.lower_predicate = predicate
+            if predicate.is_upper_bound() and (self.upper_ns is None or ns < self.upper_ns):
+                self.upper_ns = ns
+                self.upper_inclusive = predicate.op != '<'
+                self.upper_predicate = predicate
+
+    def get_duration_ns(self, now_ns):
+        """
+        :return: None if not lower bounded, upper bound defaulting to now
+        """
+        if self.lower_ns is None:
+            return None
+        return (self.upper_ns if self.upper_ns is not None else now_ns) - self.lower_ns
+
+    def __repr__(self):
+        return "TimeInterval({}{}, {}{})".format('[' if self.lower_inclusive else ']', self.lower_ns,
+                                                 self.upper_ns, ']' if self.upper_inclusive else '[')
+
+
+def get_time_interval(query, now_ns=None):
+    """
+    :param now_ns: ns since epoch now() gets resolved to, defaults to the current time
+    :return: TimeInterval
+    """
+    if now_ns is None:
+        now_ns = time.time_ns()
+    return TimeInterval(get_time_predicates(query), now_ns)
+
+
+def ns_to_datetime(ns):
+    """
+    :return: naive datetime in local time, like datetime.now()
+    """
+    return datetime.fromtimestamp(ns / 1e9)
+
+
+# ------------------------------------------------------------------------
+# ANALYSIS
+
+@lru_cache(maxsize=1024)
+def get_time_predicates(query):
+    """
+    Time predicates of the WHERE clause of the (outer) SELECT statement, in a single scan of the query.
+    Predicates that do not bound the whole statement (e.g. ORed w/ other conditions) are left out.
+    NB: independent of the current time, hence cached
+    :return: tuple of TimePredicate
+    """
+    if 'time' not in query.lower():
+        return ()
+    where_start = find_where_clause(query)
+    if where_start is None:
+        return ()
+    where_tokens = tokenize_where_clause(query, where_start)
+    if not where_tokens:
+        return ()
+    return tuple(parse_time_predicates(where_tokens))
+
+
+def find_where_clause(query):
+    """
+    :return: position following the WHERE keyword of the outer statement, None if none
+    NB: WHERE clauses of subqueries (in parentheses) are skipped
+    """
+    end = before_where_re.match(query).end()
+    if query[end:end + 5].upper() != 'WHERE':
+        return None
+    return end + 5
+
+
+def tokenize_where_clause(query, start):
+    """
+    :param start: position following the WHERE keyword
+    :return: list of (kind, value, start, end) of the WHERE clause, w/o whitespaces
+    """
+    tokens = []
+    depth = 0
+    # NB: no match on trailing whitespaces only
+    for match in token_re.finditer(query, start):
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'char':
+            if value == '(':
+                depth += 1
+            elif value == ')':
+                depth -= 1
+            elif value == ';' and depth == 0:
+                break
+        elif kind == 'word' and depth == 0 and value.upper() in where_end_keywords:
+            break
+        tokens.append((kind, value, match.start(kind), match.end()))
+    return tokens
+
+
+def is_time_token(token):
+    kind, value = token[0], token[1]
+    return (kind == 'word' and value.lower() == 'time') or (kind == 'ident' and value == '"time"')
+
+
+def parse_time_predicates(tokens):
+    """
+    :param tokens: tokens of a WHERE clause
+    :return: list of TimePredicate bounding the whole clause
+    """
+    # NB: one group per parenthesis level, whose predicates get dropped if ORed w/ other conditions
+    groups = [{'has_or': False, 'predicates': []}]
+    predicate_start = 0
+    i = 0
+    while i < len(tokens):
+        kind, value = tokens[i][0], tokens[i][1]
+        if kind == 'char' and value == '(' and i > 0 and tokens[i - 1][0] == 'word' \
+                and tokens[i - 1][1].upper() not in ('AND', 'OR', 'NOT'):
+            # NB: arguments of a function call, e.g. now()
+            i = get_expression_end(tokens, i + 1) + 1
+            continue
+        elif kind == 'char' and value == '(':
+            groups.append({'has_or': False, 'predicates': []})
+            predicate_start = i + 1
+        elif kind == 'char' and value == ')':
+            if len(groups) > 1:
+                group = groups.pop()
+                if not group['has_or']:
+                    groups[-1]['predicates'].extend(group['predicates'])
+        elif kind == 'word' and value.upper() in ('AND', 'OR'):
+            if value.upper() == 'OR':
+                groups[-1]['has_or'] = True
+            predicate_start = i + 1
+        elif kind == 'op' and value in comparison_ops:
+            if i > 0 and is_time_token(tokens[i - 1]):
+                end = get_expression_end(tokens, i + 1)
+                predicate = parse_time_expression(tokens[i + 1:end], value)
+                if predicate is not None:
+                    groups[-1]['predicates'].append(predicate)
+                i = end
+                continue
+            if i + 1 < len(tokens) and is_time_token(tokens[i + 1]):
+                predicate = parse_time_expression(tokens[predicate_start:i], reversed_ops[value])
+                if predicate is not None:
+                    groups[-1]['predicates'].append(predicate)
+                i += 2
+                continue
+        i += 1
+    root = groups[0]
+    return [] if root['has_or'] else root['predicates']
+
+
+def get_expression_end(tokens, start):
+    """
+    :return: index of the token following the expression starting at start
+    """
+    depth = 0
+    for i in range(start, len(tokens)):
+        kind, value = tokens[i][0], tokens[i][1]
+        if kind == 'char' and value == '(':
+            depth += 1
+        elif kind == 'char' and value == ')':
+            if depth == 0:
+                return i
+            depth -= 1
+        elif kind == 'word' and depth == 0 and value.upper() in ('AND', 'OR'):
+            return i
+    return len(tokens)
+
+
+def parse_time_expression(tokens, op):
+    """
+    :param tokens: e.g. now() - 1h, '2024-01-01T00:00:00Z' + 6m or 1500000000000ms
+    :param op: comparison operator, w/ time on its left side
+    :return: TimePredicate, None if not a supported expression
+    """
+    if not tokens:
+        return None
+    is_relative = False
+    ns = 0
+    sign = 1
+    expect_term = True
+    i = 0
+    while i < len(tokens):
+        kind, value = tokens[i][0], tokens[i][1]
+        if not expect_term:
+            if kind != 'char' or value not in ('+', '-'):
+                return None
+            sign = 1 if value == '+' else -1
+            expect_term = True
+            i += 1
+            continue
+        if kind == 'word' and value.lower() == 'now' and i + 2 < len(tokens) \
+                and tokens[i + 1][1] == '(' and tokens[i + 2][1] == ')':
+            if is_relative or sign < 0:
+                return None
+            is_relative = True
+            i += 3
+        elif kind == 'duration':
+            ns += sign * parse_influx_duration(value).ns
+            i += 1
+        elif kind == 'number' and value.isdigit():
+            ns += sign * int(value)
+            i += 1
+        elif kind == 'string':
+            term_ns = rfc3339_to_ns(value[1:-1])
+            if term_ns is None:
+                return None
+            ns += sign * term_ns
+            i += 1
+        else:
+            return None
+        expect_term = False
+    if expect_term:
+        return None
+    return TimePredicate(op, is_relative, ns, tokens[0][2], tokens[-1][3])
+
+
+def rfc3339_to_ns(literal):
+    """
+    :param literal: e.g. 2024-01-01T00:00:00Z, 2024-01-01 00:00:00.123456789 or 2024-01-01, UTC if no offset
+    :return: ns since epoch, None if not a valid date
+    """
+    match = rfc3339_re.match(literal)
+    if not match:
+        return None
+    parts = match.groupdict()
+    tz = parts['tz'] if parts['tz'] and parts['tz'] != 'Z' else '+00:00'
+    try:
+        dt = datetime.fromisoformat('{}T{}{}'.format(parts['date'], parts['time'] or '00:00', tz))
+    except ValueError:
+        return None
+    seconds = (dt - datetime(1970, 1, 1, tzinfo=timezone.utc)) // datetime.resolution // 1000000
+    return seconds * 1000 * 1000 * 1000 + int((parts['fraction'] or '0')[:9].ljust(9, '0'))
@@ -1,5 +1,4 @@
 import logging
-import numpy as np
 import json
 import requests
 from pprint import pprint
@@ -9,14 +8,16 @@ import influxdb
 from datadog import statsd
 
 
-from cleanflux.utils.influx.date_manipulation import pd_timestamp_to_timestamp
-from cleanflux.utils.influx.query_sqlparsing import sqlparse_query, get_cq_schema, get_cq_interval, get_cq_from, get_cq_into, parse_measurement_path
+from cleanflux.utils.influx.backend_pool import get_read_pool
+from cleanflux.utils.tracing import traced
+from cleanflux.utils.influx.query_sqlparsing import sqlparse_query, get_cq_schema, get_cq_interval, get_cq_from, get_cq_into, parse_measurement_path, is_regexp_measurement
 
 
 # ------------------------------------------------------------------------
 # LIB PATCHING
 
 def robustify_influxdb_client():
+    @traced('backend')
     def custom_request(self, url, method='GET', params=None, data=None,
                 expected_response_code=200, headers=None):
         """Make a HTTP request to the InfluxDB API.
@@ -41,8 +42,6 @@ def robustify_influxdb_client():
         :raises InfluxDBClientError: if the response code is not the
             same as `expected_response_code` and is not a server error code
         """
-        url = "{0}/{1}".format(self._baseurl, url)
-
         if headers is None:
             headers = self._headers
 
@@ -52,6 +51,38 @@ def robustify_influxdb_client():
         if isinstance(data, (dict, list)):
             data = json.dumps(data)
 
+        # reads get spread over replicas, if any
+        read_pool = None
+        if method == 'GET' and url == 'query':
+            read_pool = get_read_pool(self._host, self._port)
+        if read_pool is not None:
+            def request_backend(backend):
+                # NB: attempts run concurrently in the threads of the pool, so each one gets a session of its own
+                with requests.Session() as session:
+                    backend_response = session.request(
+                        method=method,
+                        url="{0}://{1}/{2}".format(self._scheme, backend.netloc, url),
+                        auth=(self._username, self._password),
+                        params=params,
+                        data=data,
+                        headers=headers,
+                        proxies=self._proxies,
+                        verify=self._verify_ssl,
+                        timeout=self._timeout
+                    )
+                if 500 <= backend_response.status_code < 600:
+                    raise InfluxDBServerError(backend_response.content)
+                return backend_response
+
+            def discard_response(backend, backend_response):
+                backend_response.close()
+            response = read_pool.execute(request_backend, discard_response)
+            if response.status_code == expected_response_code:
+                return response
+            raise InfluxDBClientError(response.content, response.status_code)
+
+        url = "{0}/{1}".format(self._baseurl, url)
+
         # Try to send the request more than once by default (see #103)
         retry = True
         _try = 0
@@ -92,25 +123,11 @@ def robustify_influxdb_client():
     setattr(influxdb.InfluxDBClient, 'request', custom_request)
 
 
-# ------------------------------------------------------------------------
-# NUMPY DATA ENCODER
-
-class NpEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
-        else:
-            return super(NpEncoder, self).default(obj)
-
-
 # ------------------------------------------------------------------------
 # QUERYING: pandas FORMAT
 
 @statsd.timed('timer_pd_query_influxdb', use_ms=True)
+@traced('decode')
 def pd_query(backend_host, backend_port, user, password, schema, query):
     pd_influx_client = DataFrameClient(backend_host, backend_port, user, password, schema)
     result_df_dict = pd_influx_client.query(query)  # returns a dict, "<measurement>" => DataFrame
@@ -118,7 +135,7 @@ def pd_query(backend_host, backend_port, user, password, schema, query):
 
 
 @statsd.timed('timer_rp_auto_detect', use_ms=True)
-def get_rp_list(backend_host, backend_port, user, password, schema_list=[]):
+def get_rp_list(backend_host, backend_port, user, password, schema_list=[], rollup_catalog=None):
     # influx_client = InfluxDBClient(backend_host, backend_port, user, password)
 
     pd_influx_client = DataFrameClient(backend_host, backend_port, user, password)
@@ -142,20 +159,23 @@ def get_rp_list(backend_host, backend_port, user, password, schema_list=[]):
             into = parse_measurement_path(schema, get_cq_into(parsed_cq))
             if into['measurement'] != ':MEASUREMENT' \
                and into['measurement'] != from_m['measurement']:
-                # NB: if insertion in another measurement, skip
+                # NB: if insertion in another measurement, it is a rollup rather than a downsampling RP
+                if rollup_catalog is not None:
+                    rollup_catalog.add_from_cq(schema, parsed_cq)
                 continue
             into_rp = into['rp']
             cq_into_rp_set.add(from_m['rp'])
             cq_into_rp_set.add(into_rp)
-            rp_conf_raw = next([rp, i] for i, rp in enumerate(rp_list) if rp['name'] == into_rp)
-            if not rp_conf_raw:
-                continue
-            rp_conf, rp_conf_i = rp_conf_raw
-            if 'interval' in rp_conf:
-                # NB: we assumme all CQ for all measurements with a same INTO RP use the same GROUP BY time interval
-                # this is a strong and limitative assumption
+            rp_conf = next((rp for rp in rp_list if rp['name'] == into_rp), None)
+            if rp_conf is None:
                 continue
-            rp_list[rp_conf_i]['interval'] = get_cq_interval(parsed_cq)
+            interval = get_cq_interval(parsed_cq)
+            if not is_regexp_measurement(from_m['measurement']):
+                # NB: measurements of a same RP can be downsampled at different intervals
+                rp_conf.setdefault('measurement_intervals', {})[from_m['measurement']] = interval
+            if 'interval' not in rp_conf:
+                # NB: first CQ interval is used as a fallback for measurements w/o a CQ of their own
+                rp_conf['interval'] = interval
 
         # remove RPs from rp_dict that don't match a CQ
         active_rp_list = []
@@ -167,52 +187,15 @@ def get_rp_list(backend_host, backend_port, user, password, schema_list=[]):
     return rp_dict
 
 
+@statsd.timed('timer_get_measurement_list', use_ms=True)
+def get_measurement_list(backend_host, backend_port, user, password, schema):
+    influx_client = InfluxDBClient(backend_host, backend_port, user, password, schema)
+    result = influx_client.query('SHOW MEASUREMENTS')
+    return [e['name'] for e in result.get_points(measurement='measurements')]
+
+
 def get_nb_series_in_pd_result(resultset_list):
     nb_series = 0
     for resultset in resultset_list:
         nb_series += len(resultset)
     return nb_series
-
-
-def pd_result_to_influx_result(resultset_list, precision):
-    output_dict = {
-        'results': []
-    }
-
-    for resultset in resultset_list:
-        query_dict = {
-            'series': []
-        }
-        for series in resultset:
-            tags = {}
-            if isinstance(series, tuple):
-                measurement = series[0]
-                for raw_tag in series[1]:
-                    tags[raw_tag[0]] = raw_tag[1]
-            else:
-                measurement = series
-
-            df = resultset[series]
-            columns = df.columns.values.tolist()
-            all_columns = ['time'] + columns
-            series_dict = {
-                'name': measurement,
-                'columns': all_columns,
-                'values': []
-            }
-            if tags:
-                series_dict['tags'] = tags
-            for index, row in df.iterrows():
-                # TODO: should change precision according to param epoch (ns, ms ...)
-                row_values = [pd_timestamp_to_timestamp(index, precision)]
-                for column in columns:
-                    value = row[column]
-                    if np.isnan(value):
-                        value = None
-                    row_values.append(value)
-                    # logging.debug("dump {0} -> {1}".format(index.value, row[column]))
-                    series_dict['values'].append(row_values)
-            query_dict['series'].append(series_dict)
-        output_dict['results'].append(query_dict)
-
-    return json.dumps(output_dict, cls=NpEncoder)
@@ -0,0 +1,322 @@
+import csv
+import io
+import itertools
+import json
+import logging
+import math
+import numpy as np
+
+from cleanflux.utils.influx.date_manipulation import pd_index_to_timestamps
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# ------------------------------------------------------------------------
+# NUMPY DATA ENCODER
+
+class NpEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, np.integer):
+            return int(obj)
+        elif isinstance(obj, np.floating):
+            return float(obj)
+        elif isinstance(obj, np.ndarray):
+            return obj.tolist()
+        else:
+            return super(NpEncoder, self).default(obj)
+
+
+# ------------------------------------------------------------------------
+# pandas -> InfluxDB RESULTS
+
+# same default as InfluxDB
+default_chunk_size = 10000
+
+
+def parse_pd_series_key(series):
+    """
+    :param series: key of the series in a pandas result (measurement or (measurement, tags) tuple)
+    :return: measurement, dict of tags
+    """
+    tags = {}
+    if isinstance(series, tuple):
+        measurement = series[0]
+        for raw_tag in series[1]:
+            tags[raw_tag[0]] = raw_tag[1]
+    else:
+        measurement = series
+    return measurement, tags
+
+
+def iter_pd_series_rows(df, precision):
+    """
+    :param df: DataFrame of a series
+    :param precision: value of the epoch URL param
+    :return: generator of rows, time first
+    """
+    # NB: timestamps of the whole series converted at once
+    timestamps = pd_index_to_timestamps(df.index, precision)
+    for timestamp, row in zip(timestamps, df.itertuples(index=False, name=None)):
+        row_values = [timestamp]
+        for value in row:
+            if isinstance(value, float) and math.isnan(value):
+                value = None
+            row_values.append(value)
+        yield row_values
+
+
+def iter_pd_series_row_chunks(df, precision, chunk_size):
+    """
+    :return: generator of lists of at most chunk_size rows, at least one (possibly empty) list
+    """
+    rows = iter_pd_series_rows(df, precision)
+    chunk = list(itertools.islice(rows, chunk_size))
+    yield chunk
+    while len(chunk) == chunk_size:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def iter_with_is_last(iterable):
+    """
+    :return: generator of (item, is_last_item)
+    """
+    iterator = iter(iterable)
+    try:
+        prev = next(iterator)
+    except StopIteration:
+        return
+    for item in iterator:
+        yield prev, False
+        prev = item
+    yield prev, True
+
+
+def get_series_header(series, df):
+    measurement, tags = parse_pd_series_key(series)
+    series_dict = {
+        'name': measurement,
+        'columns': ['time'] + df.columns.values.tolist(),
+    }
+    if tags:
+        series_dict['tags'] = tags
+    return series_dict
+
+
+def iter_influx_result_chunks(resultset_list, precision, chunk_size):
+    """
+    Split results the way InfluxDB does when asked for chunked=true.
+    Each chunk holds up to chunk_size points of a single series, flagged as partial if followed by
+    points of the same series (for the series) or by points of the same statement (for the statement).
+    :return: generator of result dicts, each being a whole response of its own
+    """
+    for statement_id, resultset in enumerate(resultset_list):
+        if not resultset:
+            yield {'results': [{'statement_id': statement_id}]}
+            continue
+        for series, is_last_series in iter_with_is_last(resultset):
+            df = resultset[series]
+            for rows, is_last_chunk in iter_with_is_last(iter_pd_series_row_chunks(df, precision, chunk_size)):
+                series_dict = get_series_header(series, df)
+                series_dict['values'] = rows
+                if not is_last_chunk:
+                    series_dict['partial'] = True
+                statement_dict = {'statement_id': statement_id, 'series': [series_dict]}
+                if not (is_last_chunk and is_last_series):
+                    statement_dict['partial'] = True
+                yield {'results': [statement_dict]}
+
+
+# ------------------------------------------------------------------------
+# ENCODERS
+
+class ResultEncoder(object):
+    content_type = None
+
+    @classmethod
+    def iter_encode(cls, resultset_list, precision, chunked=False, chunk_size=None):
+        """
+        Encode results piece by piece, so that at most chunk_size points are converted at once
+        :param resultset_list: one pandas result (dict of series -> DataFrame) per statement
+        :param precision: value of the epoch URL param
+        :param chunked: value of the chunked URL param, i.e. whether to split the response in several ones
+        :param chunk_size: value of the chunk_size URL param
+        :return: generator of bytes
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def encode(cls, resultset_list, precision, chunked=False, chunk_size=None):
+        return b''.join(cls.iter_encode(resultset_list, precision, chunked, chunk_size))
+
+
+class JsonResultEncoder(ResultEncoder):
+    content_type = 'application/json'
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj, cls=NpEncoder)
+
+    @classmethod
+    def iter_encode(cls, resultset_list, precision, chunked=False, chunk_size=None):
+        chunk_size = chunk_size or default_chunk_size
+
+        if chunked:
+            for result in iter_influx_result_chunks(resultset_list, precision, chunk_size):
+                yield (cls.dumps(result) + '\n').encode()
+            return
+
+        yield b'{"results": ['
+        for statement_id, resultset in enumerate(resultset_list):
+            separator = ', ' if statement_id else ''
+            if not resultset:
+                yield (separator + '{"statement_id": %d}' % statement_id).encode()
+                continue
+            yield (separator + '{"statement_id": %d, "series": [' % statement_id).encode()
+            for i, series in enumerate(resultset):
+                df = resultset[series]
+                series_header = cls.dumps(get_series_header(series, df))
+                yield ((', ' if i else '') + series_header[:-1] + ', "values": [').encode()
+                for j, rows in enumerate(iter_pd_series_row_chunks(df, precision, chunk_size)):
+                    if rows:
+                        yield ((', ' if j else '') + cls.dumps(rows)[1:-1]).encode()
+                yield b']}'
+            yield b']}'
+        yield b']}\n'
+
+
+class CsvResultEncoder(ResultEncoder):
+    """
+    Same output as InfluxDB's csvFormatter: one header line (name, tags, columns) per statement and
+    whenever columns change, statements being separated by an empty line.
+    CSV being a stream of rows, chunked responses are not split any further.
+    """
+    content_type = 'application/csv'
+
+    @staticmethod
+    def format_tags(tags):
+        # NB: same as InfluxDB tags hash key, without leading comma
+        return ','.join(escape_csv_tag(k) + '=' + escape_csv_tag(tags[k]) for k in sorted(tags))
+
+    @staticmethod
+    def format_value(value):
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, float):
+            # NB: like Go's FormatFloat(v, 'f', -1, 64): shortest repr, no exponent, no trailing '.0'
+            s = repr(value)
+            if 'e' in s:
+                return np.format_float_positional(value, trim='-')
+            if s.endswith('.0'):
+                return s[:-2]
+            return s
+        return str(value)
+
+    @classmethod
+    def iter_encode(cls, resultset_list, precision, chunked=False, chunk_size=None):
+        chunk_size = chunk_size or default_chunk_size
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator='\n')
+        is_first_statement = True
+        for statement_id, resultset in enumerate(resultset_list):
+            if not resultset:
+                continue
+            if not is_first_statement:
+                output.write('\n')
+            is_first_statement = False
+            columns = None
+            for series in resultset:
+                df = resultset[series]
+                series_header = get_series_header(series, df)
+                if series_header['columns'] != columns:
+                    if columns is not None:
+                        output.write('\n')
+                    columns = series_header['columns']
+                    writer.writerow(['name', 'tags'] + columns)
+                name = series_header['name']
+                tags = cls.format_tags(series_header.get('tags', {}))
+                for rows in iter_pd_series_row_chunks(df, precision, chunk_size):
+                    for row_values in rows:
+                        writer.writerow([name, tags] + [cls.format_value(v) for v in row_values])
+                    yield output.getvalue().encode()
+                    output.seek(0)
+                    output.truncate()
+        yield output.getvalue().encode()
+
+
+class MsgpackResultEncoder(ResultEncoder):
+    """
+    Same output as InfluxDB's msgpackFormatter
+    """
+    content_type = 'application/x-msgpack'
+
+    @staticmethod
+    def convert_times(rows, precision):
+        if precision is None:
+            # NB: w/o epoch, InfluxDB sends times as msgpack timestamps
+            for row_values in rows:
+                row_values[0] = msgpack.Timestamp.from_unix_nano(row_values[0])
+        return rows
+
+    @classmethod
+    def iter_encode(cls, resultset_list, precision, chunked=False, chunk_size=None):
+        chunk_size = chunk_size or default_chunk_size
+        packer = msgpack.Packer(use_bin_type=True)
+
+        if chunked:
+            for result in iter_influx_result_chunks(resultset_list, precision, chunk_size):
+                for statement_dict in result['results']:
+                    for series_dict in statement_dict.get('series', []):
+                        cls.convert_times(series_dict['values'], precision)
+                yield packer.pack(result)
+            return
+
+        yield packer.pack_map_header(1) + packer.pack('results') + packer.pack_array_header(len(resultset_list))
+        for statement_id, resultset in enumerate(resultset_list):
+            if not resultset:
+                # NB: like InfluxDB & the JSON encoder, w/o series at all
+                yield packer.pack_map_header(1) + packer.pack('statement_id') + packer.pack(statement_id)
+                continue
+            yield packer.pack_map_header(2) + packer.pack('statement_id') + packer.pack(statement_id) \
+                  + packer.pack('series') + packer.pack_array_header(len(resultset))
+            for series in resultset:
+                df = resultset[series]
+                series_header = get_series_header(series, df)
+                head = packer.pack_map_header(len(series_header) + 1)
+                for k in ('name', 'tags', 'columns'):
+                    if k in series_header:
+                        head += packer.pack(k) + packer.pack(series_header[k])
+                yield head + packer.pack('values') + packer.pack_array_header(len(df))
+                for rows in iter_pd_series_row_chunks(df, precision, chunk_size):
+                    yield b''.join(packer.pack(row_values) for row_values in cls.convert_times(rows, precision))
+
+
+def escape_csv_tag(s):
+    return str(s).replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def get_result_encoder(accept):
+    """
+    Select output encoder according to the Accept header of the request, as InfluxDB does
+    :param accept: value of the Accept header
+    """
+    if accept:
+        for media_range in accept.split(','):
+            media_type = media_range.split(';')[0].strip().lower()
+            if media_type == 'application/x-msgpack':
+                if msgpack is None:
+                    logging.warning('Client asked for msgpack but module msgpack is not installed, falling back to JSON')
+                    return JsonResultEncoder
+                return MsgpackResultEncoder
+            if media_type in ('application/csv', 'text/csv'):
+                return CsvResultEncoder
+            if media_type in ('application/json', '*/*'):
+                return JsonResultEncoder
+    return JsonResultEncoder
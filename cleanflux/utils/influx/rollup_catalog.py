@@ -0,0 +1,185 @@
+import logging
+import re
+
+import cleanflux.utils.influx.query_sqlparsing as influx_query_parsing
+import cleanflux.utils.influx.date_manipulation as influx_date_manipulation
+
+
+# ------------------------------------------------------------------------
+# GLOBALS
+
+# simple aggregate column, e.g.: mean("value") AS "value_mean"
+aggregate_column_re = re.compile(
+    r'^\s*(?P<function>\w+)\(\s*(?P<field>"(?:[^"\\]|\\.)+"|\w+|\*)\s*\)(?:\s+AS\s+(?P<alias>"(?:[^"\\]|\\.)+"|\w+))?\s*$',
+    re.IGNORECASE)
+
+# aggregate function to apply on a rollup to get the same result as the original function on raw data
+reaggregation_functions = {
+    'mean': 'mean',
+    'sum': 'sum',
+    'count': 'sum',
+    'min': 'min',
+    'max': 'max',
+    'first': 'first',
+    'last': 'last',
+}
+
+
+# ------------------------------------------------------------------------
+# ROLLUPS
+
+class Rollup(object):
+    """
+    A pre-aggregated measurement: function(field) of a source measurement, grouped by time(interval)
+    """
+
+    __slots__ = ('schema', 'measurement', 'function', 'field', 'interval', 'interval_ns',
+                 'rollup_rp', 'rollup_measurement', 'rollup_field')
+
+    def __init__(self, schema, measurement, function, field, interval,
+                 rollup_rp, rollup_measurement, rollup_field):
+        self.schema = schema
+        self.measurement = measurement
+        self.function = function.lower()
+        self.field = field
+        self.interval = interval
+        self.interval_ns = influx_date_manipulation.influx_interval_to_nanoseconds(interval)
+        self.rollup_rp = rollup_rp
+        self.rollup_measurement = rollup_measurement
+        self.rollup_field = rollup_field
+
+    def get_rollup_field(self, field):
+        """
+        :param field: field of the source measurement
+        :return: field of the rollup measurement holding its aggregate
+        """
+        if self.field != '*':
+            return self.rollup_field
+        # NB: function(*) writes one field per source field, prefixed w/ the name of the function
+        return self.rollup_field + field
+
+    def __repr__(self):
+        return "Rollup({}({}) of {}.{} every {} -> {}.{}.{})".format(
+            self.function, self.field, self.schema, self.measurement, self.interval,
+            self.schema, self.rollup_rp, self.rollup_measurement)
+
+
+class RollupCatalog(object):
+    """
+    Rollups by source (schema, measurement), discovered from CQs and / or declared in config
+    """
+
+    def __init__(self, rollups=None):
+        """
+        :param rollups: list of dict, as declared in config
+        """
+        self.rollups = {}
+        for rollup_conf in rollups or []:
+            rollup_field = rollup_conf.get('rollup_field', rollup_conf.get('field', '*'))
+            self.add(Rollup(rollup_conf['schema'], rollup_conf['measurement'],
+                            rollup_conf['function'], rollup_conf.get('field', '*'), rollup_conf['interval'],
+                            rollup_conf.get('rollup_rp'), rollup_conf['rollup_measurement'], rollup_field))
+
+    def add(self, rollup):
+        rollups = self.rollups.setdefault((rollup.schema, rollup.measurement), [])
+        for known_rollup in rollups:
+            if (known_rollup.function, known_rollup.field, known_rollup.interval) \
+                    == (rollup.function, rollup.field, rollup.interval):
+                # NB: rollups declared in config take precedence over discovered ones
+                return
+        rollups.append(rollup)
+        logging.debug("Registered {}".format(rollup))
+
+    def add_from_cq(self, schema, parsed_cq):
+        """
+        Register the rollups written by a CQ into another measurement
+        :param parsed_cq: sqlparsed CREATE CONTINUOUS QUERY statement
+        """
+        from_m = influx_query_parsing.parse_measurement_path(schema, influx_query_parsing.get_cq_from(parsed_cq))
+        into = influx_query_parsing.parse_measurement_path(schema, influx_query_parsing.get_cq_into(parsed_cq))
+        interval = influx_query_parsing.get_cq_interval(parsed_cq)
+        if from_m is None or into is None or interval is None or into['measurement'] == ':MEASUREMENT':
+            return
+        subquery = influx_query_parsing.get_cq_subquery(parsed_cq)
+        if '*' not in (influx_query_parsing.extract_group_by(subquery) or []):
+            # NB: rollup not keeping all tags can't answer queries filtering / grouping on them
+            return
+        for column in influx_query_parsing.extract_all_columns_in_select(subquery) or []:
+            aggregate = parse_aggregate_column(column)
+            if aggregate is None:
+                continue
+            function, field, alias = aggregate
+            if alias is None:
+                alias = function + '_' if field == '*' else function
+            self.add(Rollup(from_m['schema'], from_m['measurement'], function, field, interval,
+                            into['rp'], into['measurement'], alias))
+
+    def get_rollups(self, schema, measurement):
+        return self.rollups.get((schema, measurement), [])
+
+    def find_rollup(self, schema, measurement, aggregates, group_by_time_ns, is_retained):
+        """
+        Find the coarsest rollup holding all the aggregates a query asks for
+        :param aggregates: list of (function, field) of the query
+        :param group_by_time_ns: GROUP BY time() interval of the query
+        :param is_retained: function telling whether a RP holds the whole time window of the query
+        :return: Rollup, None if none is adequate
+        """
+        chosen = None
+        for rollup in self.get_rollups(schema, measurement):
+            if rollup.interval_ns > group_by_time_ns or group_by_time_ns % rollup.interval_ns != 0:
+                continue
+            if chosen is not None and rollup.interval_ns <= chosen.interval_ns:
+                continue
+            if not all(self.get_sibling(rollup, function, field) is not None for function, field in aggregates):
+                continue
+            if not is_retained(rollup.rollup_rp):
+                continue
+            chosen = rollup
+        return chosen
+
+    def get_sibling(self, rollup, function, field):
+        """
+        :return: rollup written along w/ rollup (same measurement & interval) holding function(field), if any
+        """
+        for r in self.get_rollups(rollup.schema, rollup.measurement):
+            if (r.rollup_rp, r.rollup_measurement, r.interval) == \
+                    (rollup.rollup_rp, rollup.rollup_measurement, rollup.interval) \
+                    and is_aggregate_in_rollup(function, field, r):
+                return r
+        return None
+
+    def get_state(self):
+        return [repr(rollup) for rollups in self.rollups.values() for rollup in rollups]
+
+
+# ------------------------------------------------------------------------
+# HELPERS
+
+def parse_aggregate_column(column):
+    """
+    :param column: a column of a SELECT
+    :return: (function, field, alias) w/ field & alias unquoted, None if column is not a simple aggregate
+    """
+    match = aggregate_column_re.match(column)
+    if match is None:
+        return None
+    field = match.group('field').strip('"')
+    alias = match.group('alias')
+    if alias is not None:
+        alias = alias.strip('"')
+    return match.group('function').lower(), field, alias
+
+
+def is_aggregate_in_rollup(function, field, rollup):
+    return rollup.function == function and rollup.field in ('*', field) and function in reaggregation_functions
+
+
+def get_rollup_aggregate(function, field, alias, rollup):
+    """
+    :return: column computing function(field) of the source measurement out of the rollup
+    """
+    rollup_field = rollup.get_rollup_field(field)
+    column = '{}("{}")'.format(reaggregation_functions[function], rollup_field)
+    # NB: keep same column name as w/ raw data
+    return column + ' AS "{}"'.format(alias if alias is not None else function)
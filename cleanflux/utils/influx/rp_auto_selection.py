@@ -2,6 +2,7 @@ import logging
 import math
 import re
 from datetime import timedelta
+from fractions import Fraction
 from pprint import pprint
 from datadog import statsd
 
@@ -10,15 +11,29 @@ import cleanflux.utils.influx.query_modification as influx_query_modification
 import cleanflux.utils.influx.date_manipulation as influx_date_manipulation
 import cleanflux.utils.influx.rp_conf_access as influx_rp_conf_access
 import cleanflux.utils.influx.querying_spe as influx_querying_spe
+import cleanflux.utils.influx.rollup_catalog as influx_rollup_catalog
+from cleanflux.utils.tracing import traced
 
 
 # ------------------------------------------------------------------------
 # PUBLIC
 
 @statsd.timed('timer_update_query_with_right_rp', use_ms=True)
+@traced('rp_selection')
 def update_query_with_right_rp(from_parts, query, parsed_query,
                                known_retention_policies, aggregation_properties,
-                               override_explicit_rp=False):
+                               override_explicit_rp=False, rollup_catalog=None, keep_sum_unit=False):
+    """
+    :param keep_sum_unit: True to adjust SUM to the new GROUP BY time() interval whatever the aggregation mode
+                          of the measurement, e.g. for a subquery, whose rows outer statements aggregate
+    """
+    if rollup_catalog is not None:
+        query_rollup = update_query_with_right_rollup(from_parts, query, parsed_query,
+                                                      known_retention_policies, rollup_catalog,
+                                                      override_explicit_rp)
+        if query_rollup is not None:
+            return query_rollup
+
     output = get_right_rp_for_query(from_parts['schema'], query, parsed_query, known_retention_policies, override_explicit_rp)
 
     if output is None:
@@ -39,7 +54,7 @@ def update_query_with_right_rp(from_parts, query, parsed_query,
                                                                                output['group_by_time_interval'])
         is_changed = True
     if 'sum_group_by_time_interval_factor' in output:
-        if counter_aggregation_mode == 'sum':
+        if counter_aggregation_mode == 'sum' or keep_sum_unit:
             parsed_query = influx_query_modification.change_sum_group_by_time_factor(
                 parsed_query,
                 output['sum_group_by_time_interval_factor'])
@@ -55,7 +70,208 @@ def update_query_with_right_rp(from_parts, query, parsed_query,
     return query
 
 
+@statsd.timed('timer_update_multi_measurement_query_with_right_rp', use_ms=True)
+@traced('rp_selection')
+def update_multi_measurement_query_with_right_rp(from_parts_list, measurement_lists, query, parsed_query,
+                                                 known_retention_policies, aggregation_properties):
+    """
+    Select the RP of a query selecting from several measurements, or from the ones matching a regex.
+    Measurements whose RP intervals call for the same GROUP BY time() interval (& SUM factor) share a statement:
+    a single one keeps the FROM clause, regexes included, while several ones get each their explicit list
+    of measurements, their results being merged afterwards.
+    :param from_parts_list: as returned by extract_measurements_from_query()
+    :param measurement_lists: for each from_parts, names of the measurements it stands for, e.g. the ones
+                              matching its regex
+    :return: list of reworked statements, None if query is left unchanged
+    """
+    schemas = set(from_parts['schema'] for from_parts in from_parts_list)
+    if len(schemas) != 1 or None in schemas:
+        logging.info('Measurements of several or unknown schemas in query, skipping')
+        return None
+    schema = schemas.pop()
+    if any(from_parts['rp'] is not None for from_parts in from_parts_list):
+        logging.info('RP set in query, skipping')
+        return None
+    if schema not in known_retention_policies:
+        logging.info('no known RP for schema ' + schema)
+        return None
+
+    # (rp, group by time interval, sum factor) -> measurements, in order of the FROM clause
+    groups = {}
+    seen_measurements = set()
+    for measurements in measurement_lists:
+        for measurement in measurements:
+            if measurement in seen_measurements:
+                continue
+            seen_measurements.add(measurement)
+            measurement_from_parts = {'schema': schema, 'rp': None, 'measurement': measurement}
+            output = get_right_rp_for_measurement(schema, measurement_from_parts, query, parsed_query,
+                                                  known_retention_policies) or {}
+            factor = output.get('sum_group_by_time_interval_factor')
+            if get_counter_aggregation_mode(measurement_from_parts, aggregation_properties) != 'sum':
+                factor = None
+            key = (output.get('rp'), output.get('group_by_time_interval'), factor)
+            groups.setdefault(key, []).append(measurement)
+
+    if not groups or list(groups) == [(None, None, None)]:
+        return None
+
+    queries = []
+    if len(groups) == 1:
+        (rp, group_by_time_interval, factor), measurements = groups.popitem()
+        measurement_paths = [get_measurement_path(schema, rp, from_parts['measurement'])
+                             for from_parts in from_parts_list]
+        queries.append(rework_statement_for_rp(parsed_query, ', '.join(measurement_paths),
+                                               group_by_time_interval, factor))
+    else:
+        for (rp, group_by_time_interval, factor), measurements in groups.items():
+            measurement_paths = [get_measurement_path(schema, rp, measurement) for measurement in measurements]
+            queries.append(rework_statement_for_rp(influx_query_parsing.sqlparse_query(query),
+                                                   ', '.join(measurement_paths),
+                                                   group_by_time_interval, factor))
+
+    for query in queries:
+        logging.info('Reworked query (auto RP): ' + query)
+
+    return queries
+
+
+@statsd.timed('timer_update_query_to_downsample_raw_query', use_ms=True)
+@traced('rewrite')
+def update_query_to_downsample_raw_query(from_parts, query, parsed_query,
+                                         known_retention_policies, aggregation_properties,
+                                         max_nb_points_per_series, min_window):
+    """
+    Aggregate a query on raw fields (w/o GROUP BY time()) over a long time window, so that it returns
+    at most max_nb_points_per_series points per series
+    :param min_window: smallest time window (influx interval) for which to downsample
+    :return: reworked query, None if not applicable
+    """
+    if from_parts is None or from_parts['schema'] is None \
+            or influx_query_parsing.extract_time_interval_group_by(parsed_query) is not None:
+        return None
+    if re.search(r'\s(LIMIT|SLIMIT|INTO)\s', query, re.IGNORECASE):
+        return None
+
+    query_window = influx_query_parsing.get_query_time_window(query)
+    if query_window is None or query_window < influx_date_manipulation.influx_interval_to_timedelta(min_window):
+        return None
+
+    query_window_ns = influx_date_manipulation.timedelta_to_ns(query_window)
+    interval_s = max(1, -(-query_window_ns // (max_nb_points_per_series * influx_date_manipulation.influx_unit_to_ns_factor('s'))))
+    interval = str(interval_s) + 's'
+
+    rp = None
+    schema_rps = known_retention_policies.get(from_parts['schema'])
+    if schema_rps:
+        if from_parts['rp'] is not None:
+            rp = next((rp for rp in schema_rps if rp['name'] == from_parts['rp']), None)
+        else:
+            rp = influx_rp_conf_access.get_default_rp_for_schema_from_conf(from_parts['schema'], known_retention_policies)
+    rp_interval = influx_rp_conf_access.get_rp_interval(rp, from_parts['measurement']) if rp is not None else None
+    if rp_interval is not None and influx_date_manipulation.influx_interval_to_nanoseconds(rp_interval) \
+            >= interval_s * influx_date_manipulation.influx_unit_to_ns_factor('s'):
+        # NB: data is already sparse enough
+        return None
+
+    # NB: last() works on any field type
+    func = get_counter_aggregation_mode(from_parts, aggregation_properties) or 'last'
+
+    parsed_query = influx_query_modification.aggregate_raw_columns(parsed_query, func)
+    if parsed_query is None:
+        return None
+    query = influx_query_parsing.stringify_sqlparsed(parsed_query)
+    query = influx_query_modification.add_group_by_time(query, interval)
+
+    logging.info('Reworked query (downsample raw query): ' + query)
+
+    return query
+
+
+@statsd.timed('timer_update_query_with_right_rollup', use_ms=True)
+def update_query_with_right_rollup(from_parts, query, parsed_query,
+                                   known_retention_policies, rollup_catalog,
+                                   override_explicit_rp=False):
+    """
+    Reroute a query aggregating raw data to the coarsest rollup (pre-aggregated measurement) holding its aggregates
+    at a compatible interval, even if stored under another measurement name
+    :type rollup_catalog: RollupCatalog
+    :return: reworked query, None if no rollup is adequate
+    """
+    if from_parts is None or (from_parts['rp'] is not None and override_explicit_rp is False):
+        return None
+    schema = from_parts['schema']
+    measurement = from_parts['measurement']
+    if not rollup_catalog.get_rollups(schema, measurement):
+        return None
+
+    group_by_time_interval = influx_query_parsing.extract_time_interval_group_by(parsed_query)
+    if group_by_time_interval is None:
+        return None
+    group_by_time_ns = influx_date_manipulation.influx_interval_to_nanoseconds(group_by_time_interval)
+
+    aggregates = []
+    for column in influx_query_parsing.extract_all_columns_in_select(parsed_query) or []:
+        aggregate = influx_rollup_catalog.parse_aggregate_column(column)
+        if aggregate is None or aggregate[1] == '*' \
+                or aggregate[0] not in influx_rollup_catalog.reaggregation_functions:
+            return None
+        aggregates.append(aggregate)
+    if not aggregates:
+        return None
+
+    time_bounds = influx_query_parsing.extract_time_window_bounds(query)
+
+    def get_rp_name(rp_name):
+        if rp_name is not None:
+            return rp_name
+        if schema not in known_retention_policies:
+            return None
+        rp = influx_rp_conf_access.get_default_rp_for_schema_from_conf(schema, known_retention_policies)
+        return rp['name'] if rp is not None else None
+
+    def is_retained(rp_name):
+        rp_name = get_rp_name(rp_name)
+        if rp_name is None:
+            return False
+        rp = next((rp for rp in known_retention_policies.get(schema, []) if rp['name'] == rp_name), None)
+        rp_duration = influx_date_manipulation.influx_rp_duration_to_timedelta(rp['duration']) \
+            if rp is not None and 'duration' in rp else None
+        if not rp_duration:
+            # NB: infinite or unknown retention
+            return True
+        if time_bounds['from'] is None:
+            return False
+        return is_rp_good_for_our_interval(influx_date_manipulation.datetime_max_for_influx_rp(rp['duration']),
+                                           time_bounds['from'])
+
+    rollup = rollup_catalog.find_rollup(schema, measurement, [(f, field) for f, field, _ in aggregates],
+                                        group_by_time_ns, is_retained)
+    if rollup is None:
+        return None
+
+    columns = []
+    for function, field, alias in aggregates:
+        sibling = rollup_catalog.get_sibling(rollup, function, field)
+        columns.append(influx_rollup_catalog.get_rollup_aggregate(function, field, alias, sibling))
+    rollup_rp = get_rp_name(rollup.rollup_rp)
+
+    columns_token_id = influx_query_parsing.get_token_index_columns_in_select(parsed_query)
+    parsed_query.tokens[columns_token_id] = ', '.join(columns)
+    from_id = influx_query_parsing.extract_from_helper(parsed_query, 'index')
+    parsed_query.tokens[from_id] = '"' + schema + '"."' + rollup_rp + '"."' + rollup.rollup_measurement + '"'
+    query = influx_query_parsing.stringify_sqlparsed(parsed_query)
+
+    from_parts['rp'] = rollup_rp
+    from_parts['measurement'] = rollup.rollup_measurement
+
+    logging.info('Reworked query (rollup): ' + query)
+
+    return query
+
+
 @statsd.timed('timer_update_query_to_limit_nb_points_per_series', use_ms=True)
+@traced('rewrite')
 def update_query_to_limit_nb_points_per_series(from_parts, query, parsed_query,
                                                aggregation_properties, max_nb_points_per_series):
 
@@ -73,7 +289,8 @@ def update_query_to_limit_nb_points_per_series(from_parts, query, parsed_query,
             expected_nb_points_per_series['nb_points']) + ' is bigger than max allowed one (' + str(
             max_nb_points_per_series) + ')')
 
-        my_factor = expected_nb_points_per_series['nb_points'] // max_nb_points_per_series
+        # NB: rounded up, so that the reworked query does not return more points than allowed
+        my_factor = -(-expected_nb_points_per_series['nb_points'] // max_nb_points_per_series)
         split_group_by_time_interval = influx_date_manipulation.split_influx_time(
             expected_nb_points_per_series['group_by_time_interval'])
         adjusted_group_by_time_value = int(math.ceil(my_factor * split_group_by_time_interval['number']))
@@ -94,6 +311,7 @@ def update_query_to_limit_nb_points_per_series(from_parts, query, parsed_query,
 
 
 @statsd.timed('timer_update_query_to_limit_nb_points_for_query', use_ms=True)
+@traced('rewrite')
 def update_query_to_limit_nb_points_for_query(backend_host, backend_port, user, password,
                                               from_parts, query, parsed_query,
                                               aggregation_properties, max_nb_points_per_query):
@@ -134,6 +352,49 @@ def update_query_to_limit_nb_points_for_query(backend_host, backend_port, user,
     return None
 
 
+@statsd.timed('timer_update_query_to_fit_subquery_interval', use_ms=True)
+@traced('rewrite')
+def update_query_to_fit_subquery_interval(parsed_query, subquery_interval, new_subquery_interval):
+    """
+    Align a query on its subquery, once the GROUP BY time() interval of the subquery got reworked (RP selection,
+    limit of nb of points): its own interval becomes a multiple of the new one of the subquery, at least as coarse,
+    and SUM of rows of the subquery keep their unit, despite the change of nb of rows per interval.
+    NB: rows of the reworked subquery are expected to keep their unit too, see keep_sum_unit
+    :param parsed_query: query, w/ its subquery already reworked
+    :param subquery_interval: GROUP BY time() interval of the original subquery
+    :param new_subquery_interval: GROUP BY time() interval of the reworked subquery
+    :return: reworked query, None if GROUP BY time() is left unchanged
+    """
+    group_by_time_interval = influx_query_parsing.extract_time_interval_group_by(parsed_query)
+    if group_by_time_interval is None or subquery_interval is None or new_subquery_interval is None:
+        return None
+    group_by_time_ns = influx_date_manipulation.influx_interval_to_nanoseconds(group_by_time_interval)
+    subquery_ns = influx_date_manipulation.influx_interval_to_nanoseconds(subquery_interval)
+    new_subquery_ns = influx_date_manipulation.influx_interval_to_nanoseconds(new_subquery_interval)
+    if not group_by_time_ns or not subquery_ns or not new_subquery_ns or subquery_ns == new_subquery_ns:
+        return None
+
+    # NB: rounded up, so that each interval aggregates whole intervals of the subquery
+    new_group_by_time_ns = -(-group_by_time_ns // new_subquery_ns) * new_subquery_ns
+    is_query_sum_group_by_time = influx_query_parsing.is_sum_group_by_time(parsed_query)
+    if new_group_by_time_ns != group_by_time_ns:
+        new_group_by_time_interval = influx_date_manipulation.nanoseconds_to_influx_interval(new_group_by_time_ns)
+        parsed_query = influx_query_modification.change_group_by_time_interval(parsed_query,
+                                                                               new_group_by_time_interval)
+    if is_query_sum_group_by_time:
+        # NB: nb of rows of the subquery per interval goes from group_by_time / subquery
+        #     to new_group_by_time / new_subquery
+        factor = Fraction(group_by_time_ns * new_subquery_ns, subquery_ns * new_group_by_time_ns)
+        if factor != 1:
+            parsed_query = influx_query_modification.change_sum_group_by_time_factor(
+                parsed_query, str(factor.numerator) + ' / ' + str(factor.denominator))
+
+    query = influx_query_parsing.stringify_sqlparsed(parsed_query)
+    logging.info('Reworked query (fit subquery interval): ' + query)
+
+    return query
+
+
 # ------------------------------------------------------------------------
 # PRIVATE
 
@@ -163,15 +424,26 @@ def get_counter_aggregation_mode(from_part, aggregation_properties):
 
 @statsd.timed('timer_get_right_rp_for_query', use_ms=True)
 def get_right_rp_for_query(schema, query, parsed_query, known_retention_policies, override_explicit_rp=False):
+    from_parts = influx_query_parsing.extract_measurement_from_query(schema, parsed_query)
+    if from_parts is None:
+        logging.error('Could not extract measurement from query')
+        return None
+    return get_right_rp_for_measurement(schema, from_parts, query, parsed_query,
+                                        known_retention_policies, override_explicit_rp)
+
+
+def get_right_rp_for_measurement(schema, from_parts, query, parsed_query, known_retention_policies,
+                                 override_explicit_rp=False):
+    """
+    :param from_parts: measurement path the query selects from, w/ a measurement name (not a regex)
+    :return: dict w/ keys rp, group_by_time_interval & sum_group_by_time_interval_factor (all optional),
+             None if nothing to change
+    """
     output = {}
     chosen_rp = None
     chosen_group_by_time_interval = None
     is_query_sum_group_by_time = False
 
-    from_parts = influx_query_parsing.extract_measurement_from_query(schema, parsed_query)
-    if from_parts is None:
-        logging.error('Could not extract measurement from query')
-        return None
     if schema is None and from_parts['schema'] is None:
         # pass-through towards InfluxDB
         logging.warning('Schema not specified in query nor as a URL param')
@@ -223,7 +495,8 @@ def get_right_rp_for_query(schema, query, parsed_query, known_retention_policies
             if is_rp_good_for_our_interval(max_datetime, time_bounds['from']):
                 logging.info('RP ' + rp['name'] + ' is selected')
                 chosen_rp = rp['name']
-                if group_by_time_interval is not None and 'interval' in rp:
+                if group_by_time_interval is not None \
+                        and influx_rp_conf_access.get_rp_interval(rp, from_parts['measurement']) is not None:
                     chosen_group_by_time_interval = get_new_group_by_time_interval_according_to_rp(
                         group_by_time_interval, from_parts['measurement'], rp)
                 break
@@ -243,6 +516,29 @@ def get_right_rp_for_query(schema, query, parsed_query, known_retention_policies
     return output
 
 
+def get_measurement_path(schema, rp, measurement):
+    """
+    :param rp: None for the default RP of schema
+    :param measurement: name or regex, e.g. /^cpu.*/
+    """
+    if not influx_query_parsing.is_regexp_measurement(measurement):
+        measurement = '"' + measurement.replace('"', '\\"') + '"'
+    return '"' + schema + '".' + ('"' + rp + '"' if rp is not None else '') + '.' + measurement
+
+
+def rework_statement_for_rp(parsed_query, from_clause, group_by_time_interval, sum_factor):
+    """
+    :return: statement selecting from from_clause, at the given GROUP BY time() interval (None to keep it),
+             w/ SUM adjusted by sum_factor (None to leave it as is)
+    """
+    parsed_query = influx_query_modification.change_from_clause(parsed_query, from_clause)
+    if group_by_time_interval is not None:
+        parsed_query = influx_query_modification.change_group_by_time_interval(parsed_query, group_by_time_interval)
+    if sum_factor is not None:
+        parsed_query = influx_query_modification.change_sum_group_by_time_factor(parsed_query, sum_factor)
+    return influx_query_parsing.stringify_sqlparsed(parsed_query)
+
+
 def is_rp_good_for_our_interval(rp_max_datetime, from_time_bound):
     # NB: We allow ourselves a small margin for the edge case when both date are equal, but we get a few
     #     Another way would have been to .replace(microsecond=0) on each datetime
@@ -251,17 +547,17 @@ def is_rp_good_for_our_interval(rp_max_datetime, from_time_bound):
 
 
 def get_new_group_by_time_interval_according_to_rp(current_group_by_time_interval, measurement, new_rp):
-    # TODO: we might want to be able to (re)define it on a per-measurement basis
+    new_rp_interval = influx_rp_conf_access.get_rp_interval(new_rp, measurement)
     current = influx_date_manipulation.influx_interval_to_timedelta(current_group_by_time_interval)
-    new = influx_date_manipulation.influx_interval_to_timedelta(new_rp['interval'])
+    new = influx_date_manipulation.influx_interval_to_timedelta(new_rp_interval)
     if current < new:
-        logging.debug('Selected RP (' + new_rp['name'] + ') has lower precision interval (' + new_rp['interval'] +
+        logging.debug('Selected RP (' + new_rp['name'] + ') has lower precision interval (' + new_rp_interval +
                       ') than what query asks for (' + current_group_by_time_interval + '), changing to: ' +
-                      new_rp['interval'])
-        return new_rp['interval']
+                      new_rp_interval)
+        return new_rp_interval
     else:
         logging.debug('Selected RP (' + new_rp['name'] + ') has higher or equal precision interval (' +
-                      new_rp['interval'] + ') than what query asks for (' + current_group_by_time_interval +
+                      new_rp_interval + ') than what query asks for (' + current_group_by_time_interval +
                       '), no change')
 
 
@@ -288,6 +584,8 @@ def get_expected_nb_points_per_series(query, parsed_query):
         return None
 
     group_by_time_interval = influx_query_parsing.extract_time_interval_group_by(parsed_query)
+    if group_by_time_interval is None:
+        return None
 
     group_by_time_ns = influx_date_manipulation.influx_interval_to_nanoseconds(group_by_time_interval)
     query_window_ns = influx_date_manipulation.timedelta_to_ns(query_window_timedelta)
@@ -8,3 +8,14 @@ def get_default_rp_for_schema_from_conf(schema, known_retention_policies):
         if 'default' in rp and rp['default'] is True:
             return rp
     return None
+
+
+def get_rp_interval(rp, measurement=None):
+    """
+    :param rp: RP conf
+    :return: GROUP BY time() interval of the CQ downsampling measurement into rp, None if unknown
+    """
+    measurement_intervals = rp.get('measurement_intervals')
+    if measurement_intervals and measurement in measurement_intervals:
+        return measurement_intervals[measurement]
+    return rp.get('interval')
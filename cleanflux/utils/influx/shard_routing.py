@@ -0,0 +1,234 @@
+import re
+import threading
+
+
+# ------------------------------------------------------------------------
+# SHARDS
+
+class Shard(object):
+    """
+    An InfluxDB instance holding the data of the schemas / measurements matching its regexps
+    """
+
+    __slots__ = ('host', 'port', 'schema_re', 'measurement_re')
+
+    def __init__(self, host, port, schema_regexp=None, measurement_regexp=None):
+        self.host = host
+        self.port = port
+        self.schema_re = re.compile(schema_regexp) if schema_regexp else None
+        self.measurement_re = re.compile(measurement_regexp) if measurement_regexp else None
+
+    @property
+    def backend(self):
+        return self.host, self.port
+
+    def match_schema(self, schema):
+        return self.schema_re is None or (schema is not None and self.schema_re.match(schema) is not None)
+
+    def match_measurement(self, measurement):
+        return self.measurement_re is None \
+               or (measurement is not None and self.measurement_re.match(measurement) is not None)
+
+    def __repr__(self):
+        return "Shard({}:{})".format(self.host, self.port)
+
+
+class ShardRouter(object):
+    """
+    Routing table of schemas / measurements to backends.
+    Shards are evaluated in order, the first one matching wins. Unmatched data stays on the default backend.
+    """
+
+    # max nb of (schema, measurement) couples for which routing gets memoized
+    max_cache_size = 10000
+
+    def __init__(self, shards, default_host, default_port):
+        """
+        :param shards: list of dict w/ keys host, port (defaults to 8086), schema & measurement (regexps, optional)
+        """
+        self.shards = [Shard(shard['host'], shard.get('port', 8086), shard.get('schema'), shard.get('measurement'))
+                       for shard in shards]
+        self.default_backend = (default_host, default_port)
+        self.backends = [self.default_backend]
+        for shard in self.shards:
+            if shard.backend not in self.backends:
+                self.backends.append(shard.backend)
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.schema_cache = {}
+
+    @property
+    def is_active(self):
+        return len(self.shards) > 0
+
+    def get_backend(self, schema, measurement=None):
+        """
+        :return: (host, port) of the backend holding measurement of schema
+        """
+        key = (schema, measurement)
+        backend = self.cache.get(key)
+        if backend is not None:
+            return backend
+        backend = self.default_backend
+        for shard in self.shards:
+            if shard.match_schema(schema) and shard.match_measurement(measurement):
+                backend = shard.backend
+                break
+        with self.lock:
+            if len(self.cache) >= self.max_cache_size:
+                self.cache.clear()
+            self.cache[key] = backend
+        return backend
+
+    def get_schema_backend(self, schema):
+        """
+        :return: (host, port) of the backend holding the whole schema, None if it is split by measurement
+        """
+        if schema in self.schema_cache:
+            return self.schema_cache[schema]
+        backend = self.default_backend
+        for shard in self.shards:
+            if not shard.match_schema(schema):
+                continue
+            if shard.measurement_re is not None:
+                backend = None
+            else:
+                backend = shard.backend
+            break
+        with self.lock:
+            if len(self.schema_cache) >= self.max_cache_size:
+                self.schema_cache.clear()
+            self.schema_cache[schema] = backend
+        return backend
+
+    def get_schema_backends(self, schema):
+        """
+        :return: list of (host, port) of the backends holding measurements of schema
+        """
+        backends = []
+        for shard in self.shards:
+            if not shard.match_schema(schema):
+                continue
+            if shard.backend not in backends:
+                backends.append(shard.backend)
+            if shard.measurement_re is None:
+                # NB: measurements not matched so far all go to this shard
+                return backends
+        if self.default_backend not in backends:
+            backends.append(self.default_backend)
+        return backends
+
+    def split_write(self, schema, payload):
+        """
+        Split a line protocol payload according to the measurement of each line
+        :param payload: line protocol (bytes)
+        :return: dict of backend -> line protocol (bytes)
+        """
+        lines_by_measurement = {}
+        for line in payload.split(b'\n'):
+            if not line or line.startswith(b'#'):
+                continue
+            measurement = get_line_measurement(line)
+            lines = lines_by_measurement.get(measurement)
+            if lines is None:
+                lines = lines_by_measurement[measurement] = []
+            lines.append(line)
+
+        lines_by_backend = {}
+        for measurement, lines in lines_by_measurement.items():
+            backend = self.get_backend(schema, unescape_measurement(measurement))
+            lines_by_backend.setdefault(backend, []).extend(lines)
+        return {backend: b'\n'.join(lines) + b'\n' for backend, lines in lines_by_backend.items()}
+
+    def get_state(self):
+        return {
+            'default_backend': "{}:{}".format(*self.default_backend),
+            'shards': [{'backend': "{}:{}".format(*shard.backend),
+                        'schema': shard.schema_re.pattern if shard.schema_re is not None else None,
+                        'measurement': shard.measurement_re.pattern if shard.measurement_re is not None else None}
+                       for shard in self.shards],
+            'nb_cached_routes': len(self.cache),
+            'nb_cached_schemas': len(self.schema_cache),
+        }
+
+
+# ------------------------------------------------------------------------
+# QUERY RESULTS
+
+def merge_query_results(responses):
+    """
+    Merge the responses of several shards to the same /query request, statement by statement.
+    Series returned by several shards (e.g. "measurements" of SHOW MEASUREMENTS) get their values merged & sorted,
+    w/o duplicates. The first error of a statement wins.
+    :param responses: one list of statement results per shard, as found in the "results" of its JSON response(s)
+    :return: list of statement results
+    """
+    results = {}
+    series_by_statement = {}
+    for statement_results in responses:
+        for result in statement_results:
+            statement_id = result.get('statement_id', 0)
+            merged_result = results.setdefault(statement_id, {'statement_id': statement_id})
+            if 'error' in merged_result:
+                continue
+            if 'error' in result:
+                merged_result['error'] = result['error']
+                continue
+            merged_series = series_by_statement.setdefault(statement_id, {})
+            for series in result.get('series', []):
+                key = (series.get('name'), tuple(sorted(series.get('tags', {}).items())))
+                if key not in merged_series:
+                    merged_series[key] = (dict(series, values=[]), set())
+                merged, seen = merged_series[key]
+                for row in series.get('values', []):
+                    if tuple(row) not in seen:
+                        seen.add(tuple(row))
+                        merged['values'].append(row)
+
+    merged_results = []
+    for statement_id in sorted(results):
+        result = results[statement_id]
+        merged_series = series_by_statement.get(statement_id)
+        if 'error' not in result and merged_series:
+            result['series'] = []
+            for key in sorted(merged_series, key=str):
+                series, _ = merged_series[key]
+                series.pop('partial', None)
+                series['values'].sort(key=lambda row: [str(value) for value in row])
+                result['series'].append(series)
+        merged_results.append(result)
+    return merged_results
+
+
+# ------------------------------------------------------------------------
+# LINE PROTOCOL
+
+def get_line_measurement(line):
+    """
+    :param line: a line of line protocol (bytes)
+    :return: measurement, still escaped (bytes)
+    """
+    start = 0
+    while True:
+        comma = line.find(b',', start)
+        space = line.find(b' ', start)
+        if comma == -1:
+            end = space
+        elif space == -1:
+            end = comma
+        else:
+            end = min(comma, space)
+        if end == -1:
+            return line
+        if end > 0 and line[end - 1:end] == b'\\':
+            start = end + 1
+            continue
+        return line[:end]
+
+
+def unescape_measurement(measurement):
+    """
+    :param measurement: as found in line protocol (bytes)
+    :rtype: str
+    """
+    return measurement.replace(b'\\,', b',').replace(b'\\ ', b' ').decode('utf-8', 'replace')
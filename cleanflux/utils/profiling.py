@@ -0,0 +1,92 @@
+import os
+import sys
+import threading
+import time
+
+import cleanflux.utils.tracing as tracing
+
+
+# ------------------------------------------------------------------------
+# SAMPLING PROFILER
+
+class SamplingProfiler(object):
+    """
+    Statistical profiler for the live daemon: periodically walks the stacks of the threads handling requests
+    and counts identical stacks, grouped by the stage of the request they are running.
+
+    Profiles are time-boxed and only one can run at a time.
+    While profiling, requests get traced (even if tracing is disabled by config) so that their stage is known.
+    """
+
+    def __init__(self, max_seconds=60, max_rate=1000):
+        """
+        :param max_seconds: max duration of a profile
+        :param max_rate: max nb of samples per second
+        """
+        self.max_seconds = max_seconds
+        self.max_rate = max_rate
+        self.lock = threading.Lock()
+        self.labels = {}
+
+    def profile(self, seconds, rate, all_threads=False):
+        """
+        :param seconds: duration of the profile
+        :param rate: nb of samples per second
+        :param all_threads: if True, also sample threads not handling a request (labelled by thread name)
+        :return: collapsed stacks (flamegraph.pl / speedscope compatible), one 'frame;frame;... count' per line
+        """
+        seconds = min(max(seconds, 0), self.max_seconds)
+        interval = 1.0 / min(max(rate, 1), self.max_rate)
+        if not self.lock.acquire(blocking=False):
+            raise Exception("A profile is already running")
+        counts = {}
+        tracing.set_forced(True)
+        try:
+            own_ident = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            next_sample = time.monotonic()
+            while next_sample < deadline:
+                self._sample(counts, own_ident, all_threads)
+                next_sample += interval
+                delay = next_sample - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        finally:
+            tracing.set_forced(False)
+            self.lock.release()
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in sorted(counts.items(), key=lambda item: item[1], reverse=True))
+
+    def _sample(self, counts, own_ident, all_threads):
+        thread_names = None
+        if all_threads:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            trace = tracing.active_traces.get(ident)
+            if trace is not None:
+                root = 'stage:' + (trace.get_current_stage() or 'none')
+            elif all_threads:
+                root = 'thread:' + thread_names.get(ident, str(ident))
+            else:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(self._get_label(frame))
+                frame = frame.f_back
+            frames.append(root)
+            stack = ';'.join(reversed(frames))
+            counts[stack] = counts.get(stack, 0) + 1
+
+    def _get_label(self, frame):
+        code = frame.f_code
+        key = (code, frame.f_lineno)
+        label = self.labels.get(key)
+        if label is None:
+            path = code.co_filename.split(os.sep)
+            label = '{} ({}:{})'.format(code.co_name, '/'.join(path[-2:]), frame.f_lineno).replace(';', ',')
+            if len(self.labels) >= 100000:
+                self.labels.clear()
+            self.labels[key] = label
+        return label
@@ -0,0 +1,165 @@
+import threading
+import time
+from functools import wraps
+
+
+# ------------------------------------------------------------------------
+# GLOBALS
+
+# trace of the request being handled by the current thread, if tracing is enabled
+_local = threading.local()
+
+# traces of the requests being handled, by thread id, e.g. for the sampling profiler to know their stage
+active_traces = {}
+
+# whether requests get traced even if tracing is disabled by config, e.g. while profiling
+forced = False
+
+
+# ------------------------------------------------------------------------
+# TRACES
+
+class Trace(object):
+    """
+    Time spent in each stage of a request (parse, rp_selection, backend, decode...).
+    Stages can be nested: each one only accounts for its own time, not the one of its sub-stages.
+    """
+
+    __slots__ = ('start', 'end', 'durations', 'stack')
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.end = None
+        # stage name -> total duration, in seconds
+        self.durations = {}
+        self.stack = []
+
+    def get_total(self):
+        end = self.end if self.end is not None else time.monotonic()
+        return end - self.start
+
+    def get_server_timing(self):
+        """
+        :return: value of a Server-Timing header, w/ durations in ms
+        """
+        metrics = ['{};dur={:.1f}'.format(name, duration * 1000) for name, duration in self.durations.items()]
+        metrics.append('total;dur={:.1f}'.format(self.get_total() * 1000))
+        return ', '.join(metrics)
+
+    def get_current_stage(self):
+        """
+        :return: name of the innermost stage being run, None if none
+        NB: might be called from another thread
+        """
+        try:
+            return self.stack[-1].name
+        except IndexError:
+            return None
+
+    def __str__(self):
+        return ' '.join('{}={:.1f}ms'.format(name, duration * 1000) for name, duration in self.durations.items())
+
+
+class Stage(object):
+    __slots__ = ('trace', 'name', 'start', 'nested', 'inclusive')
+
+    def __init__(self, trace, name, inclusive=False):
+        """
+        :param inclusive: if True, sub-stages are not traced but accounted for in this one
+        """
+        self.trace = trace
+        self.name = name
+        self.start = None
+        # time spent in sub-stages
+        self.nested = 0.0
+        self.inclusive = inclusive
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        self.trace.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        elapsed = time.monotonic() - self.start
+        stack = self.trace.stack
+        stack.pop()
+        if stack:
+            stack[-1].nested += elapsed
+        durations = self.trace.durations
+        durations[self.name] = durations.get(self.name, 0.0) + elapsed - self.nested
+        return False
+
+
+class NullStage(object):
+    """
+    Stage of a request not being traced
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+null_stage = NullStage()
+
+
+# ------------------------------------------------------------------------
+# API
+
+def start_trace():
+    trace = _local.trace = Trace()
+    active_traces[threading.get_ident()] = trace
+    return trace
+
+
+def end_trace():
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.end = time.monotonic()
+        _local.trace = None
+        active_traces.pop(threading.get_ident(), None)
+    return trace
+
+
+def set_forced(is_forced):
+    global forced
+    forced = is_forced
+
+
+def is_forced():
+    return forced
+
+
+def get_trace():
+    return getattr(_local, 'trace', None)
+
+
+def stage(name, inclusive=False):
+    """
+    Time a block of code as a stage of the current request, e.g.: with stage('rule_action'): ...
+    NB: costs a mere thread-local lookup when request is not traced
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None or (trace.stack and trace.stack[-1].inclusive):
+        return null_stage
+    return Stage(trace, name, inclusive)
+
+
+def traced(name, inclusive=False):
+    """
+    Decorator timing each call of a function as a stage of the current request
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            trace = getattr(_local, 'trace', None)
+            if trace is None:
+                return fn(*args, **kwargs)
+            with stage(name, inclusive):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator